@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Benchmarks of the interpreter.
+
+Runs every case at each optimization level and measures the time spent
+parsing, expanding the macros and optimizing, the steps per second of the
+run and the peak memory of building and running the program. Results are
+written as JSON, and can be compared against a baseline:
+
+    ./benchmarks/bench.py -o baseline.json
+    ./benchmarks/bench.py --compare baseline.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from core import VonNeumannProgram, __version__
+from core import instructions
+from core.utils import LanguageSettings
+
+# Format of the JSON results
+BENCH_FORMAT = 1
+
+class BenchCase(object):
+    """A program with its alphabet, inputs and return value"""
+
+    def __init__(self, name, source, alph, ns=(), ws=(), ret="n",
+                 max_steps=None):
+        self.name = name
+        self.source = source
+        self.alph = alph
+        self.ns = list(ns)
+        self.ws = list(ws)
+        self.ret = ret
+        self.max_steps = max_steps
+
+def example(name, alph, ns=(), ws=(), ret="n"):
+    with open(os.path.join(ROOT, "examples", name)) as f:
+        source = f.read()
+    return BenchCase(f"examples/{name}", source, alph, ns, ws, ret)
+
+def macro_tree(depth):
+    """Macros that call the one below twice, ``depth`` levels deep, so the
+    program expands to ``2**depth`` calls of the last one"""
+    macros = ["{V1 <- T0(V2)} {\n  V1 <- V2\n  V1 <- V1 + 1\n}"]
+    for k in range(1, depth+1):
+        macros.append(f"{{V1 <- T{k}(V2)}} {{\n"
+                      f"  [V3 <- T{k-1}(V2)]\n"
+                      f"  [V1 <- T{k-1}(V3)]\n"
+                      f"}}")
+    return BenchCase(f"macro_tree_{depth}",
+                     "\n".join(macros)+f"\n[N0 <- T{depth}(N1)]\n",
+                     "[a-z]", ns=(0, 3))
+
+def macro_chain(depth):
+    """Macros that call the one below once, ``depth`` levels deep"""
+    macros = ["{V1 <- C0(V2)} {\n  V1 <- V2\n}"]
+    for k in range(1, depth+1):
+        macros.append(f"{{V1 <- C{k}(V2)}} {{\n"
+                      f"  [V3 <- C{k-1}(V2)]\n"
+                      f"  V1 <- V3\n"
+                      f"  V1 <- V1 + 1\n"
+                      f"}}")
+    return BenchCase(f"macro_chain_{depth}",
+                     "\n".join(macros)+f"\n[N0 <- C{depth}(N1)]\n",
+                     "[a-z]", ns=(0, 5))
+
+def tail_loop(length):
+    """Counts the characters of a word of ``length`` removing them one at a
+    time"""
+    source = ("L1 IF P1 BEGINS a GOTO L2\n"
+              "   IF P1 BEGINS b GOTO L2\n"
+              "   GOTO L3\n"
+              "L2 P1 <- >P1\n"
+              "   P2 <- P2.a\n"
+              "   N0 <- N0 + 1\n"
+              "   GOTO L1\n"
+              "L3 SKIP\n")
+    return BenchCase(f"tail_loop_{length}", source, "[ab]",
+                     ws=("", "ab"*(length//2)))
+
+def straight_line(size):
+    """``size`` instructions without jumps"""
+    lines = []
+    for i in range(size):
+        r = i % 8
+        if (i % 4 == 3):
+            lines.append(f"N{r} <- N{(r+1) % 8}")
+        elif (i % 4 == 2):
+            lines.append(f"N{r} <- N{r} .- 1")
+        else:
+            lines.append(f"N{r} <- N{r} + 1")
+    return BenchCase(f"straight_line_{size}", "\n".join(lines)+"\n",
+                     "[a-z]", ns=(1, 2, 3))
+
+def multiply(a, b):
+    """Product through nested counting loops of macros"""
+    source = ("{V1 <- V2 + V3} {\n"
+              "   V4 <- V2\n"
+              "   V5 <- V3\n"
+              "   A3 IF V5 /= 0 GOTO A1\n"
+              "      GOTO A2\n"
+              "   A1 V5 <- V5 .- 1\n"
+              "      V4 <- V4 + 1\n"
+              "      GOTO A3\n"
+              "   A2 V1 <- V4\n"
+              "} !!\n"
+              "V[4] = V[2]+V[3]\n"
+              "V[5] = 0\n"
+              "V[1] = V[2]+V[3]\n"
+              "!!\n"
+              "{V1 <- V2 * V3} {\n"
+              "   V4 <- 0\n"
+              "   V5 <- V3\n"
+              "   A3 IF V5 /= 0 GOTO A1\n"
+              "      GOTO A2\n"
+              "   A1 V5 <- V5 .- 1\n"
+              "      [V4 <- V4 + V2]\n"
+              "      GOTO A3\n"
+              "   A2 V1 <- V4\n"
+              "}\n"
+              "[N0 <- N1 * N2]\n")
+    return BenchCase(f"multiply_{a}x{b}", source, "[a-z]", ns=(0, a, b))
+
+def get_cases(quick=False):
+    scale = 1 if quick else 4
+    return [
+        example("macro.vn", "[@#]", ns=(3, 2)),
+        example("vonsum.vn", "[a-z]", ns=(300*scale, 400*scale)),
+        example("vonindx.vn", "[@#]", ns=(5,), ws=("#@"*50*scale,),
+                ret="w"),
+        example("pnmn+1.vn", "[a-z]", ws=("", "abc"*10*scale), ret="w"),
+        example("c11001S.vn", "[a-z]", ns=(0, 1)),
+        macro_tree(6+scale),
+        macro_chain(15*scale),
+        tail_loop(5000*scale),
+        straight_line(5000*scale),
+        multiply(30*scale, 40*scale),
+    ]
+
+def run_case(case, optim, backend):
+    """Builds and runs the program once. Returns the program and the steps
+    and seconds of the run."""
+    settings = LanguageSettings(case.alph, instructions.instruction_dict,
+                                optim, backend)
+    program = VonNeumannProgram(case.source, settings)
+    if (backend == "object"):
+        numbs, words = program._init_state(case.ns, case.ws)
+    else:
+        numbs, words = program.get_allocation().load(case.ns, case.ws)
+    # The bytecode and the compiled code are built on the first run
+    if (backend == "compiled"):
+        program.get_compiled()
+    elif (backend == "vm"):
+        program.get_bytecode()
+    start = time.perf_counter()
+    if (backend == "object"):
+        steps = program.run_objects(numbs, words, case.max_steps)
+    elif (backend == "compiled"):
+        steps = program.run_compiled(numbs, words, case.max_steps)
+    else:
+        steps = program.run_bytecode(numbs, words, case.max_steps)
+    return program, steps, time.perf_counter()-start
+
+def measure(case, optim, backend, repeat):
+    """Best of ``repeat`` runs of each phase, plus a run under tracemalloc
+    for the peak memory"""
+    best = {}
+    for _ in range(repeat):
+        program, steps, seconds = run_case(case, optim, backend)
+        times = dict(program.timings, run=seconds)
+        for k, v in times.items():
+            best[k] = min(best.get(k, v), v)
+    tracemalloc.start()
+    try:
+        run_case(case, optim, backend)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "case": case.name,
+        "optim": optim,
+        "backend": backend,
+        "instructions": len(program.instrs),
+        "steps": steps,
+        "parse_s": best["parse"],
+        "expand_s": best["expand"],
+        "optimize_s": best["optimize"],
+        "run_s": best["run"],
+        "steps_per_s": steps/best["run"] if best["run"] else None,
+        "peak_bytes": peak,
+    }
+
+# Metrics compared against a baseline, and whether higher is better
+METRICS = {
+    "parse_s": False,
+    "expand_s": False,
+    "optimize_s": False,
+    "run_s": False,
+    "steps_per_s": True,
+    "peak_bytes": False,
+}
+
+# Times under this many seconds are too noisy to compare
+MIN_SECONDS = 1e-3
+
+def compare(baseline, results, threshold):
+    """Regressions of ``results`` against ``baseline`` larger than
+    ``threshold``, relative to the baseline. Returns a list of dicts."""
+    old = {(r["case"], r["optim"], r["backend"]): r
+           for r in baseline["results"]}
+    regressions = []
+    for r in results["results"]:
+        base = old.get((r["case"], r["optim"], r["backend"]))
+        if (base is None):
+            continue
+        for metric, higher in METRICS.items():
+            a, b = base.get(metric), r.get(metric)
+            if (not a or b is None):
+                continue
+            if (metric.endswith("_s") and max(a, b) < MIN_SECONDS):
+                continue
+            change = (b-a)/a
+            if (higher):
+                change = -change
+            if (change > threshold):
+                regressions.append({
+                    "case": r["case"],
+                    "optim": r["optim"],
+                    "backend": r["backend"],
+                    "metric": metric,
+                    "baseline": a,
+                    "current": b,
+                    "change": change,
+                })
+    return regressions
+
+aparser = argparse.ArgumentParser(
+    description="Benchmarks of parsing, macro expansion and execution")
+aparser.add_argument("-O",
+    metavar="O",
+    type=int,
+    nargs="+",
+    default=[0, 1, 2],
+    help="Optimization levels to run. Default 0 1 2")
+aparser.add_argument("-b", "--backend",
+    metavar="B",
+    nargs="+",
+    default=["vm"],
+    choices=["vm", "compiled", "object"],
+    help="Backends to run. Default vm")
+aparser.add_argument("-r", "--repeat",
+    metavar="R",
+    type=int,
+    default=3,
+    help="Runs of each case, the best one is kept. Default 3")
+aparser.add_argument("-k",
+    metavar="K",
+    type=str,
+    default=None,
+    help="Only run the cases whose name contains K")
+aparser.add_argument("--quick",
+    action="store_true",
+    help="Use smaller inputs")
+aparser.add_argument("-o", "--output",
+    metavar="FILE",
+    type=str,
+    default=None,
+    help="Write the results as JSON to FILE")
+aparser.add_argument("--compare",
+    metavar="BASELINE",
+    type=str,
+    default=None,
+    help="Compare the results against the JSON results on BASELINE and"
+         " exit with status 1 if any regressed")
+aparser.add_argument("--threshold",
+    metavar="T",
+    type=float,
+    default=0.2,
+    help="Relative change counted as a regression. Default 0.2")
+aparser.add_argument("--results",
+    metavar="FILE",
+    type=str,
+    default=None,
+    help="Compare the results on FILE instead of running the benchmarks")
+
+def main():
+    args = aparser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if (args.results):
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        results = {
+            "format": BENCH_FORMAT,
+            "version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+            "results": [],
+        }
+        for case in get_cases(args.quick):
+            if (args.k and args.k not in case.name):
+                continue
+            for optim in args.O:
+                for backend in args.backend:
+                    r = measure(case, optim, backend, args.repeat)
+                    results["results"].append(r)
+                    rate = r["steps_per_s"] or 0
+                    print(f"{case.name:24} -O{optim} {backend:8} "
+                          f"parse {r['parse_s']*1000:8.2f}ms "
+                          f"expand {r['expand_s']*1000:8.2f}ms "
+                          f"optimize {r['optimize_s']*1000:8.2f}ms "
+                          f"{rate:12.0f} steps/s "
+                          f"{r['peak_bytes']/1024:9.0f}KiB",
+                          file=sys.stderr)
+        if (args.output):
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+
+    if (args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline.get("quick") != results.get("quick")):
+            logging.warning("The baseline was run with other input sizes")
+        regressions = compare(baseline, results, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['case']} -O{r['optim']} {r['backend']} "
+                  f"{r['metric']}: {r['baseline']:.6g} -> "
+                  f"{r['current']:.6g} ({r['change']:+.0%})",
+                  file=sys.stderr)
+        if (regressions):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1 +1,3 @@
+__version__ = "0.2.0"
+
 from .program import VonNeumannProgram
\ No newline at end of file
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import os
+import csv
+import json
+import signal
+import logging
+import multiprocessing
+
+from .cache import dump_program, load_program
+from .results import ResultCache
+
+def read_jsonl(stream):
+    """Inputs from a JSON lines stream. Each line is an object with the
+    lists ``ns`` and ``ws`` and optionally ``id`` and ``max_steps``, or a
+    list with the numbers and a list with the words."""
+    for line in stream:
+        line = line.strip()
+        if (not line):
+            continue
+        data = json.loads(line)
+        if (isinstance(data, list)):
+            data = {"ns": data[0], "ws": data[1] if len(data) > 1 else []}
+        yield data
+
+def read_csv(stream):
+    """Inputs from a CSV stream. The header names the columns ``n0``,
+    ``n1``... for numbers and ``w0``, ``w1``... for words, ``id`` and
+    ``max_steps`` can also be given."""
+    for row in csv.DictReader(stream):
+        data = {"ns": [], "ws": []}
+        for key, value in row.items():
+            if (key in ("id", "max_steps")):
+                if (value):
+                    data[key] = value if key == "id" else int(value)
+                continue
+            tp, indx = key[0], int(key[1:])
+            args = data["ns"] if tp == "n" else data["ws"]
+            while (len(args) <= indx):
+                args.append(0 if tp == "n" else "")
+            if (value):
+                args[indx] = int(value) if tp == "n" else value
+        yield data
+
+READERS = {
+    "jsonl": read_jsonl,
+    "csv": read_csv,
+}
+
+# State of each worker process, set by _init_worker
+_program = None
+_options = None
+_error = None
+
+def _init_worker(data, source, settings, options, memo=None):
+    global _program, _options, _error
+    _options = options
+    # A failed initializer would be run again forever by the pool, so
+    # the error is kept and reported by each run instead
+    try:
+        _program = load_program(data, source, settings)
+    except Exception as e:
+        _error = f"{type(e).__name__}: {e}"
+        logging.error(f"Worker {os.getpid()} could not load the program:"
+                      f" {_error}")
+        return
+    if (memo is not None):
+        _program.result_cache = ResultCache(memo or None)
+
+class RunTimeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise RunTimeout()
+
+def _run(job):
+    index, data = job
+    ret, max_steps, timeout = _options
+    result = {"index": index}
+    if ("id" in data):
+        result["id"] = data["id"]
+    if (_program is None):
+        result["error"] = f"The worker could not load the program: {_error}"
+        return result
+    max_steps = data.get("max_steps", max_steps)
+    timer = timeout is not None and hasattr(signal, "setitimer")
+    if (timer):
+        signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        result["result"] = _program(data.get("ns", []),
+                                    data.get("ws", []),
+                                    ret,
+                                    max_steps)
+    except RunTimeout:
+        result["error"] = f"Timeout after {timeout} seconds"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if (timer):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return result
+
+class BatchRunner(object):
+    """Runs a program over many inputs.
+
+    The program is compiled once, its expanded form is sent to a pool of
+    ``jobs`` worker processes (by default one per core) and each input is
+    run there with ``VonNeumannProgram.__call__``. Each run stops after
+    ``max_steps`` steps or ``timeout`` seconds, the timeout needs
+    ``signal.setitimer``. With one job the runs happen on this process.
+
+    ``memo`` enables a ResultCache on each worker, stored on the sqlite
+    database ``memo`` if it is not empty."""
+    chunk_size = 16
+
+    def __init__(self, program, ret="n", max_steps=None, timeout=None,
+                 jobs=None, memo=None):
+        self.program = program
+        self.options = (ret, max_steps, timeout)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.memo = memo
+
+    def run(self, inputs, ordered=True):
+        """Yields a dict for each input with its ``index``, its ``id`` if
+        it had one and the ``result`` or the ``error``. Results come in the
+        order of the inputs or, if not ``ordered``, as they are done."""
+        global _program, _options
+        jobs = enumerate(inputs)
+        if (self.jobs == 1):
+            _program, _options = self.program, self.options
+            if (self.memo is not None and _program.result_cache is None):
+                _program.result_cache = ResultCache(self.memo or None)
+            yield from map(_run, jobs)
+            return
+        source = self.program.program
+        if (not isinstance(source, str)):
+            source = getattr(source, "name", None)
+        args = (dump_program(self.program, None), source,
+                self.program.settings, self.options, self.memo)
+        with multiprocessing.Pool(self.jobs, _init_worker, args) as pool:
+            if (ordered):
+                results = pool.imap(_run, jobs, self.chunk_size)
+            else:
+                results = pool.imap_unordered(_run, jobs, self.chunk_size)
+            yield from results
\ No newline at end of file
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hashlib
+import logging
+
+from . import __version__
+from .utils import MacroState
+from .macros import VonNeumannMacroTemplate
+from .program import VonNeumannProgram
+from .library import include_keys
+from .serialize import dump_instrs, load_instrs, read_cache, write_cache
+
+CACHE_EXT = ".vnc"
+CACHE_FORMAT = 2
+
+def program_key(source, settings, libraries=()):
+    """Hash of everything the expanded program depends on. The source can
+    be a string or a text stream, which is read in chunks. ``libraries``
+    are the keys of the libraries it includes."""
+    h = hashlib.sha256()
+    if (isinstance(source, str)):
+        h.update(source.encode())
+    else:
+        for chunk in iter(lambda: source.read(1 << 16), ""):
+            h.update(chunk.encode())
+    h.update(b"\0")
+    for part in (settings.alph,
+                 str(settings.optim),
+                 str(settings.inline_limit),
+                 str(settings.safe_macros),
+                 __version__,
+                 str(CACHE_FORMAT),
+                 sys.version.split()[0],
+                 *libraries):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def get_cache_path(path):
+    return os.path.splitext(path)[0]+CACHE_EXT
+
+def dump_program(program, key):
+    """Serializable representation of an expanded program"""
+    templates = {}
+    def template_index(template):
+        if (template not in templates):
+            templates[template] = len(templates)
+        return templates[template]
+
+    # Templates are numbered as the instructions refer to them
+    instrs = dump_instrs(program.expanded, template_index)
+    return {
+        "key": key,
+        "templates": [x.source for x in templates],
+        "instrs": instrs,
+    }
+
+def load_program(data, source, settings):
+    macro_state = MacroState()
+    templates = []
+    for t in data["templates"]:
+        template = VonNeumannMacroTemplate(t, settings, macro_state)
+        macro_state.register_macro(template)
+        templates.append(template)
+
+    expanded = load_instrs(data["instrs"], templates, settings)
+    return VonNeumannProgram.from_expanded(source,
+                                           settings,
+                                           macro_state,
+                                           expanded)
+
+def compile_cached(path, settings):
+    """Returns the program on the file ``path``. The expanded program is
+    loaded from the ``.vnc`` file next to it when it was built from the
+    same source, libraries, alphabet, optimization level and interpreter
+    version, otherwise the program is compiled and the cache
+    rewritten."""
+    cache_path = get_cache_path(path)
+    with open(path) as f:
+        libraries = include_keys(f, os.path.dirname(path), settings)
+    with open(path) as f:
+        key = program_key(f, settings, libraries)
+    data = read_cache(cache_path, key)
+    if (data is not None):
+        logging.debug(f"Loading program from {cache_path}")
+        try:
+            return load_program(data, path, settings)
+        except (IndexError, KeyError, TypeError, ValueError) as e:
+            # A cache that doesn't load is built again
+            logging.warning(f"Could not load cache {cache_path}: "
+                            f"{type(e).__name__}: {e}")
+    with open(path) as f:
+        program = VonNeumannProgram(f, settings)
+    write_cache(cache_path, dump_program(program, key))
+    return program
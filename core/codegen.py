@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import sys
+import logging
+
+from .instructions import *
+from .idioms import LoopIdiom
+
+class BasicBlock(object):
+    """Straight run of instructions ``[start, end)``, only the last one can
+    jump. ``succs`` holds the instruction indexes execution can continue
+    on, a None stands for a jump that is resolved at runtime."""
+    __slots__ = ("start", "end", "succs")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.succs = []
+
+    def __len__(self):
+        return self.end-self.start
+
+def is_terminator(inst):
+    return isinstance(inst, (Ifneq0, Ifbeg, Goto, MacroCall, LoopIdiom))
+
+def build_cfg(instrs, labels):
+    """Splits the expanded program in basic blocks. Returns a dict from the
+    index of the first instruction of each block to the block."""
+    leaders = {0, len(instrs)}
+    leaders.update(labels.values())
+    for i, inst in enumerate(instrs):
+        if (is_terminator(inst)):
+            leaders.add(i+1)
+    leaders = sorted(x for x in leaders if x <= len(instrs))
+
+    blocks = {}
+    for start, end in zip(leaders, leaders[1:]):
+        block = BasicBlock(start, end)
+        last = instrs[end-1]
+        if (isinstance(last, MacroCall)):
+            block.succs = [end, None]
+        elif (isinstance(last, (Goto, LoopIdiom))):
+            block.succs = [labels.get(last.args[-1])]
+        elif (is_terminator(last)):
+            block.succs = [end, labels.get(last.args[-1])]
+        else:
+            block.succs = [end]
+        blocks[start] = block
+    return blocks
+
+class ProgramCompiler(object):
+    """Generates a single python function that runs the expanded program.
+
+    Registers are local variables of the function and each basic block is
+    a branch of a dispatch on the variable ``b``, which holds the index of
+    the next block. The function receives the numeric and word register
+    files, loads the registers the program uses and stores them back when
+    the program ends. Returns the amount of steps executed."""
+    name = "_vonneu_program"
+
+    def __init__(self, instrs, labels):
+        self.instrs = instrs
+        self.labels = labels
+        self.blocks = build_cfg(instrs, labels)
+        self.macros = []
+        self.numbs, self.words = self._get_registers()
+
+    def _get_registers(self):
+        numbs, words = set(), set()
+        for inst in self.instrs:
+            used = inst.get_used_vars()
+            numbs.update(used[0])
+            words.update(used[1])
+        return sorted(numbs), sorted(words)
+
+    def get_source(self):
+        if (hasattr(self, "_source")):
+            return self._source
+        lines = [
+            f"def {self.name}(numbs, words, limit, macros, labels):",
+        ]
+        for n in self.numbs:
+            lines.append(f"    n{n} = numbs[{n}]")
+        for p in self.words:
+            lines.append(f"    p{p} = words[{p}]")
+        lines += [
+            "    s = 0",
+            "    b = 0",
+            "    while True:",
+        ]
+        lines += self._gen_dispatch(sorted(self.blocks), 2)
+        for n in self.numbs:
+            lines.append(f"    numbs[{n}] = n{n}")
+        for p in self.words:
+            lines.append(f"    words[{p}] = p{p}")
+        lines.append("    return s")
+        self._source = "\n".join(lines)+"\n"
+        return self._source
+
+    def _gen_dispatch(self, starts, depth):
+        # Binary search over the block indexes, so each jump costs a
+        # logarithmic amount of comparisons
+        ind = "    "*depth
+        if (not starts):
+            return [f"{ind}break"]
+        if (len(starts) <= 4):
+            lines = []
+            for j, start in enumerate(starts):
+                cond = "if" if j == 0 else "elif"
+                lines.append(f"{ind}{cond} b == {start}:")
+                lines += self._gen_block(self.blocks[start], depth+1)
+            lines.append(f"{ind}else:")
+            lines.append(f"{ind}    break")
+            return lines
+        mid = len(starts)//2
+        lines = [f"{ind}if b < {starts[mid]}:"]
+        lines += self._gen_dispatch(starts[:mid], depth+1)
+        lines.append(f"{ind}else:")
+        lines += self._gen_dispatch(starts[mid:], depth+1)
+        return lines
+
+    def _gen_block(self, block, depth):
+        ind = "    "*depth
+        lines = [
+            f"{ind}s += {len(block)}",
+            f"{ind}if s > limit:",
+            f"{ind}    raise RuntimeError(\"Max ammount of steps reached\")",
+        ]
+        for i in range(block.start, block.end):
+            lines += [ind+x for x in self._gen_inst(self.instrs[i], block)]
+        if (not is_terminator(self.instrs[block.end-1])):
+            lines.append(f"{ind}b = {block.end}")
+        return lines
+
+    def _jump(self, label):
+        if (label in self.labels):
+            return f"b = {self.labels[label]}"
+        return f"raise KeyError({label})"
+
+    def _gen_inst(self, inst, block):
+        tp = type(inst)
+        a = inst.args if not isinstance(inst, MacroCall) else []
+        if (tp is Suc):
+            return [f"n{a[0]} += 1"]
+        elif (tp is Pred):
+            return [f"if n{a[0]}:", f"    n{a[0]} -= 1"]
+        elif (tp is AssignNumber):
+            return [f"n{a[0]} = n{a[1]}"]
+        elif (tp is AssignZero):
+            return [f"n{a[0]} = 0"]
+        elif (tp is Append):
+            return [f"p{a[0]} += {a[1]!r}"]
+        elif (tp is Tail):
+            return [f"p{a[0]} = p{a[0]}[1:]"]
+        elif (tp is AssignWord):
+            return [f"p{a[0]} = p{a[1]}"]
+        elif (tp is AssignEpsilon):
+            return [f"p{a[0]} = ''"]
+        elif (tp is Skip):
+            return []
+        elif (tp is Goto):
+            return [self._jump(a[0])]
+        elif (tp is Ifneq0):
+            return [f"if n{a[0]}:",
+                    f"    {self._jump(a[1])}",
+                    f"else:",
+                    f"    b = {block.end}"]
+        elif (tp is Ifbeg):
+            cond = f"p{a[0]}.startswith({a[1]!r})" if a[1] else "False"
+            return [f"if {cond}:",
+                    f"    {self._jump(a[2])}",
+                    f"else:",
+                    f"    b = {block.end}"]
+        elif (tp is MacroCall):
+            return self._gen_macro(inst, block)
+        elif (tp is LoopIdiom):
+            # The block already counted one step for the fused loop
+            lines = ["budget = limit-s+1", "steps = 0"]
+            lines += inst.get_lines(lambda r: f"n{r}", lambda r: f"p{r}")
+            lines += ["s += steps-1", self._jump(a[0])]
+            return lines
+        raise RuntimeError(f"Instruction {inst} can't be compiled")
+
+    def _gen_macro(self, inst, block):
+        # Optimized macros work over the register files, so the registers
+        # they use are spilled before the call and reloaded after it
+        numbs = sorted(set(inst.macro.var_map[0].values()))
+        words = sorted(set(inst.macro.var_map[1].values()))
+        lines = [f"numbs[{n}] = n{n}" for n in numbs]
+        lines += [f"words[{p}] = p{p}" for p in words]
+        lines.append(f"l = macros[{len(self.macros)}](numbs, words)[0]")
+        self.macros.append(inst.macro)
+        lines += [f"n{n} = numbs[{n}]" for n in numbs]
+        lines += [f"p{p} = words[{p}]" for p in words]
+        lines += ["if l is not None:",
+                  "    b = labels[l]",
+                  "else:",
+                  f"    b = {block.end}"]
+        return lines
+
+    def compile(self):
+        """Returns the generated function, compiled only once"""
+        if (hasattr(self, "_function")):
+            return self._function
+        source = self.get_source()
+        logging.debug(f"Generated program:\n{source}")
+        scope = {}
+        exec(compile(source, f"<{self.name}>", "exec"), scope)
+        function = scope[self.name]
+        macros = self.macros
+        labels = self.labels
+
+        def run(numbs, words, max_steps=None):
+            limit = sys.maxsize if max_steps is None else max_steps
+            return function(numbs, words, limit, macros, labels)
+        self._function = run
+        return run
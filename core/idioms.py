@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+import sys
+import copy
+import logging
+
+from collections import Counter
+
+from .instructions import *
+
+class ClosedLoop(object):
+    """A counting loop whose effect has a closed form.
+
+    The loop runs ``k`` times, where ``k`` is the value of the guard
+    register ``Nc`` or, for word guards, the amount of leading ``char`` on
+    ``Px``. Each iteration increments the registers in ``incs``, decrements
+    the ones in ``decs``, removes ``tails`` characters from the front of
+    words and appends the strings in ``appends``. ``per`` and ``exit`` are
+    the steps each iteration and the final check take."""
+    __slots__ = ("kind", "guard", "char", "incs", "decs", "tails", "appends",
+                 "per", "exit", "label", "target")
+
+    def __init__(self, kind, guard, char, body, label, target):
+        self.kind = kind
+        self.guard = guard
+        self.char = char
+        self.incs = Counter()
+        self.decs = Counter()
+        self.tails = Counter()
+        self.appends = {}
+        for inst in body:
+            tp = type(inst)
+            if (tp is Suc):
+                self.incs[inst.args[0]] += 1
+            elif (tp is Pred):
+                self.decs[inst.args[0]] += 1
+            elif (tp is Tail):
+                self.tails[inst.args[0]] += 1
+            else:
+                self.appends[inst.args[0]] = (
+                    self.appends.get(inst.args[0], "")+inst.args[1])
+        # The guard consumes itself once per iteration
+        if (kind == "N"):
+            self.decs[guard] -= 1
+        else:
+            self.tails[guard] -= 1
+        self.decs = +self.decs
+        self.tails = +self.tails
+        self.per = len(body)+2
+        self.exit = 2
+        self.label = label
+        self.target = target
+
+    def get_lines(self, numb, word):
+        """Python lines that run the loop. ``numb`` and ``word`` return the
+        expression used to access a register given its index."""
+        if (self.kind == "N"):
+            lines = [f"k = {numb(self.guard)}"]
+        else:
+            w = word(self.guard)
+            lines = [f"k = len({w})-len({w}.lstrip({self.char!r}))"]
+        lines += [
+            f"c = {self.exit}+k*{self.per}",
+            "if c > budget:",
+            "    raise RuntimeError(\"Max ammount of steps reached\")",
+            "budget -= c",
+            "steps += c",
+        ]
+        if (self.kind == "N"):
+            lines.append(f"{numb(self.guard)} = 0")
+        else:
+            lines.append(f"{word(self.guard)} = {word(self.guard)}[k:]")
+        for r, n in sorted(self.incs.items()):
+            lines.append(f"{numb(r)} += k*{n}")
+        for r, n in sorted(self.decs.items()):
+            lines.append(f"{numb(r)} = max({numb(r)}-k*{n}, 0)")
+        for r, n in sorted(self.tails.items()):
+            lines.append(f"{word(r)} = {word(r)}[k*{n}:]")
+        for r, a in sorted(self.appends.items()):
+            lines.append(f"{word(r)} += {a!r}*k")
+        return lines
+
+    def renumber(self, numb_map, word_map):
+        """Copy of the loop over the registers given by the maps"""
+        loop = ClosedLoop.__new__(ClosedLoop)
+        loop.kind = self.kind
+        loop.guard = (numb_map if self.kind == "N" else word_map)[self.guard]
+        loop.char = self.char
+        loop.incs = Counter({numb_map[r]: n for r, n in self.incs.items()})
+        loop.decs = Counter({numb_map[r]: n for r, n in self.decs.items()})
+        loop.tails = Counter({word_map[r]: n for r, n in self.tails.items()})
+        loop.appends = {word_map[r]: a for r, a in self.appends.items()}
+        loop.per = self.per
+        loop.exit = self.exit
+        loop.label = self.label
+        loop.target = self.target
+        return loop
+
+    def __str__(self):
+        if (self.kind == "N"):
+            guard = f"N{self.guard}"
+        else:
+            guard = f"P{self.guard} BEGINS {self.char}"
+        effects = [f"N{r}+{n}" for r, n in sorted(self.incs.items())]
+        effects += [f"N{r}.-{n}" for r, n in sorted(self.decs.items())]
+        effects += [f">{n}P{r}" for r, n in sorted(self.tails.items())]
+        effects += [f"P{r}.{a}" for r, a in sorted(self.appends.items())]
+        return f"WHILE {guard}: {', '.join(effects) or 'SKIP'}"
+
+class LoopIdiom(VonNeumannInstruction):
+    """Fused instruction that replaces one or more chained counting loops.
+
+    It is not parsed from source, it is created by ``fuse_loops`` over an
+    expanded program. Running it takes the same amount of steps the
+    original loops would take."""
+    argKinds = ("L",)
+
+    def __init__(self, loops, macro_state=None):
+        self.loops = loops
+        self.args = [loops[-1].target]
+        self.steps = 1
+        if (macro_state is not None):
+            macro_state.update_used_vars(self.get_used_vars())
+
+    def __str__(self):
+        return " ; ".join(map(str, self.loops))+f" GOTO L{self.args[0]}"
+
+    def __repr__(self):
+        return str(self)
+
+    def get_used_vars(self):
+        numbs, words = set(), set()
+        for loop in self.loops:
+            (numbs if loop.kind == "N" else words).add(loop.guard)
+            numbs.update(loop.incs, loop.decs)
+            words.update(loop.tails, loop.appends)
+        return list(numbs), list(words), list(self.args)
+
+    def renumber(self, numb_map, word_map):
+        idiom = LoopIdiom([x.renumber(numb_map, word_map)
+                           for x in self.loops])
+        idiom.origin = self.origin
+        return idiom
+
+    def retarget(self, label):
+        """Copy of the idiom that exits to ``label``"""
+        last = copy.copy(self.loops[-1])
+        last.target = label
+        idiom = LoopIdiom(self.loops[:-1]+[last])
+        idiom.origin = self.origin
+        return idiom
+
+    def get_lines(self, numb, word):
+        lines = []
+        for loop in self.loops:
+            lines += loop.get_lines(numb, word)
+        return lines
+
+    def get_function(self):
+        """Compiled function over the numbers and words state. Receives
+        the amount of steps left and returns the steps taken."""
+        if (hasattr(self, "_function")):
+            return self._function
+        lines = ["def _idiom(numbs, words, budget):", "    steps = 0"]
+        lines += ["    "+x for x in self.get_lines(lambda r: f"numbs[{r}]",
+                                                    lambda r: f"words[{r}]")]
+        lines.append("    return steps")
+        scope = {}
+        exec(compile("\n".join(lines), "<idiom>", "exec"), scope)
+        self._function = scope["_idiom"]
+        return self._function
+
+    def run(self, numbs, words, budget=sys.maxsize):
+        self.steps = self.get_function()(numbs, words, budget)
+        return self.steps
+
+    def effect(self, numbs, words):
+        self.run(numbs, words)
+        self._jump(self.args[0])
+        return numbs, words
+
+def _label_refs(instrs):
+    refs = Counter()
+    for l, inst in instrs:
+        if (isinstance(inst, MacroCall)):
+            refs.update(inst.macro.var_map[2].values())
+            continue
+        for kind, arg in zip(inst.argKinds, inst.args):
+            if (kind == "L"):
+                refs[arg] += 1
+    return refs
+
+def _match_loop(instrs, i, eff, refs):
+    """Tries to match the canonical loop
+
+        La IF Nc /= 0 GOTO Lb         La IF Px BEGINS a GOTO Lb
+           GOTO Le                       GOTO Le
+        Lb Nc <- Nc .- 1        or    Lb Px <- >Px
+           ...                           ...
+           GOTO La                       GOTO La
+
+    at index i. The body can only have Suc, Pred, Tail and Append. Returns
+    the loop and the index of its last instruction or None."""
+    la, head = instrs[i]
+    if (la is None or eff.get(la) != i or i+3 >= len(instrs)):
+        return None
+    if (type(head) is Ifneq0):
+        kind, guard, char, lb = "N", head.args[0], None, head.args[1]
+        consume = Pred
+    elif (type(head) is Ifbeg and head.args[1] != ""):
+        kind, guard, char, lb = "P", head.args[0], head.args[1], head.args[2]
+        consume = Tail
+    else:
+        return None
+    exit = instrs[i+1][1]
+    if (type(exit) is not Goto or eff.get(lb) != i+2 or refs[lb] != 1):
+        return None
+
+    j = i+2
+    body = []
+    while (j < len(instrs) and
+           type(instrs[j][1]) in (Suc, Pred, Tail, Append)):
+        body.append(instrs[j][1])
+        j += 1
+    if (j >= len(instrs)):
+        return None
+    back = instrs[j][1]
+    if (type(back) is not Goto or back.args[0] != la):
+        return None
+    # Nothing from outside may jump inside the loop
+    for k in range(i+1, j+1):
+        l = instrs[k][0]
+        if (l is not None and eff.get(l) == k and l != lb and refs[l]):
+            return None
+    if (i < eff.get(exit.args[0], -1) <= j):
+        return None
+
+    # The guard has to be consumed exactly once, and no register can be
+    # both grown and shrunk, since then the order of the body matters
+    consumed = [x for x in body
+                if type(x) is consume and x.args[0] == guard]
+    if (len(consumed) != 1):
+        return None
+    numb_up = {x.args[0] for x in body if type(x) is Suc}
+    numb_down = {x.args[0] for x in body if type(x) is Pred}
+    word_up = {x.args[0] for x in body if type(x) is Append}
+    word_down = {x.args[0] for x in body if type(x) is Tail}
+    if (numb_up & numb_down or word_up & word_down):
+        return None
+    if (kind == "N" and guard in numb_up):
+        return None
+    if (kind == "P" and (guard in word_up or
+                         sum(x.args[0] == guard for x in body
+                             if type(x) is Tail) != 1)):
+        return None
+    if (kind == "N" and sum(x.args[0] == guard for x in body
+                            if type(x) is Pred) != 1):
+        return None
+
+    return ClosedLoop(kind, guard, char, body, la, exit.args[0]), j
+
+def fuse_loops(instrs, macro_state=None):
+    """Replaces every counting loop with a closed form in ``instrs``, a list
+    of ``(label, instruction)``, by a single LoopIdiom. Loops that exit
+    straight into another fused loop that nothing else jumps to are merged
+    with it, which covers copying through an auxiliary register. Returns
+    the new list."""
+    eff = {}
+    for i, (l, inst) in enumerate(instrs):
+        if (l is not None and l not in eff):
+            eff[l] = i
+    refs = _label_refs(instrs)
+
+    out = []
+    i = 0
+    fused = 0
+    while i < len(instrs):
+        matched = _match_loop(instrs, i, eff, refs)
+        if (matched is None):
+            out.append(instrs[i])
+            i += 1
+            continue
+        loop, j = matched
+        fused += 1
+        prev = out[-1][1] if out else None
+        if (isinstance(prev, LoopIdiom) and prev.args[0] == loop.label and
+                refs[loop.label] == 2):
+            prev.loops.append(loop)
+            prev.args = [loop.target]
+        else:
+            idiom = LoopIdiom([loop], macro_state)
+            idiom.origin = instrs[i][1].origin
+            out.append((loop.label, idiom))
+        i = j+1
+    logging.debug(f"Fused {fused} loops into closed forms")
+    return out
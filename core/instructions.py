@@ -7,6 +7,10 @@ class VonNeumannInstruction(object):
     instMatch = None
     syntMatch = None
     humInst = None
+    argKinds = ()
+    # Macro calls the instruction was expanded from, outermost first, as
+    # (call, template) pairs
+    origin = ()
     next = None
     def __init__(self, inst, alph, macro_state: MacroState, inside_macro):
         self.inst = inst
@@ -15,7 +19,7 @@ class VonNeumannInstruction(object):
         self.syntMatch = self.syntMatch.format(alph=self.alph)
         self.match = re.fullmatch(self.syntMatch, inst)
         if (self.match is not None):
-            self.args = list(map(int, self.match.groups()))
+            self.args = self.parse_args(self.match.groups())
         else:
             raise SyntaxError(f"Unable to parse instruction: {self.inst}")
         macro_state.update_used_vars(self.get_used_vars())
@@ -29,6 +33,11 @@ class VonNeumannInstruction(object):
     def get_used_vars(self):
         pass
 
+    def parse_args(self, groups):
+        # Characters are kept as strings, indexes are converted to int
+        return [g if k == "C" else int(g)
+                for k, g in zip(self.argKinds, groups)]
+
     def __call__(self, numbs, words):
         ns, ws = self.effect(numbs, words)
         next = None
@@ -37,6 +46,15 @@ class VonNeumannInstruction(object):
             self.next = None
         return (next, ns, ws)
 
+    @classmethod
+    def build(cls, args, alph):
+        """Creates the instruction from already parsed arguments"""
+        inst = cls.__new__(cls)
+        inst.alph = alph
+        inst.args = list(args)
+        inst.inst = str(inst)
+        return inst
+
     @classmethod
     def get_inst_re(cls, alph):
         return cls.instMatch.format(alph=alph)
@@ -48,6 +66,7 @@ class Suc(VonNeumannInstruction):
     instMatch = fr"N{NUM_RE}<-N{NUM_RE}\+1"
     syntMatch = fr"N(?P<PN>{NUM_RE})<-N(?P=PN)\+1"
     humInst = "N{0} <- N{0}+1"
+    argKinds = ("N",)
 
     def effect(self, numbs, words):
         n = self.args[0]
@@ -61,6 +80,7 @@ class Pred(VonNeumannInstruction):
     instMatch = fr"N{NUM_RE}<-N{NUM_RE}\.-1"
     syntMatch = fr"N(?P<MN>{NUM_RE})<-N(?P=MN)\.-1"
     humInst = "N{0} <- N{0}.-1"
+    argKinds = ("N",)
 
     def effect(self, numbs, words):
         n = self.args[0]
@@ -74,6 +94,7 @@ class AssignNumber(VonNeumannInstruction):
     instMatch = fr"N{NUM_RE}<-N{NUM_RE}"
     syntMatch = fr"N({NUM_RE})<-N({NUM_RE})"
     humInst = "N{0} <- N{1}"
+    argKinds = ("N", "N")
 
     def effect(self, numbs, words):
         numbs[self.args[0]] = numbs[self.args[1]]
@@ -86,6 +107,7 @@ class AssignZero(VonNeumannInstruction):
     instMatch = fr"N{NUM_RE}<-0"
     syntMatch = fr"N({NUM_RE})<-0"
     humInst = "N{0} <- 0"
+    argKinds = ("N",)
 
     def effect(self, numbs, words):
         numbs[self.args[0]] = 0
@@ -98,6 +120,7 @@ class Ifneq0(VonNeumannInstruction):
     instMatch = fr"IFN{NUM_RE}\/=0GOTOL{NUM_RE}"
     syntMatch = fr"IFN({NUM_RE})\/=0GOTOL({NUM_RE})"
     humInst = "IF N{0} /= 0 GOTO L{1}"
+    argKinds = ("N", "L")
 
     def effect(self, numbs, words):
         if (numbs[self.args[0]]!=0):
@@ -111,6 +134,7 @@ class Append(VonNeumannInstruction):
     instMatch = fr"P{NUM_RE}<-P{NUM_RE}.{{alph}}"
     syntMatch = fr"P(?P<WA>{NUM_RE})<-P(?P=WA).({{alph}})"
     humInst = "P{0} <- P{0}.{1}"
+    argKinds = ("P", "C")
 
     def effect(self, numbs, words):
         words[self.args[0]] += self.args[1]
@@ -123,6 +147,7 @@ class Tail(VonNeumannInstruction):
     instMatch = fr"P{NUM_RE}<->P{NUM_RE}"
     syntMatch = fr"P(?P<WR>{NUM_RE})<->P(?P=WR)"
     humInst = "P{0} <- >P{0}"
+    argKinds = ("P",)
 
     def effect(self, numbs, words):
         words[self.args[0]] = words[self.args[0]][1:]
@@ -135,6 +160,7 @@ class AssignWord(VonNeumannInstruction):
     instMatch = fr"P{NUM_RE}<-P{NUM_RE}"
     syntMatch = fr"P({NUM_RE})<-P({NUM_RE})"
     humInst = "P{0} <- P{1}"
+    argKinds = ("P", "P")
 
     def effect(self, numbs, words):
         words[self.args[0]] = words[self.args[1]]
@@ -147,6 +173,7 @@ class AssignEpsilon(VonNeumannInstruction):
     instMatch = fr"P{NUM_RE}<-e"
     syntMatch = fr"P({NUM_RE})<-e"
     humInst = "P{0} <- e"
+    argKinds = ("P",)
 
     def effect(self, numbs, words):
         words[self.args[0]] = ""
@@ -159,6 +186,7 @@ class Ifbeg(VonNeumannInstruction):
     instMatch = fr"IFP{NUM_RE}BEGINS{{alph}}?GOTOL{NUM_RE}"
     syntMatch = fr"IFP({NUM_RE})BEGINS({{alph}}?)GOTOL({NUM_RE})"
     humInst = "IF P{0} BEGINS {1} GOTO L{2}"
+    argKinds = ("P", "C", "L")
 
     def effect(self, numbs, words):
         a = words[self.args[0]]
@@ -174,6 +202,7 @@ class Goto(VonNeumannInstruction):
     instMatch = fr"GOTOL{NUM_RE}"
     syntMatch = fr"GOTOL({NUM_RE})"
     humInst = "GOTO L{0}"
+    argKinds = ("L",)
 
     def effect(self, numbs, words):
         self._jump(self.args[0])
@@ -201,6 +230,7 @@ class MacroCall(VonNeumannInstruction):
         self.name = inst[1:-1]
         self.alph = alph
         self.inside_macro = inside_macro
+        self.macro_state = macro_state
         self.macro = macro_state.match(self.name, inside_macro)
         macro_state.update_used_vars(self.get_used_vars())
 
@@ -210,6 +240,18 @@ class MacroCall(VonNeumannInstruction):
     def __repr__(self):
         return self.humInst.format(self.name)
 
+    @classmethod
+    def from_macro(cls, macro, alph):
+        """Creates the call from an already matched macro"""
+        inst = cls.__new__(cls)
+        inst.name = macro.inst
+        inst.inst = f"[{macro.inst}]"
+        inst.alph = alph
+        inst.inside_macro = None
+        inst.macro_state = None
+        inst.macro = macro
+        return inst
+
     def effect(self, numbs, words):
         label, numbs, words = self.macro(numbs, words)
         if label is not None:
@@ -220,10 +262,10 @@ class MacroCall(VonNeumannInstruction):
         return self.macro.get_used_vars()
 
     def compile(self):
-        return self.macro.compile()
+        return self.macro.compile(self.macro_state)
 
     def parse_code(self):
-        return self.macro.parse_code()
+        return self.macro.parse_code(self.macro_state)
 
     @property
     def optimized(self):
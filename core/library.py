@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hashlib
+import logging
+
+from . import __version__
+from .utils import MacroState
+from .macros import VonNeumannMacroTemplate
+from .tokenizer import VonNeumannTokenizer, Include
+from .serialize import dump_instrs, load_instrs, read_cache, write_cache
+from .verify import MacroVerifier
+
+PACK_EXT = ".vnp"
+PACK_FORMAT = 1
+
+# Libraries built on this process, by path and settings
+_libraries = {}
+
+def resolve_include(path, base):
+    """Path of the library included as ``path`` from a file on the
+    directory ``base``. Without a base only absolute paths can be
+    included."""
+    path = os.path.expanduser(path)
+    if (base is None and not os.path.isabs(path)):
+        raise SyntaxError(f"Can't include {path} without the directory of"
+                          " the program")
+    return os.path.abspath(os.path.join(base or "", path))
+
+def get_pack_path(path):
+    return os.path.splitext(path)[0]+PACK_EXT
+
+def _settings_key(settings):
+    return (settings.alph, settings.optim, settings.inline_limit,
+            settings.safe_macros)
+
+def _digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+class MacroLibrary(object):
+    """Macros of a library file, compiled once for some settings.
+
+    A library is a file with macros and ``INCLUDE`` lines only. It has a
+    MacroState of its own with the templates of the libraries it includes
+    and its own ones, in the order of the file, and its templates are
+    built with their syntax regex, parameters and auxiliary variables
+    already computed, so ``register`` adds them to the MacroState of a
+    program for the cost of a dict entry each. Bodies are parsed the first
+    time a program expands them, on the MacroState of the library, and
+    kept for the next programs.
+
+    Libraries are kept on this process and written as packs, ``.vnp``
+    files next to the library, with the bodies parsed so far. ``save``
+    writes the bodies parsed since the pack was read. ``key``
+    hashes the source, the settings and the keys of the included
+    libraries, so a change to a library builds again the libraries that
+    include it and nothing else."""
+
+    def __init__(self, path, settings, digest):
+        self.path = path
+        self.settings = settings
+        # Hash of the source and the settings
+        self.digest = digest
+        self.macro_state = MacroState()
+        # Included libraries and own templates, in the order of the file
+        self.items = []
+        self.templates = []
+        self.stat = None
+        # Templates parsed or checked on the pack last written
+        self.saved = None
+
+    @property
+    def includes(self):
+        return [x for x in self.items if isinstance(x, MacroLibrary)]
+
+    def get_key(self):
+        if (hasattr(self, "key")):
+            return self.key
+        self.key = _digest(self.digest, *(x.get_key() for x in self.includes))
+        return self.key
+
+    def register(self, macro_state):
+        """Adds the templates of the library, with the ones of the
+        libraries it includes, to ``macro_state``"""
+        for item in self.items:
+            if (isinstance(item, MacroLibrary)):
+                item.register(macro_state)
+            elif (item not in macro_state.positions):
+                macro_state.register_macro(item)
+
+    def _add(self, item):
+        self.items.append(item)
+        if (isinstance(item, MacroLibrary)):
+            item.register(self.macro_state)
+        else:
+            self.templates.append(item)
+            self.macro_state.register_macro(item)
+
+    def build(self, items):
+        """Creates the templates of the macros of ``items``, the texts of
+        the macros and the included libraries"""
+        for item in items:
+            if (not isinstance(item, MacroLibrary)):
+                item = VonNeumannMacroTemplate(item, self.settings,
+                                               self.macro_state)
+                item.get_syntmatch()
+                item.get_parameters()
+                item.get_auxiliary()
+            self._add(item)
+        self._set_verifier()
+
+    def _set_verifier(self):
+        settings = self.settings
+        if (settings.safe_macros and settings.optim >= 1):
+            self.macro_state.verifier = MacroVerifier(self.macro_state.macros,
+                                                      settings)
+
+    def _parsed(self):
+        return sum(1 for t in self.templates
+                   if hasattr(t, "body") or hasattr(t, "trusted"))
+
+    def save(self):
+        """Writes the pack again when programs parsed more bodies since it
+        was written, with the libraries it includes"""
+        for library in self.includes:
+            library.save()
+        parsed = self._parsed()
+        if (parsed != self.saved):
+            write_cache(get_pack_path(self.path), self.dump())
+            self.saved = parsed
+
+    def dump(self):
+        """Serializable pack of the library"""
+        index = {t: i for i, t in enumerate(self.macro_state.macros)}
+        items = []
+        for item in self.items:
+            if (isinstance(item, MacroLibrary)):
+                items.append(("include", item.path, item.get_key()))
+                continue
+            body = None
+            if (hasattr(item, "body")):
+                body = (dump_instrs(item.body, index.__getitem__),
+                        [sorted(x) for x in item.body_vars])
+            items.append(("macro", item.source, item.optimized,
+                          getattr(item, "trusted", None),
+                          item.get_syntmatch(), item.get_parameters(),
+                          [sorted(x) for x in item.get_auxiliary()], body))
+        return {"key": self.digest, "items": items}
+
+    def load(self, data, settings, loading=()):
+        """Fills the library from a pack. Returns False if a library it
+        includes changed since the pack was written. ``loading`` are the
+        libraries being loaded, as on ``load_library``."""
+        bodies = []
+        for item in data["items"]:
+            if (item[0] == "include"):
+                library = load_library(item[1], settings, loading)
+                if (library.get_key() != item[2]):
+                    return False
+                self._add(library)
+                continue
+            _, source, optimized, trusted, synt, params, aux, body = item
+            template = VonNeumannMacroTemplate(source, settings,
+                                               self.macro_state)
+            if (not optimized):
+                template.drop_opt_code()
+            if (trusted is not None):
+                template.trusted = trusted
+            template.syntMatch = synt
+            template.parameters = tuple(params)
+            template.auxiliary = tuple(set(x) for x in aux)
+            self._add(template)
+            bodies.append((template, body))
+        for template, body in bodies:
+            if (body is not None):
+                template.body = load_instrs(body[0], self.macro_state.macros,
+                                            settings)
+                template.body_vars = [set(x) for x in body[1]]
+        self._set_verifier()
+        self.saved = self._parsed()
+        return True
+
+    def fresh(self):
+        """Whether the files of the library and of the ones it includes
+        are as they were when it was loaded"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return ((st.st_mtime_ns, st.st_size) == self.stat and
+                all(x.fresh() for x in self.includes))
+
+def read_library(source, alph):
+    """Macros and includes of the text of a library"""
+    tokens = VonNeumannTokenizer(source, alph)
+    items = list(tokens.macros())
+    for _ in tokens:
+        line, col = tokens.location()
+        raise SyntaxError(
+            f"On line {line}, column {col}: Libraries can only have macros")
+    return items
+
+def load_library(path, settings, loading=()):
+    """The MacroLibrary of the file ``path``. It is taken from the ones
+    built on this process, or from its pack, when none of its files
+    changed, otherwise it is built and its pack written."""
+    path = os.path.abspath(path)
+    if (path in loading):
+        raise SyntaxError(f"Library {path} includes itself")
+    cached = _libraries.get((path, _settings_key(settings)))
+    if (cached is not None and cached.fresh()):
+        return cached
+    try:
+        with open(path) as f:
+            st = os.fstat(f.fileno())
+            source = f.read()
+    except OSError as e:
+        raise SyntaxError(f"Could not read library {path}: {e.strerror}")
+    digest = _digest(source, *map(str, _settings_key(settings)),
+                     __version__, str(PACK_FORMAT), sys.version.split()[0])
+    loading = loading+(path,)
+
+    pack_path = get_pack_path(path)
+    library = None
+    data = read_cache(pack_path, digest)
+    if (data is not None):
+        library = MacroLibrary(path, settings, digest)
+        if (library.load(data, settings, loading)):
+            logging.debug(f"Loaded library {path} from {pack_path}")
+        else:
+            library = None
+    if (library is None):
+        try:
+            items = read_library(source, settings.alph)
+            base = os.path.dirname(path)
+            items = [load_library(resolve_include(x.path, base), settings,
+                                  loading)
+                     if isinstance(x, Include) else x for x in items]
+            library = MacroLibrary(path, settings, digest)
+            library.build(items)
+        except SyntaxError as e:
+            raise SyntaxError(f"In library {path}: {e.msg}") from None
+        library.save()
+        logging.debug(f"Built library {path}")
+    library.stat = (st.st_mtime_ns, st.st_size)
+    _libraries[(path, _settings_key(settings))] = library
+    return library
+
+def include_keys(source, base, settings):
+    """Keys of the libraries included by the program ``source``, whose
+    file is on the directory ``base``, see ``resolve_include``"""
+    keys = []
+    for item in VonNeumannTokenizer(source, settings.alph).macros():
+        if (isinstance(item, Include)):
+            library = load_library(resolve_include(item.path, base),
+                                   settings)
+            keys.append(library.get_key())
+    return keys
\ No newline at end of file
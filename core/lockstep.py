@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import sys
+import logging
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .instructions import *
+from .idioms import LoopIdiom
+
+# Instructions run on every lane waiting on them at once
+VECTOR = (Suc, Pred, AssignNumber, AssignZero, Ifneq0, Goto, Skip)
+
+class LockstepRunner(object):
+    """Runs a program over many inputs at once with NumPy.
+
+    Each number register is a row of an array with a column, a lane, for
+    each input, and each lane has its own program counter. On each step
+    every instruction some lane is waiting on runs once over all of those
+    lanes, so the numeric instructions cost a few array operations for
+    the whole batch. Other instructions, the words, the macros and the
+    fused loops run lane by lane over the registers of the lane. Numbers
+    are 64 bit integers, a run fails with OverflowError when they don't
+    fit.
+
+    Inputs are split in blocks of ``lanes``. Lanes that end or fail are
+    parked and the rest are packed again when most of the block is
+    parked. ``run`` yields the same dicts as BatchRunner, in order."""
+    lanes = 4096
+
+    def __init__(self, program, ret="n", max_steps=None, lanes=None):
+        if (np is None):
+            raise RuntimeError("Running in lockstep needs numpy")
+        if (lanes is not None):
+            self.lanes = lanes
+        self.program = program
+        self.ret = ret
+        self.max_steps = max_steps
+        self.allocation = program.get_allocation()
+        self.size = len(self.allocation.instrs)
+
+        self.undefined = []
+        def target(label):
+            if (label in program.labels):
+                return program.labels[label]
+            if (label not in self.undefined):
+                self.undefined.append(label)
+            return self.size+self.undefined.index(label)+1
+        self.target = target
+
+        self.code = []
+        for inst in self.allocation.instrs:
+            tp = type(inst)
+            if (tp in VECTOR):
+                regs = [a for k, a in zip(inst.argKinds, inst.args)
+                        if k == "N"]
+                label = [a for k, a in zip(inst.argKinds, inst.args)
+                         if k == "L"]
+                self.code.append((tp,
+                                  regs[0] if regs else 0,
+                                  regs[1] if len(regs) > 1 else 0,
+                                  target(label[0]) if label else 0))
+            else:
+                self.code.append((None, inst, 0, 0))
+
+    def run(self, inputs):
+        """Yields a dict for each input with its ``index``, its ``id`` if
+        it had one and the ``result`` or the ``error``"""
+        jobs = enumerate(inputs)
+        while True:
+            block = list(itertools.islice(jobs, self.lanes))
+            if (not block):
+                break
+            yield from self._run_block(block)
+
+    def _run_block(self, block):
+        results = []
+        numbs = []
+        words = []
+        limits = []
+        for index, data in block:
+            result = {"index": index}
+            if ("id" in data):
+                result["id"] = data["id"]
+            results.append(result)
+            try:
+                ns, ws = self.allocation.load(data.get("ns", []),
+                                              data.get("ws", []))
+                for n in ns:
+                    if (not 0 <= n < 1 << 63):
+                        raise OverflowError(f"{n} doesn't fit in 64 bits")
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+                continue
+            numbs.append(ns)
+            words.append(ws)
+            limits.append(data.get("max_steps", self.max_steps))
+        # Lanes that could run, by column
+        lane = np.array([i for i, r in enumerate(results)
+                         if "error" not in r], dtype=np.int64)
+        if (lane.size):
+            self._execute(numbs, words, limits, lane, results)
+        return results
+
+    def _fail(self, results, lane, e):
+        results[lane]["error"] = f"{type(e).__name__}: {e}"
+
+    def _execute(self, numbs, words, limits, lane, results):
+        size = self.size
+        code = self.code
+        get = self.allocation.get
+        regs = np.array(numbs, dtype=np.int64).T.copy()
+        pc = np.zeros(lane.size, dtype=np.int64)
+        steps = np.zeros(lane.size, dtype=np.int64)
+        limit = np.array([-1 if x is None else x for x in limits],
+                         dtype=np.int64)
+        bounded = bool((limit >= 0).any())
+
+        while True:
+            # Lanes that ended, jumped to an undefined label or ran out
+            # of steps are parked on -1
+            done = pc >= size
+            if (bounded):
+                done |= (pc >= 0) & (limit >= 0) & (steps >= limit)
+            for col in np.flatnonzero(done):
+                if (pc[col] == size):
+                    results[lane[col]]["result"] = get(regs[:, col].tolist(),
+                                                       words[col], self.ret)
+                elif (pc[col] > size):
+                    self._fail(results, lane[col],
+                               KeyError(self.undefined[pc[col]-size-1]))
+                else:
+                    self._fail(results, lane[col],
+                               RuntimeError("Max ammount of steps reached"))
+                pc[col] = -1
+            running = int(np.count_nonzero(pc >= 0))
+            if (not running):
+                break
+            if (running <= pc.size//2):
+                # Pack the lanes still running
+                keep = np.flatnonzero(pc >= 0)
+                regs = regs[:, keep]
+                pc = pc[keep]
+                steps = steps[keep]
+                limit = limit[keep]
+                words = [words[x] for x in keep]
+                lane = lane[keep]
+                logging.debug(f"Packed {lane.size} lanes")
+
+            first = pc[0]
+            if ((pc == first).all()):
+                # Every lane on the same instruction
+                groups = [(first, slice(None))]
+                steps += 1
+            else:
+                order = np.argsort(pc, kind="stable")
+                spc = pc[order]
+                cuts = np.flatnonzero(spc[1:] != spc[:-1])+1
+                starts = np.concatenate(([0], cuts))
+                groups = [(spc[s], x) for s, x in
+                          zip(starts, np.split(order, cuts))
+                          if (spc[s] >= 0)]
+                steps[pc >= 0] += 1
+
+            for p, sel in groups:
+                tp, a, b, c = code[p]
+                if (tp is Suc):
+                    regs[a, sel] += 1
+                    pc[sel] += 1
+                    if (regs[a, sel].min() < 0):
+                        # Numbers past 2**63-1 wrapped around
+                        cols = np.arange(pc.size)[sel]
+                        for col in cols[regs[a, cols] < 0]:
+                            self._fail(results, lane[col], OverflowError(
+                                "Number doesn't fit in 64 bits"))
+                            pc[col] = -1
+                elif (tp is Pred):
+                    row = regs[a, sel]
+                    regs[a, sel] = row-(row > 0)
+                    pc[sel] += 1
+                elif (tp is AssignNumber):
+                    regs[a, sel] = regs[b, sel]
+                    pc[sel] += 1
+                elif (tp is AssignZero):
+                    regs[a, sel] = 0
+                    pc[sel] += 1
+                elif (tp is Ifneq0):
+                    pc[sel] = np.where(regs[a, sel] != 0, c, p+1)
+                elif (tp is Goto):
+                    pc[sel] = c
+                elif (tp is Skip):
+                    pc[sel] += 1
+                else:
+                    cols = np.arange(pc.size)[sel]
+                    self._step_lanes(a, cols, regs, words, pc, steps, limit,
+                                     lane, results)
+
+    def _step_lanes(self, inst, cols, regs, words, pc, steps, limit, lane,
+                    results):
+        """Runs ``inst`` on each lane of ``cols``, one at a time"""
+        for col in cols:
+            numbs = regs[:, col].tolist()
+            ws = words[col]
+            try:
+                if (isinstance(inst, LoopIdiom)):
+                    budget = (sys.maxsize if limit[col] < 0 else
+                              int(limit[col]-steps[col]+1))
+                    steps[col] += inst.run(numbs, ws, budget)-1
+                    l = inst.args[0]
+                elif (isinstance(inst, MacroCall)):
+                    l, numbs, ws = inst.macro(numbs, ws)
+                else:
+                    l, numbs, ws = inst(numbs, ws)
+                regs[:, col] = numbs
+            except Exception as e:
+                self._fail(results, lane[col], e)
+                pc[col] = -1
+                continue
+            words[col] = ws
+            pc[col] = pc[col]+1 if l is None else self.target(l)
\ No newline at end of file
@@ -1,25 +1,55 @@
 #!/usr/bin/env python3
 import re
+import ast
+import textwrap
 
 from .parser import *
 from .utils import *
 
 class VonNeumannMacroTemplate(object):
+    """Macro definition. Only its name is read when it is created, the body
+    and the optimized code are split from the source the first time a call
+    uses them, and the body is only parsed when a call is expanded, so the
+    macros that are never called cost next to nothing."""
     match = r"(?:{(.*?)}[ \n]*)(?:{(.*?)}[ \n]*)(?:!!(.*?)!!)?"
-    opt_code = None
+    name_match = r"{(.*?)}"
     def __init__(self, macro, settings, macro_state):
         self.settings = settings
         self.macro_state = macro_state
-        match = re.fullmatch(self.match, macro, re.MULTILINE | re.DOTALL)
+        self.source = macro
+        match = re.match(self.name_match, macro, re.DOTALL)
         if (not match):
             raise SyntaxError("Could not match a macro.")
         self.name = clean_program(match.group(1))
 
-        self.code = clean_program(match.group(2))
-        self.optimized = False
-        if (match.group(3)):
-            self.opt_code = match.group(3)
-            self.optimized = True
+    def _split(self):
+        if (hasattr(self, "_code")):
+            return
+        match = re.fullmatch(self.match, self.source,
+                             re.MULTILINE | re.DOTALL)
+        if (not match):
+            raise SyntaxError("Could not match a macro.")
+        self._code = clean_program(match.group(2))
+        self._opt_code = match.group(3) or None
+
+    @property
+    def code(self):
+        self._split()
+        return self._code
+
+    @property
+    def opt_code(self):
+        self._split()
+        return self._opt_code
+
+    @property
+    def optimized(self):
+        return self.opt_code is not None
+
+    def drop_opt_code(self):
+        """Forgets the optimized code, the calls expand the body instead"""
+        self._split()
+        self._opt_code = None
 
     def get_vars_on_name(self):
         if (hasattr(self, "vars_on_name")):
@@ -64,6 +94,25 @@ class VonNeumannMacroTemplate(object):
             )
         return self.auxiliary
 
+    def get_opt_auxiliary(self):
+        """Auxiliary variables of the optimized code, the ones it indexes
+        that are not parameters. Code with dynamic indexes can reach any of
+        the body, so it takes the ones of the body."""
+        if (hasattr(self, "opt_auxiliary")):
+            return self.opt_auxiliary
+        factory = self.get_opt_factory()
+        if (factory.dynamic):
+            self.opt_auxiliary = self.get_auxiliary()
+            return self.opt_auxiliary
+        aux = (set(), set(), set())
+        for p in factory.params:
+            aux[AUX_TP_INDX[p[1]]].add(int(p[2:]))
+        params = self.get_parameters()
+        self.opt_auxiliary = tuple(
+            aux[i].difference(set(params[i])) for i in range(3)
+        )
+        return self.opt_auxiliary
+
     def get_syntmatch(self):
         if (hasattr(self, "syntMatch")):
             return self.syntMatch
@@ -94,6 +143,38 @@ class VonNeumannMacroTemplate(object):
         if (match is not None):
             return VonNeumannMacro(inst, self)
 
+    def get_shape(self):
+        """Shape of the calls this template matches, see ``call_shape``.
+        None when the digits of a variable could run into the ones after
+        it on a call."""
+        shape = re.sub(AUX_MATCH, "#", self.name)
+        if (re.search(r"#[0-9]", shape)):
+            return None
+        return call_shape(shape)
+
+    def get_body(self):
+        """Instructions of the body, parsed once with the template's own
+        numbering: ``Vx`` is ``Nx``, ``Wx`` is ``Px`` and ``Ax`` is ``Lx``,
+        and nested macros take the variables after the ones used. Returns
+        the instructions and the variables they use."""
+        if (hasattr(self, "body")):
+            return self.body, self.body_vars
+        state = self.macro_state.fork()
+        code = re.sub(AUX_MATCH,
+                      lambda m: AUX_TO_VAR[m.group(1)]+m.group(2),
+                      self.code)
+        self.body = VonNeumannParser(code, self.settings, state, self).instrs
+        self.body_vars = state.get_used_vars()
+        return self.body, self.body_vars
+
+    def get_opt_factory(self):
+        """Compiles the optimized code once. Returns an OptCodeFactory that
+        builds the function for each call site."""
+        if (hasattr(self, "opt_factory")):
+            return self.opt_factory
+        self.opt_factory = OptCodeFactory(self.opt_code, self.name)
+        return self.opt_factory
+
     @staticmethod
     def get_macro_re():
         return r"(?:{.*?}[ \n]*){2}(?:!!.*?!!)?"
@@ -103,12 +184,9 @@ class VonNeumannMacro:
                  inst: str,
                  template: VonNeumannMacroTemplate):
         self.inst = inst
-        self.code = template.code
         self.template = template
         self.compiled = False
         self.var_map = [dict(), dict(), dict()]
-        self.parsed_insts = None
-        self.ctx_used_vars = None
 
         match = re.fullmatch(self.template.get_syntmatch(), self.inst)
         arguments = ([], [], [])
@@ -123,62 +201,227 @@ class VonNeumannMacro:
             for arg, para in zip(args_tp, para_tp):
                 self.var_map[i][para] = arg
 
+    @classmethod
+    def from_var_map(cls, inst, template, var_map):
+        """Creates an already compiled macro from its variable map"""
+        macro = cls.__new__(cls)
+        macro.inst = inst
+        macro.template = template
+        macro.compiled = True
+        macro.var_map = [dict(x) for x in var_map]
+        return macro
+
+    @property
+    def code(self):
+        return self.template.code
+
     def get_used_vars(self):
         return tuple( set(x.values()) for x in self.var_map )
 
-    def compile(self):
+    def compile(self, macro_state=None):
+        """Maps the auxiliary variables to free ones of ``macro_state``"""
         if self.compiled:
             return
         self.compiled = True
-        for i, vars_tp, aux_tp in zip(range(3),
-                                   self.template.macro_state.get_used_vars(),
-                                   self.template.get_auxiliary()):
-            end = max(vars_tp) if vars_tp else 0
-            complete = set(range(0, end+len(aux_tp)+1))
-            diff = complete.difference(vars_tp)
-            for code, mape in zip(aux_tp, diff):
-                self.var_map[i][code] = mape
-                self.template.macro_state.take_var(i,code)
-
-
-        self.code = re.sub(
-            fr"([VWA])({NUM_RE})",
-            self._translate_aux_var,
-            self.code)
-
-    def _translate_aux_var(self, match):
-        var_tp = AUX_TO_VAR[match.group(1)]
-        var_ind = self.var_map[VAR_TP_INDX[var_tp]][int(match.group(2))]
-        return f"{var_tp}{var_ind}"
-
-    def parse_code(self):
+        if (macro_state is None):
+            macro_state = self.template.macro_state
+        template = self.template
+        # Macros that run their optimized code only need its variables
+        if (template.settings.optim >= 1 and template.optimized):
+            auxiliary = template.get_opt_auxiliary()
+        else:
+            auxiliary = template.get_auxiliary()
+        for i, aux_tp in enumerate(auxiliary):
+            for code in sorted(aux_tp):
+                self.var_map[i][code] = macro_state.alloc_var(i)
+
+    def parse_code(self, macro_state=None):
+        """Instructions of the macro, renumbered from the parsed body of
+        the template. Variables of nested macros take free ones of
+        ``macro_state``."""
         if not self.compiled:
             raise MacroError("Can't parse instructions before compiling")
-        self.code_parser = VonNeumannParser(self.code,
-                                            self.template.settings,
-                                            self.template.macro_state,
-                                            self)
-        return self.code_parser.instrs
+        if (macro_state is None):
+            macro_state = self.template.macro_state
+        body, body_vars = self.template.get_body()
+        maps = [dict(x) for x in self.var_map]
+        for i in range(3):
+            for var in sorted(body_vars[i]):
+                if (var not in maps[i]):
+                    maps[i][var] = macro_state.alloc_var(i)
+        alph = self.template.settings.alph
+        frame = (self.inst, self.template)
+        instrs = []
+        for l, inst in body:
+            new = self._renumber(inst, maps, alph)
+            new.origin = (frame,)+tuple((self._rename(x, maps), t)
+                                        for x, t in inst.origin)
+            instrs.append((maps[2][l] if l is not None else None, new))
+        return instrs
 
-    def __call__(self, numbs, words):
-        V = OptCodeVariables(self.var_map[0], numbs)
-        W = OptCodeVariables(self.var_map[1], words)
+    @staticmethod
+    def _rename(name, maps):
+        return re.sub(
+            VAR_MATCH,
+            lambda m: m.group(1)+str(
+                maps[VAR_TP_INDX[m.group(1)]][int(m.group(2))]),
+            name)
+
+    @staticmethod
+    def _renumber(inst, maps, alph):
+        if (isinstance(inst, MacroCall)):
+            macro = inst.macro
+            var_map = [{k: maps[i][v] for k, v in macro.var_map[i].items()}
+                       for i in range(3)]
+            name = VonNeumannMacro._rename(macro.inst, maps)
+            return MacroCall.from_macro(
+                VonNeumannMacro.from_var_map(name, macro.template, var_map),
+                alph)
+        args = [maps[VAR_TP_INDX[k]][a] if k in VAR_TP_INDX else a
+                for k, a in zip(inst.argKinds, inst.args)]
+        return type(inst).build(args, alph)
+
+    def get_opt_function(self):
+        if (hasattr(self, "opt_function")):
+            return self.opt_function
         out_labels = {}
         for k, v in self.var_map[2].items():
             if k in self.template.get_parameters()[2]:
                 out_labels[k] = v
-        A = OptCodeLabels(out_labels)
-        GOTO = self._jump
-        label = None
-        try:
-            exec(self.template.opt_code)
-        except OutsideJump as e:
-            label = e.args[0]
+        self.opt_function = self.template.get_opt_factory().bind(
+            self.var_map[0], self.var_map[1], out_labels)
+        return self.opt_function
+
+    def __call__(self, numbs, words):
+        label = self.get_opt_function()(numbs, words)
         return label, numbs, words
 
-    def _jump(self, label):
-        lab = label
-        raise OutsideJump(lab)
+class OptCodeFactory:
+    """Optimized code of a template, compiled once.
+
+    The code is rewritten so each ``V[x]``, ``W[x]`` and ``A[x]`` with a
+    literal index reads a variable of a closure and each ``GOTO(l)``
+    statement returns the label. ``bind`` builds, for a call site, the
+    function ``f(numbs, words)`` that runs the code and returns the label to
+    jump to or None. Dynamic indexes and GOTO used inside expressions
+    keep working through OptCodeVariables and OutsideJump."""
+    def __init__(self, code, name):
+        self.name = name
+        tree = ast.parse(textwrap.dedent(code), f"<macro {name}>")
+        rewriter = OptCodeRewriter()
+        tree.body = [rewriter.visit(x) for x in tree.body]
+        tree.body.append(ast.Return(ast.Constant(None)))
+        self.params = sorted(rewriter.params)
+        self.dynamic = rewriter.dynamic
+
+        if (self.dynamic):
+            # Fall back to the wrappers for what can't be bound statically
+            prelude = ast.parse(
+                "V = _OptCodeVariables(_vmap, numbs)\n"
+                "W = _OptCodeVariables(_wmap, words)\n"
+                "A = _OptCodeLabels(_amap)\n"
+                "GOTO = _jump\n").body
+            handler = ast.parse(
+                "try:\n"
+                "    pass\n"
+                "except _OutsideJump as e:\n"
+                "    return e.args[0]\n").body[0]
+            handler.body = tree.body
+            tree.body = prelude+[handler]
+
+        func = ast.FunctionDef(
+            name="_opt",
+            args=ast.arguments(posonlyargs=[],
+                               args=[ast.arg("numbs"), ast.arg("words")],
+                               kwonlyargs=[], kw_defaults=[], defaults=[]),
+            body=tree.body, decorator_list=[], returns=None)
+        factory = ast.FunctionDef(
+            name="_factory",
+            args=ast.arguments(posonlyargs=[],
+                               args=[ast.arg(x) for x in
+                                     self.params+["_vmap", "_wmap", "_amap"]],
+                               kwonlyargs=[], kw_defaults=[], defaults=[]),
+            body=[func, ast.Return(ast.Name("_opt", ast.Load()))],
+            decorator_list=[], returns=None)
+        module = ast.fix_missing_locations(ast.Module([factory], []))
+
+        scope = dict(globals())
+        scope.update({"_OptCodeVariables": OptCodeVariables,
+                      "_OptCodeLabels": OptCodeLabels,
+                      "_OutsideJump": OutsideJump,
+                      "_jump": self._jump})
+        exec(compile(module, f"<macro {name}>", "exec"), scope)
+        self.factory = scope["_factory"]
+
+    def bind(self, numbs_map, words_map, labels_map):
+        maps = {"V": numbs_map, "W": words_map, "A": labels_map}
+        args = []
+        for p in self.params:
+            tp, indx = p[1], int(p[2:])
+            if (indx not in maps[tp]):
+                raise IndexError(
+                    f"{tp}[{indx}] is not defined for macro {self.name}")
+            args.append(maps[tp][indx])
+        return self.factory(*args, numbs_map, words_map, labels_map)
+
+    @staticmethod
+    def _jump(label):
+        raise OutsideJump(label)
+
+class OptCodeRewriter(ast.NodeTransformer):
+    """Binds literal indexes of the optimized code and turns GOTO
+    statements into returns"""
+    states = {"V": "numbs", "W": "words"}
+
+    def __init__(self):
+        self.params = set()
+        self.dynamic = False
+        self.nested = 0
+
+    def visit_Subscript(self, node):
+        if (isinstance(node.value, ast.Name) and
+                node.value.id in ("V", "W", "A") and
+                isinstance(node.slice, ast.Constant) and
+                type(node.slice.value) is int):
+            tp = node.value.id
+            param = f"_{tp}{node.slice.value}"
+            self.params.add(param)
+            if (tp == "A"):
+                return ast.copy_location(ast.Name(param, ast.Load()), node)
+            return ast.copy_location(
+                ast.Subscript(ast.Name(self.states[tp], ast.Load()),
+                              ast.Name(param, ast.Load()),
+                              node.ctx),
+                node)
+        self.generic_visit(node)
+        return node
+
+    def visit_Name(self, node):
+        if (node.id in ("V", "W", "A", "GOTO")):
+            self.dynamic = True
+        return node
+
+    def visit_Expr(self, node):
+        call = node.value
+        if (not self.nested and isinstance(call, ast.Call) and
+                isinstance(call.func, ast.Name) and call.func.id == "GOTO" and
+                len(call.args) == 1 and not call.keywords):
+            return ast.copy_location(
+                ast.Return(self.visit(call.args[0])), node)
+        self.generic_visit(node)
+        return node
+
+    def _visit_nested(self, node):
+        # A GOTO inside a nested function can't become a return
+        self.nested += 1
+        self.generic_visit(node)
+        self.nested -= 1
+        return node
+
+    visit_FunctionDef = _visit_nested
+    visit_AsyncFunctionDef = _visit_nested
+    visit_Lambda = _visit_nested
+    visit_ClassDef = _visit_nested
 
 class OptCodeLabels:
     """This class represents the labels inside the optimized code"""
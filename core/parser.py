@@ -1,81 +1,100 @@
 #!/usr/bin/env python3
-import re
-import logging
+import time
 
 
 from .utils import *
 from .instructions import *
+from .tokenizer import VonNeumannTokenizer
 
 class VonNeumannParser(object):
     def __init__(self,
-                 code: str,
+                 code,
                  settings: LanguageSettings,
                  macro_state: MacroState=None,
                  inside_macro=None):
-        self.code = clean_program(code)
+        if (isinstance(code, VonNeumannTokenizer)):
+            self.tokens = code
+        else:
+            self.tokens = VonNeumannTokenizer(code, settings.alph)
         self.settings = settings
         self.macro_state = macro_state
         self.inside_macro = inside_macro
+        start = time.perf_counter()
         self._parse_program()
+        parsed = time.perf_counter()
+        self._expand_macros()
+        # Seconds spent on each phase
+        self.timings = {"parse": parsed-start,
+                        "expand": time.perf_counter()-parsed}
 
     def _parse_program(self):
-        non_parsed_insts = re.finditer(self.get_regex(), self.code)
-
         self.instrs = []
-        last_stop = 0
-        for i, m in enumerate(non_parsed_insts):
-            span = m.span()
-            # Check that the entire string was matched
-            if (last_stop!=span[0]):
-                raise SyntaxError(
-                    f"On instruction {i+1}: Could not "
-                    f"match {self.code[last_stop:span[0]]}"
-                )
-            last_stop = span[1]
-            g = m.lastgroup
+        alph = self.settings.alph
+        for l, inst_cls, args in self.tokens:
             try:
-                inst_cls = self.settings.instrs[g]
-                inst = inst_cls(m.group(g),
-                                self.settings.alph,
-                                self.macro_state,
-                                self.inside_macro)
+                if (inst_cls is MacroCall):
+                    inst = MacroCall(f"[{args}]",
+                                     alph,
+                                     self.macro_state,
+                                     self.inside_macro)
+                else:
+                    inst = inst_cls.build(args, alph)
+                    self.macro_state.update_used_vars(inst.get_used_vars())
             except SyntaxError as e:
-                raise SyntaxError(f"On line {i+1}. {e.msg}")
+                line, col = self.tokens.location()
+                raise SyntaxError(
+                    f"On line {line}, column {col}: {e.msg}") from None
 
-            l = m.group(1)
             if (l is not None):
-                l = int(l)
                 self.macro_state.take_label(l)
             self.instrs.append((l, inst))
 
-        for i, linst in enumerate(self.instrs):
-            l = linst[0]
-            inst = linst[1]
+    def _expand_macros(self):
+        instrs = []
+        for l, inst in self.instrs:
             if (isinstance(inst,MacroCall)):
-                inst.compile()
+                verifier = self.macro_state.verifier
+                if (verifier is not None and inst.optimized):
+                    verifier.trust(inst.macro.template)
+                try:
+                    inst.compile()
+                except SyntaxError as e:
+                    raise SyntaxError(f"In macro {inst}: {e.msg}") from None
                 if (self.settings.optim==0 or not inst.optimized):
-                    macro_inst = inst.parse_code()
+                    if (self._outline(inst)):
+                        instrs.append((l, inst))
+                        continue
+                    try:
+                        macro_inst = inst.parse_code()
+                    except SyntaxError as e:
+                        raise SyntaxError(
+                            f"In macro {inst}: {e.msg}") from None
                     if l is not None:
-                        s = Skip(
-                            "SKIP",
-                            self.settings.alph,
-                            self.macro_state,
-                            self.inside_macro)
-                        macro_inst = [(l, s)]+macro_inst
-                    self.instrs[i:i+1] = macro_inst
+                        instrs.append((l, Skip.build([], self.settings.alph)))
+                    instrs += macro_inst
+                    continue
+            instrs.append((l, inst))
+        self.instrs = instrs
 
-    def get_regex(self):
-        if (hasattr(self,"_regex")):
-            return self._regex
-        r = gen_regex(self.settings.instrs, self.settings.alph)
-        self._regex = r
-        logging.debug(f"Language Regex={self._regex}")
-        return r
+    def _outline(self, inst):
+        """Whether the call is left for SubroutineLowering instead of
+        being expanded"""
+        limit = self.settings.inline_limit
+        if (limit is None):
+            return False
+        try:
+            body = inst.macro.template.get_body()[0]
+        except SyntaxError as e:
+            raise SyntaxError(f"In macro {inst}: {e.msg}") from None
+        return len(body) > limit
 
     def get_program_str(self):
-        program = ""
-        for l,i in self.instrs:
-            if l is not None:
-                program += f"L{l} "
-            program += f"{str(i)}\n"
-        return program
\ No newline at end of file
+        return program_str(self.instrs)
+
+def program_str(instrs):
+    program = []
+    for l,i in instrs:
+        if l is not None:
+            program.append(f"L{l} ")
+        program.append(f"{str(i)}\n")
+    return "".join(program)
\ No newline at end of file
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+import logging
+
+from collections import Counter
+
+from .instructions import *
+from .idioms import LoopIdiom, _label_refs
+from .macros import VonNeumannMacro
+from .regalloc import uses_defs, successors, liveness
+
+# Instructions whose only effect is changing the register they write
+PURE = (Suc, Pred, AssignNumber, AssignZero, Append, Tail, AssignWord,
+        AssignEpsilon)
+# Instructions that never go on to the next one
+UNCONDITIONAL = (Goto, LoopIdiom)
+BRANCHES = (Ifneq0, Ifbeg)
+
+def label_index(instrs):
+    """Index of the instruction each label is on, the first one when a
+    label is defined twice"""
+    eff = {}
+    for i, (l, inst) in enumerate(instrs):
+        if (l is not None and l not in eff):
+            eff[l] = i
+    return eff
+
+def retarget(inst, labels):
+    """Copy of ``inst`` jumping to ``labels[l]`` instead of each label
+    ``l`` in ``labels``, or ``inst`` itself if it jumps to none of them"""
+    if (isinstance(inst, MacroCall)):
+        macro = inst.macro
+        outs = macro.var_map[2]
+        if (not any(l in labels for l in outs.values())):
+            return inst
+        var_map = [macro.var_map[0],
+                   macro.var_map[1],
+                   {k: labels.get(v, v) for k, v in outs.items()}]
+        new = MacroCall.from_macro(
+            VonNeumannMacro.from_var_map(macro.inst, macro.template, var_map),
+            inst.alph)
+    elif (isinstance(inst, LoopIdiom)):
+        if (inst.args[0] not in labels):
+            return inst
+        return inst.retarget(labels[inst.args[0]])
+    else:
+        # Jumps have the label as their last argument
+        if (not inst.argKinds or inst.argKinds[-1] != "L" or
+                inst.args[-1] not in labels):
+            return inst
+        new = type(inst).build(inst.args[:-1]+[labels[inst.args[-1]]],
+                               inst.alph)
+    new.origin = inst.origin
+    return new
+
+def remove(instrs, drop):
+    """``instrs`` without the instructions whose index is in ``drop``.
+
+    The label of a removed instruction moves to the next instruction kept,
+    if it has no label of its own, or the jumps to it are retargeted to
+    that label. A label left after the last instruction keeps a SKIP, so
+    jumping there still ends the program."""
+    if (not drop):
+        return instrs
+    eff = label_index(instrs)
+    refs = _label_refs([x for i, x in enumerate(instrs) if i not in drop])
+    rename = {}
+    pending = []
+    out = []
+    for i, (l, inst) in enumerate(instrs):
+        live = l is not None and eff[l] == i and refs[l]
+        if (i in drop):
+            if (live):
+                pending.append(l)
+            continue
+        if (pending):
+            if (not live):
+                l = pending.pop(0)
+            for x in pending:
+                rename[x] = l
+            pending = []
+        out.append((l, inst))
+    if (pending):
+        for x in pending[1:]:
+            rename[x] = pending[0]
+        out.append((pending[0], Skip.build([], instrs[-1][1].alph)))
+    if (rename):
+        out = [(l, retarget(inst, rename)) for l, inst in out]
+    return out
+
+class OptimizationPass(object):
+    """A rewrite of an expanded program, a list of ``(label,
+    instruction)``. ``run`` returns the new list, which takes the same
+    registers as inputs and outputs but can take less steps."""
+    name = None
+
+    def run(self, instrs):
+        raise NotImplementedError()
+
+class SkipElimination(OptimizationPass):
+    """Removes every SKIP, the parser adds one before each labeled macro
+    call and most macros end on one"""
+    name = "skip"
+
+    def run(self, instrs):
+        drop = {i for i, (l, inst) in enumerate(instrs)
+                if (type(inst) is Skip)}
+        return remove(instrs, drop)
+
+class UnreachableCode(OptimizationPass):
+    """Removes the instructions no path from the first one reaches"""
+    name = "unreachable"
+
+    def run(self, instrs):
+        if (not instrs):
+            return instrs
+        labels = label_index(instrs)
+        size = len(instrs)
+        seen = {0}
+        work = [0]
+        while work:
+            i = work.pop()
+            for j in successors(i, instrs[i][1], labels, size):
+                if (j < size and j not in seen):
+                    seen.add(j)
+                    work.append(j)
+        return remove(instrs, set(range(size))-seen)
+
+class JumpThreading(OptimizationPass):
+    """Jumps to a GOTO go straight to its target, and jumps to the next
+    instruction are removed"""
+    name = "threading"
+
+    def run(self, instrs):
+        while True:
+            size = len(instrs)
+            instrs = self._thread(instrs)
+            if (len(instrs) == size):
+                return instrs
+
+    @staticmethod
+    def _thread(instrs):
+        eff = label_index(instrs)
+
+        def final(l):
+            seen = set()
+            while (l in eff and type(instrs[eff[l]][1]) is Goto and
+                   l not in seen):
+                seen.add(l)
+                l = instrs[eff[l]][1].args[0]
+            return l
+
+        threads = {}
+        for l in _label_refs(instrs):
+            target = final(l)
+            if (target != l):
+                threads[l] = target
+        instrs = [(l, retarget(inst, threads)) for l, inst in instrs]
+        drop = set()
+        for i, (l, inst) in enumerate(instrs):
+            if (type(inst) is Goto or isinstance(inst, BRANCHES)):
+                if (eff.get(inst.args[-1]) == i+1):
+                    drop.add(i)
+        return remove(instrs, drop)
+
+class BranchInversion(OptimizationPass):
+    """Moves the code jumped to by the GOTO after a branch in place of the
+    GOTO.
+
+    The language has no test for zero, so ``IF N1 /= 0 GOTO L1`` followed
+    by ``GOTO L2`` can't be turned into a single branch. Instead, when the
+    block starting on ``L2`` is only reached from that GOTO and ends on an
+    unconditional jump, it is moved after the branch, which saves the GOTO
+    each time the branch is not taken. Blocks with a label defined more
+    than once stay where they are."""
+    name = "inversion"
+
+    def run(self, instrs):
+        while True:
+            size = len(instrs)
+            instrs = self._invert(instrs)
+            if (len(instrs) == size):
+                return instrs
+
+    @staticmethod
+    def _invert(instrs):
+        eff = label_index(instrs)
+        refs = _label_refs(instrs)
+        # Jumps go to the first definition of a label, moving a label
+        # defined twice could change which one that is
+        defined = Counter(l for l, inst in instrs if l is not None)
+        size = len(instrs)
+        used = set()
+        moves = {}
+        for i in range(size-1):
+            goto_label, goto = instrs[i+1]
+            if (not isinstance(instrs[i][1], BRANCHES) or
+                    type(goto) is not Goto):
+                continue
+            if (goto_label is not None and eff[goto_label] == i+1 and
+                    refs[goto_label]):
+                continue
+            k = eff.get(goto.args[0])
+            if (k is None or k == 0 or refs[goto.args[0]] != 1 or
+                    not isinstance(instrs[k-1][1], UNCONDITIONAL)):
+                continue
+            m = k
+            while (m < size and
+                   not isinstance(instrs[m][1], UNCONDITIONAL)):
+                m += 1
+            if (m == size):
+                continue
+            block = set(range(k, m+1))
+            if (any(defined[instrs[j][0]] > 1 for j in block
+                    if instrs[j][0] is not None)):
+                continue
+            if (i in block or i+1 in block or
+                    used & (block | {i, i+1})):
+                continue
+            used |= block | {i, i+1}
+            moves[i+1] = (k, m)
+
+        if (not moves):
+            return instrs
+        moved = set()
+        for k, m in moves.values():
+            moved.update(range(k, m+1))
+        out = []
+        for i, x in enumerate(instrs):
+            if (i in moves):
+                k, m = moves[i]
+                out += instrs[k:m+1]
+            elif (i not in moved):
+                out.append(x)
+        return out
+
+class CopyPropagation(OptimizationPass):
+    """Reads of a register assigned from another one read the other one
+    instead, while neither changes. Assignments of a register to itself
+    are removed."""
+    name = "copies"
+
+    def run(self, instrs):
+        refs = _label_refs(instrs)
+        copies = {}
+        out = []
+        drop = set()
+        for i, (l, inst) in enumerate(instrs):
+            if (l is not None and refs[l]):
+                copies = {}
+            tp = type(inst)
+            if (tp in (AssignNumber, AssignWord)):
+                kind = 0 if tp is AssignNumber else 1
+                src = copies.get((kind, inst.args[1]), inst.args[1])
+                if (src != inst.args[1]):
+                    inst = self._replace(inst, [inst.args[0], src])
+                if (inst.args[0] == src):
+                    drop.add(i)
+            elif (tp in BRANCHES):
+                kind = 0 if tp is Ifneq0 else 1
+                src = copies.get((kind, inst.args[0]), inst.args[0])
+                if (src != inst.args[0]):
+                    inst = self._replace(inst, [src]+inst.args[1:])
+            out.append((l, inst))
+
+            for reg in uses_defs(inst)[1]:
+                copies.pop(reg, None)
+                for dst in [k for k, v in copies.items()
+                            if (k[0] == reg[0] and v == reg[1])]:
+                    del copies[dst]
+            if (tp in (AssignNumber, AssignWord) and i not in drop):
+                copies[(kind, inst.args[0])] = inst.args[1]
+            elif (isinstance(inst, UNCONDITIONAL)):
+                copies = {}
+        return remove(out, drop)
+
+    @staticmethod
+    def _replace(inst, args):
+        new = type(inst).build(args, inst.alph)
+        new.origin = inst.origin
+        return new
+
+class DeadCode(OptimizationPass):
+    """Removes the instructions that only write registers that are never
+    read afterwards, or only read by other removed instructions. Only
+    ``N0`` and ``P0`` are read when the program ends."""
+    name = "dead"
+
+    def run(self, instrs):
+        return remove(instrs, self._dead(instrs))
+
+    @staticmethod
+    def _dead(instrs):
+        bit = {(0, 0): 0, (1, 0): 1}
+        gen, kill, defs = [], [], []
+        for l, inst in instrs:
+            masks = []
+            for regs in uses_defs(inst):
+                mask = 0
+                for reg in regs:
+                    if (reg not in bit):
+                        bit[reg] = len(bit)
+                    mask |= 1 << bit[reg]
+                masks.append(mask)
+            gen.append(masks[0])
+            defs.append(masks[1])
+            kill.append(masks[2])
+        labels = label_index(instrs)
+        size = len(instrs)
+        succs = [successors(i, x[1], labels, size)
+                 for i, x in enumerate(instrs)]
+        pure = [defs[i] if isinstance(x[1], PURE) else 0
+                for i, x in enumerate(instrs)]
+        live_out = liveness(gen, kill, succs, exit=0b11, pure=pure)
+        return {i for i, (l, inst) in enumerate(instrs)
+                if (isinstance(inst, PURE) and not defs[i] & live_out[i])}
+
+# Passes run by default, in order
+PASSES = [SkipElimination, CopyPropagation, DeadCode, UnreachableCode,
+          JumpThreading, BranchInversion]
+
+class PassManager(object):
+    """Runs optimization passes over an expanded program, in order, again
+    and again while a round removes instructions. ``removed`` counts the
+    instructions removed by each pass, by name."""
+    max_rounds = 4
+
+    def __init__(self, passes=None):
+        if (passes is None):
+            passes = [x() for x in PASSES]
+        self.passes = list(passes)
+        self.removed = Counter()
+
+    def add_pass(self, opt_pass):
+        self.passes.append(opt_pass)
+
+    def run(self, instrs):
+        size = len(instrs)
+        for _ in range(self.max_rounds):
+            before = len(instrs)
+            for opt_pass in self.passes:
+                n = len(instrs)
+                instrs = opt_pass.run(instrs)
+                self.removed[opt_pass.name] += n-len(instrs)
+            if (len(instrs) == before):
+                break
+        for opt_pass in self.passes:
+            logging.info(f"Pass {opt_pass.name} removed "
+                         f"{self.removed[opt_pass.name]} instructions")
+        logging.info(f"Optimized from {size} to {len(instrs)} instructions")
+        return instrs
\ No newline at end of file
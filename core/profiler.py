@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import json
+
+from array import array
+from collections import Counter
+
+from .instructions import MacroCall
+from .vm import Bytecode
+from .idioms import LoopIdiom
+
+class ExecutionProfile(object):
+    """Execution counts of a run, by expanded instruction.
+
+    It is passed to the bytecode as a trace and counts each executed
+    instruction and each jump backwards, which closes a loop. Fused loops
+    count once but take many steps, so their extra steps are counted
+    apart. The counts are attributed back to the macro calls each
+    instruction was expanded from."""
+    sample = 1
+
+    def __init__(self, program):
+        self.program = program
+        self.counts = array("q", bytes(8*(len(program.instrs)+1)))
+        self.extra = Counter()
+        self.edges = Counter()
+        self.result = None
+
+    def get_bytecode(self):
+        """Bytecode of the program whose fused loops report their steps"""
+        bytecode = Bytecode(self.program.get_allocation().instrs,
+                            self.program.labels)
+        pcs = [i for i, inst in enumerate(self.program.instrs)
+               if (isinstance(inst, LoopIdiom))]
+        bytecode.idioms = [self._count_idiom(pc, f)
+                           for pc, f in zip(pcs, bytecode.idioms)]
+        return bytecode
+
+    def _count_idiom(self, pc, function):
+        def idiom(numbs, words, budget):
+            steps = function(numbs, words, budget)
+            self.extra[pc] += steps-1
+            return steps
+        return idiom
+
+    def __call__(self, pc, i):
+        self.counts[pc] += 1
+        if (i <= pc):
+            self.edges[(pc, i)] += 1
+
+    def steps(self, pc):
+        return self.counts[pc]+self.extra[pc]
+
+    def get_stack(self, pc):
+        """Macro calls of an instruction, the call itself included for
+        optimized macros"""
+        inst = self.program.instrs[pc]
+        stack = list(inst.origin)
+        if (isinstance(inst, MacroCall)):
+            stack.append((inst.macro.inst, inst.macro.template))
+        return stack
+
+    def get_report(self, back_edges=10):
+        """Dict with the steps of each instruction, macro template and call
+        chain and the hottest back edges"""
+        instrs = []
+        templates = {}
+        calls = Counter()
+        total = 0
+        for pc, inst in enumerate(self.program.instrs):
+            steps = self.steps(pc)
+            if (not steps):
+                continue
+            total += steps
+            stack = self.get_stack(pc)
+            instrs.append({
+                "index": pc,
+                "instruction": str(inst),
+                "count": self.counts[pc],
+                "steps": steps,
+                "origin": [x for x, _ in stack],
+            })
+            seen = set()
+            for depth, (call, template) in enumerate(stack):
+                entry = templates.setdefault(template, {
+                    "template": template.name,
+                    "optimized": template.optimized,
+                    "steps": 0,
+                    "self_steps": 0,
+                })
+                if (template not in seen):
+                    entry["steps"] += steps
+                    seen.add(template)
+                if (depth == len(stack)-1):
+                    entry["self_steps"] += steps
+                calls[tuple(x for x, _ in stack[:depth+1])] += steps
+        instrs.sort(key=lambda x: -x["steps"])
+
+        edges = []
+        for (pc, target), count in self.edges.most_common(back_edges):
+            edges.append({
+                "from": pc,
+                "to": target,
+                "count": count,
+                "instruction": str(self.program.instrs[pc]),
+                "target": str(self.program.instrs[target])
+                          if target < len(self.program.instrs) else None,
+                "origin": [x for x, _ in self.get_stack(target)]
+                          if target < len(self.program.instrs) else [],
+            })
+        return {
+            "steps": total,
+            "instructions": instrs,
+            "macros": sorted(templates.values(), key=lambda x: -x["steps"]),
+            "calls": [{"stack": list(k), "steps": v}
+                      for k, v in calls.most_common()],
+            "back_edges": edges,
+        }
+
+    def get_json(self, back_edges=10):
+        return json.dumps(self.get_report(back_edges), indent=2)
+
+    def get_collapsed(self):
+        """Steps in the collapsed stack format read by flame graph tools,
+        one line per instruction: the program, the macro calls and the
+        instruction separated by ``;`` and then the steps"""
+        lines = []
+        for pc, inst in enumerate(self.program.instrs):
+            steps = self.steps(pc)
+            if (not steps):
+                continue
+            frames = ["program"]
+            frames += [f"[{x}]" for x, _ in self.get_stack(pc)]
+            frames.append(f"{pc}: {inst}")
+            lines.append(";".join(x.replace(";", ",") for x in frames)+
+                         f" {steps}")
+        return "\n".join(lines)+"\n"
\ No newline at end of file
@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
+import os
 import re
+import sys
+import time
+import hashlib
 import logging
 
 from collections import defaultdict
@@ -9,43 +13,106 @@ from .instructions import *
 from .utils import *
 from .macros import *
 from .parser import VonNeumannParser
+from .tokenizer import VonNeumannTokenizer, Include
+from .vm import Bytecode
+from .codegen import ProgramCompiler
+from .idioms import LoopIdiom, fuse_loops
+from .trace import StepTrace
+from .recorder import RunRecorder
+from .profiler import ExecutionProfile
+from .regalloc import RegisterAllocation
+from .passes import PassManager
+from .subroutines import lower_subroutines
+from .verify import MacroVerifier
+from .library import load_library, resolve_include
 
 class VonNeumannProgram(object):
-    def __init__(self, program, settings):
+    result_cache = None
+
+    def __init__(self, program, settings, base=None):
+        """``base`` is the directory the included libraries are relative
+        to, by default the one of the program's file or the current one"""
         self.settings = settings
         self.program = program
 
-        macro_re = fr"(?:{VonNeumannMacroTemplate.get_macro_re()})[ \n\t]*"
-        self.code = re.split(
-            macro_re,
-            self.program,
-            flags=re.MULTILINE | re.DOTALL)[-1]
-        self.code = clean_program(self.code)
-
-        macro_match = re.finditer(
-            VonNeumannMacroTemplate.get_macro_re(),
-            self.program,
-            re.MULTILINE | re.DOTALL)
+        start = time.perf_counter()
+        tokens = VonNeumannTokenizer(self.program, self.settings.alph)
 
+        if (base is None):
+            base = os.path.dirname(os.path.abspath(
+                getattr(self.program, "name", "") or ""))
         self.macro_state = MacroState()
-        for i in macro_match:
-            self.macro_state.register_macro(
-                VonNeumannMacroTemplate(i.group(),
-                                        self.settings,
-                                        self.macro_state)
-            )
-
-        self.parser = VonNeumannParser(self.code,
+        libraries = []
+        for macro in tokens.macros():
+            try:
+                if (isinstance(macro, Include)):
+                    library = load_library(resolve_include(macro.path, base),
+                                           self.settings)
+                    library.register(self.macro_state)
+                    libraries.append(library)
+                    continue
+                template = VonNeumannMacroTemplate(macro,
+                                                   self.settings,
+                                                   self.macro_state)
+            except SyntaxError as e:
+                line, col = tokens.macro_loc
+                raise SyntaxError(
+                    f"On line {line}, column {col}: {e.msg}") from None
+            self.macro_state.register_macro(template)
+        if (self.settings.safe_macros and self.settings.optim >= 1):
+            self.macro_state.verifier = MacroVerifier(self.macro_state.macros,
+                                                      self.settings)
+
+        self.parser = VonNeumannParser(tokens,
                                        self.settings,
                                        self.macro_state)
 
-        self.instrs = [x[1] for x in self.parser.instrs]
+        expanded = self.parser.instrs
+        lowering = time.perf_counter()
+        if (self.settings.inline_limit is not None):
+            expanded = lower_subroutines(expanded, self.macro_state,
+                                         self.settings)
+
+        parsed = time.perf_counter()
+
+        if (self.settings.optim >= 1):
+            expanded = fuse_loops(expanded, self.macro_state)
+        if (self.settings.optim >= 2):
+            expanded = PassManager().run(expanded)
+        self.set_expanded(expanded)
+        # Seconds spent reading the macros and the program, expanding the
+        # macros and optimizing the expanded program
+        expand = self.parser.timings["expand"]+parsed-lowering
+        self.timings = {"parse": parsed-start-expand,
+                        "expand": expand,
+                        "optimize": time.perf_counter()-parsed}
+        # Keep the bodies of the libraries parsed by this program
+        for library in libraries:
+            library.save()
+        if (logging.getLogger().isEnabledFor(logging.INFO)):
+            logging.info(
+                f"Expanded Program :\n{self.get_expanded_program()}")
+
+    @classmethod
+    def from_expanded(cls, program, settings, macro_state, expanded):
+        """Creates the program from an already expanded list of
+        ``(label, instruction)``, skipping parsing and macro expansion"""
+        prog = cls.__new__(cls)
+        prog.settings = settings
+        prog.program = program
+        prog.macro_state = macro_state
+        prog.timings = {}
+        prog.set_expanded(expanded)
+        return prog
+
+    def set_expanded(self, expanded):
+        self.expanded = expanded
+        self.instrs = [x[1] for x in self.expanded]
         self.labels = {}
-        for i,l in enumerate(self.parser.instrs):
+        for i,l in enumerate(self.expanded):
             label = int(l[0]) if l[0] is not None else None
             if (label is not None) and (label not in self.labels):
                 self.labels[label] = i
-        logging.info(f"Expanded Program :\n{self.parser.get_program_str()}")
 
     def get_regex(self):
         if (hasattr(self,"_regex")):
@@ -55,9 +122,9 @@ class VonNeumannProgram(object):
         logging.debug(f"Language Regex={self._regex}")
         return r
 
-    def __call__(self, numbs, words, ret, max_steps=None):
+    def __call__(self, numbs, words, ret, max_steps=None, trace=None):
         logging.debug(f"Called => prog({numbs}, {words}, {ret})")
-        return self.run(numbs, words, ret, max_steps)
+        return self.run(numbs, words, ret, max_steps, trace)
 
     def _str_state(self, i, l, numbs, words):
         if (not hasattr(self,"n_inst")):
@@ -68,36 +135,169 @@ class VonNeumannProgram(object):
         form = form+(f"\twords={dict(words.items())}" if words else "")
         return form
 
-    def run(self, ns, ws, ret, max_steps):
+    def get_allocation(self):
+        """Dense registers the vm and compiled backends run on"""
+        if (hasattr(self, "_allocation")):
+            return self._allocation
+        self._allocation = RegisterAllocation(self.expanded, self.labels)
+        return self._allocation
+
+    def get_bytecode(self):
+        if (hasattr(self, "_bytecode")):
+            return self._bytecode
+        self._bytecode = Bytecode(self.get_allocation().instrs, self.labels)
+        return self._bytecode
+
+    @staticmethod
+    def _init_state(ns, ws):
         numbs = defaultdict(lambda: 0)
         words = defaultdict(lambda: "")
-        i=0
         # Initialize num state
         for i, n in enumerate(ns):
             numbs[i] = n
         # Initialize word state
         for i, w in enumerate(ws):
             words[i] = w
-        # Main execution loop
+        return numbs, words
+
+    def run(self, ns, ws, ret, max_steps, trace=None):
+        """Runs the program with the given arguments. ``trace`` is a
+        StepTrace or a RunRecorder that records the steps, with INFO
+        logging a StepTrace is created and its steps are logged when the
+        run ends. Traced runs on the compiled backend run on the vm. Runs
+        without a given trace use the result cache, if the program has
+        one."""
+        key = None
+        if (self.result_cache is not None and trace is None):
+            key = self.result_cache.make_key(self, ns, ws, ret)
+            hit = self.result_cache.get(key)
+            if (hit is not None):
+                result, steps = hit
+                if (max_steps is not None and steps > max_steps):
+                    raise RuntimeError("Max ammount of steps reached")
+                logging.info(f"Result taken from the cache ({steps} steps)")
+                return result
+        log = logging.getLogger().isEnabledFor(logging.INFO)
+        if (trace is None and log and self.settings.backend != "compiled"):
+            trace = StepTrace(self)
+
+        if (self.settings.backend == "object"):
+            numbs, words = self._init_state(ns, ws)
+            maps = None
+        else:
+            alloc = self.get_allocation()
+            numbs, words = alloc.load(ns, ws)
+            maps = (alloc.numb_map, alloc.word_map)
+        if (trace is not None):
+            trace.start(numbs, words, maps)
+        try:
+            if (self.settings.backend == "object"):
+                steps = self.run_objects(numbs, words, max_steps, trace)
+            elif (self.settings.backend == "compiled" and trace is None):
+                steps = self.run_compiled(numbs, words, max_steps)
+            else:
+                steps = self.run_bytecode(numbs, words, max_steps, trace)
+        finally:
+            if (log and hasattr(trace, "lines")):
+                for line in trace.lines():
+                    logging.info(line)
+        # Once finished return what was asked
+        if (maps is not None):
+            result = alloc.get(numbs, words, ret)
+        elif (ret == 'n'):
+            result = numbs[0]
+        elif (ret == 'w'):
+            result = words[0]
+        else:
+            result = None
+        if (key is not None):
+            self.result_cache.put(key, result, steps)
+        return result
+
+    def get_fingerprint(self):
+        """Hash of the expanded program and of the optimized code of the
+        macros it calls"""
+        if (hasattr(self, "_fingerprint")):
+            return self._fingerprint
+        h = hashlib.sha256()
+        h.update(f"{self.settings.alph}\0{self.settings.optim}\0".encode())
+        h.update(self.get_expanded_program().encode())
+        for inst in self.instrs:
+            if (isinstance(inst, MacroCall)):
+                h.update(b"\0")
+                h.update(inst.macro.template.source.encode())
+                h.update(repr(inst.macro.var_map).encode())
+        self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def profile(self, ns, ws, ret, max_steps=None):
+        """Runs the program on the bytecode counting the steps of each
+        instruction, whatever the backend. Returns an ExecutionProfile with
+        the return value on ``result``."""
+        alloc = self.get_allocation()
+        numbs, words = alloc.load(ns, ws)
+        profile = ExecutionProfile(self)
+        profile.get_bytecode().execute(numbs, words, max_steps, profile)
+        profile.result = alloc.get(numbs, words, ret)
+        return profile
+
+    def record(self, ns, ws, ret, max_steps=None, every=1024,
+               budget=64 << 20):
+        """Runs the program keeping a RunRecorder of its steps, see
+        RunRecorder. Returns the recorder with the return value on
+        ``result`` or, if the run failed, the exception on ``error``."""
+        recorder = RunRecorder(self, every, budget)
+        try:
+            recorder.result = self.run(ns, ws, ret, max_steps, recorder)
+        except Exception as e:
+            recorder.error = e
+        return recorder
+
+    def run_objects(self, numbs, words, max_steps, trace=None):
+        """Reference interpreter, calls every instruction object in turn"""
+        left = sample = getattr(trace, "sample", 1)
         i = 0
         s = 0
         while i<len(self.instrs):
+            if max_steps is not None and s>=max_steps:
+                raise RuntimeError("Max ammount of steps reached")
+            s+=1
             # Exec instruction
-            l, numbs, words = self.instrs[i](numbs, words)
-            logging.info(self._str_state(i, l, numbs, words))
+            inst = self.instrs[i]
+            if (isinstance(inst, LoopIdiom)):
+                budget = sys.maxsize if max_steps is None else max_steps-s+1
+                s += inst.run(numbs, words, budget)-1
+                l = inst.args[0]
+            else:
+                l, numbs, words = inst(numbs, words)
+            pc = i
             # Jump to a label or to the next instruction
             if (l is not None):
                 i = self.labels[l]
             else:
                 i += 1
-            if max_steps is not None and max_steps>=s:
-                raise RuntimeError("Max ammount of steps reached")
-            s+=1
-        # Once finished return what was asked
-        if (ret == 'n'):
-            return numbs[0]
-        elif (ret == 'w'):
-            return words[0]
+            if (trace is not None):
+                left -= 1
+                if (left == 0):
+                    left = sample
+                    trace(pc, i)
+        return s
+
+    def run_bytecode(self, numbs, words, max_steps, trace=None):
+        """Runs the bytecode over a register file made by the allocation"""
+        return self.get_bytecode().execute(numbs, words, max_steps, trace)
+
+    def get_compiled(self):
+        if (hasattr(self, "_compiled")):
+            return self._compiled
+        self._compiled = ProgramCompiler(self.get_allocation().instrs,
+                                         self.labels).compile()
+        return self._compiled
+
+    def run_compiled(self, numbs, words, max_steps):
+        if (logging.getLogger().isEnabledFor(logging.INFO)):
+            logging.info("The compiled backend does not trace the steps")
+        return self.get_compiled()(numbs, words, max_steps)
 
     def get_expanded_program(self):
-        return self.parser.get_program_str()
\ No newline at end of file
+        return program_str(self.expanded)
\ No newline at end of file
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import re
+import sys
+
+from array import array
+from bisect import bisect_right
+
+from .utils import VAR_TP_INDX
+from .instructions import MacroCall
+from .idioms import LoopIdiom
+from .regalloc import uses_defs
+from .trace import MAX_VALUE, jump_label
+
+# Approximate bytes taken by each step, each change and each register of
+# a snapshot
+STEP_BYTES = 24
+CHANGE_BYTES = 17
+ENTRY_BYTES = 64
+
+class RunRecorder(object):
+    """Record of a whole run that can be queried at any step.
+
+    It is passed to a backend as a trace. Every ``every`` steps it keeps a
+    snapshot of the registers of the program and, for each step, the
+    instruction it ran, the next one and the registers it wrote with their
+    new value. The state at a step is the closest snapshot before it with
+    the changes of the steps in between replayed. A macro or a fused loop
+    takes a single step and only records the registers it changed.
+
+    ``budget`` bounds the bytes taken by the record, roughly. When it is
+    exceeded and the snapshots take a good part of it every other
+    snapshot of the older half is dropped, otherwise the steps before the
+    second snapshot are forgotten. Steps are counted from 0, the state
+    before running, and queries about forgotten steps fail with
+    ValueError."""
+    sample = 1
+
+    def __init__(self, program, every=1024, budget=64 << 20):
+        if (every < 1 or budget < 1):
+            raise ValueError("The snapshot interval and the budget must be"
+                             " positive")
+        self.program = program
+        self.every = every
+        self.budget = budget
+        self.writes = {}
+        self.result = None
+        self.error = None
+        self.start({}, {})
+
+    def start(self, numbs, words, maps=None):
+        """Binds the recorder to the state of a new run, as
+        StepTrace.start"""
+        self.numbs = numbs
+        self.words = words
+        self.maps = maps
+        if (maps is None):
+            current = (dict(numbs), dict(words))
+        else:
+            current = tuple({r: state[i] for r, i in m.items() if state[i]}
+                            for m, state in zip(maps, (numbs, words)))
+        # Values of the registers after the last step
+        self.current = current
+        self.count = 0
+        # First step still recorded
+        self.horizon = 0
+        # Executed and next instruction, and end of the changes of each
+        # step after the horizon
+        self.pcs = array("q")
+        self.nexts = array("q")
+        self.ends = array("q")
+        # Changes, numbered from ``first`` on
+        self.first = 0
+        self.kinds = array("B")
+        self.regs = array("q")
+        self.values = array("q")
+        self.objects = {}
+        self.object_bytes = 0
+        self.snapshots = []
+        self.snapshot_steps = []
+        self.snapshot_bytes = 0
+        self._snapshot(0)
+
+    def __len__(self):
+        return self.count
+
+    def _writes(self, pc):
+        # Registers written by an instruction and whether it can leave
+        # them as they were
+        if (pc not in self.writes):
+            inst = self.program.instrs[pc]
+            self.writes[pc] = (isinstance(inst, (MacroCall, LoopIdiom)),
+                               uses_defs(inst)[1])
+        return self.writes[pc]
+
+    def __call__(self, pc, i):
+        wide, writes = self._writes(pc)
+        for kind, reg in writes:
+            indx = reg if self.maps is None else self.maps[kind][reg]
+            value = (self.numbs, self.words)[kind][indx]
+            current = self.current[kind]
+            if (wide and current.get(reg, "" if kind else 0) == value):
+                continue
+            current[reg] = value
+            n = self.first+len(self.kinds)
+            self.kinds.append(kind)
+            self.regs.append(reg)
+            if (kind == 0 and value <= MAX_VALUE):
+                self.values.append(value)
+            else:
+                self.values.append(0)
+                self.objects[n] = value
+                self.object_bytes += sys.getsizeof(value)+ENTRY_BYTES
+        self.pcs.append(pc)
+        self.nexts.append(i)
+        self.ends.append(self.first+len(self.kinds))
+        self.count += 1
+        if (self.count % self.every == 0):
+            self._snapshot(i)
+            self._enforce()
+
+    def _snapshot(self, pc):
+        numbs, words = (dict(x) for x in self.current)
+        size = (ENTRY_BYTES*(len(numbs)+len(words)) +
+                sum(sys.getsizeof(x) for x in words.values()))
+        self.snapshots.append((pc, numbs, words, size))
+        self.snapshot_steps.append(self.count)
+        self.snapshot_bytes += size
+
+    def get_size(self):
+        """Approximate bytes taken by the record"""
+        return (STEP_BYTES*len(self.pcs)+CHANGE_BYTES*len(self.kinds) +
+                self.object_bytes+self.snapshot_bytes)
+
+    def _enforce(self):
+        while (self.get_size() > self.budget and len(self.snapshots) > 1):
+            if (len(self.snapshots) >= 4 and
+                    4*self.snapshot_bytes > self.get_size()):
+                self._thin()
+            else:
+                self._forget()
+
+    def _thin(self):
+        # Every other snapshot between the first one and the newer half
+        old = range(1, len(self.snapshots)//2, 2)
+        for k in reversed(old):
+            self.snapshot_bytes -= self.snapshots[k][3]
+            del self.snapshots[k]
+            del self.snapshot_steps[k]
+
+    def _forget(self):
+        # Drops the steps before the second snapshot
+        horizon = self.snapshot_steps[1]
+        n = horizon-self.horizon
+        first = self.ends[n-1]
+        del self.pcs[:n]
+        del self.nexts[:n]
+        del self.ends[:n]
+        m = first-self.first
+        del self.kinds[:m]
+        del self.regs[:m]
+        del self.values[:m]
+        self.objects = {k: v for k, v in self.objects.items() if k >= first}
+        self.object_bytes = sum(sys.getsizeof(x)+ENTRY_BYTES
+                                for x in self.objects.values())
+        self.first = first
+        self.horizon = horizon
+        self.snapshot_bytes -= self.snapshots[0][3]
+        del self.snapshots[0]
+        del self.snapshot_steps[0]
+
+    @staticmethod
+    def _register(name):
+        m = re.fullmatch(r"([NP])([0-9]+)", name)
+        if (m is None):
+            raise ValueError(f"Invalid register {name}")
+        return VAR_TP_INDX[m.group(1)], int(m.group(2))
+
+    def _check(self, step):
+        if (not self.horizon <= step <= self.count):
+            raise ValueError(f"Step {step} is not recorded, only steps"
+                             f" {self.horizon} to {self.count} are")
+
+    def _end(self, step):
+        # Index of the first change after the step
+        if (step == self.horizon):
+            return self.first
+        return self.ends[step-self.horizon-1]
+
+    def _change(self, n):
+        k = n-self.first
+        if (n in self.objects):
+            value = self.objects[n]
+        else:
+            value = self.values[k]
+        return self.kinds[k], self.regs[k], value
+
+    def _step_of(self, n):
+        # Step that made the change ``n``
+        return self.horizon+bisect_right(self.ends, n)+1
+
+    def state(self, step):
+        """State after ``step`` steps, as the index of the next instruction
+        and the numbers and words of the registers set until then"""
+        self._check(step)
+        k = bisect_right(self.snapshot_steps, step)-1
+        pc, numbs, words, _ = self.snapshots[k]
+        state = (dict(numbs), dict(words))
+        for n in range(self._end(self.snapshot_steps[k]), self._end(step)):
+            kind, reg, value = self._change(n)
+            state[kind][reg] = value
+        if (step > self.snapshot_steps[k]):
+            pc = self.nexts[step-self.horizon-1]
+        return pc, state[0], state[1]
+
+    def executed(self, step):
+        """Index of the instruction run on ``step``"""
+        self._check(step)
+        if (step == self.horizon):
+            raise ValueError(f"Only the state after step {step} is recorded")
+        return self.pcs[step-self.horizon-1]
+
+    def last_write(self, name, step=None):
+        """Last step, up to ``step`` or the end, that wrote the register
+        ``name``, as ``N3`` or ``P0``. None when no recorded step did."""
+        kind, reg = self._register(name)
+        if (step is None):
+            step = self.count
+        self._check(step)
+        kinds = self.kinds
+        regs = self.regs
+        for n in range(self._end(step)-1, self.first-1, -1):
+            k = n-self.first
+            if (regs[k] == reg and kinds[k] == kind):
+                return self._step_of(n)
+        return None
+
+    def find(self, name, test, step=None):
+        """First step after ``step``, or the first one recorded, where the
+        register ``name`` changes to a value that passes ``test`` while
+        the one before didn't. None when it never does."""
+        kind, reg = self._register(name)
+        if (step is None):
+            step = self.horizon
+        state = self.state(step)[kind+1]
+        before = test(state.get(reg, "" if kind else 0))
+        kinds = self.kinds
+        regs = self.regs
+        for n in range(self._end(step), self.first+len(kinds)):
+            k = n-self.first
+            if (regs[k] == reg and kinds[k] == kind):
+                now = test(self._change(n)[2])
+                if (now and not before):
+                    return self._step_of(n)
+                before = now
+        return None
+
+    def first_empty(self, name, step=None):
+        """First step after ``step`` that left the word register ``name``
+        empty"""
+        if (not name.startswith("P")):
+            raise ValueError(f"{name} is not a word register")
+        return self.find(name, lambda x: x == "", step)
+
+    def line(self, step):
+        """Step as the reference interpreter logs it, with the whole
+        state"""
+        pc = self.executed(step)
+        i, numbs, words = self.state(step)
+        return self.program._str_state(pc, jump_label(self.program, pc, i),
+                                      numbs, words)
\ No newline at end of file
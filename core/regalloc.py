@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+import re
+import logging
+
+from .utils import VAR_MATCH, VAR_TP_INDX
+from .instructions import *
+from .idioms import LoopIdiom
+from .macros import VonNeumannMacro
+
+def _bits(x):
+    while x:
+        low = x & -x
+        yield low.bit_length()-1
+        x ^= low
+
+def program_registers(instrs):
+    """Registers written on the program itself, outside the macros, and on
+    the arguments of its macro calls. Returns the numbers and the words."""
+    regs = (set(), set())
+    for l, inst in instrs:
+        if (inst.origin):
+            for m in re.finditer(VAR_MATCH, inst.origin[0][0]):
+                tp = VAR_TP_INDX[m.group(1)]
+                if (tp < 2):
+                    regs[tp].add(int(m.group(2)))
+        elif (isinstance(inst, MacroCall)):
+            for tp in range(2):
+                regs[tp].update(inst.macro.var_map[tp].values())
+        else:
+            used = inst.get_used_vars()
+            regs[0].update(used[0])
+            regs[1].update(used[1])
+    return regs
+
+def uses_defs(inst):
+    """Registers read, registers written and registers surely overwritten
+    by an instruction, as lists of (type, index) pairs"""
+    tp = type(inst)
+    if (tp in (Suc, Pred)):
+        r = [(0, inst.args[0])]
+        return r, r, []
+    elif (tp is AssignNumber):
+        return [(0, inst.args[1])], [(0, inst.args[0])], [(0, inst.args[0])]
+    elif (tp is AssignZero):
+        r = [(0, inst.args[0])]
+        return [], r, r
+    elif (tp in (Append, Tail)):
+        r = [(1, inst.args[0])]
+        return r, r, []
+    elif (tp is AssignWord):
+        return [(1, inst.args[1])], [(1, inst.args[0])], [(1, inst.args[0])]
+    elif (tp is AssignEpsilon):
+        r = [(1, inst.args[0])]
+        return [], r, r
+    elif (tp is Ifneq0):
+        return [(0, inst.args[0])], [], []
+    elif (tp is Ifbeg):
+        return [(1, inst.args[0])], [], []
+    elif (tp is MacroCall or tp is LoopIdiom):
+        # Anything can be read or written
+        used = inst.get_used_vars()
+        r = [(0, x) for x in used[0]]+[(1, x) for x in used[1]]
+        return r, r, []
+    return [], [], []
+
+def successors(i, inst, labels, size):
+    """Indexes of the instructions that can run after the one at ``i``,
+    ``size`` when the program can end there. Jumps to undefined labels
+    have none"""
+    succs = []
+    if (isinstance(inst, (Goto, LoopIdiom))):
+        targets = [inst.args[-1]]
+    elif (isinstance(inst, (Ifneq0, Ifbeg))):
+        succs.append(i+1)
+        targets = [inst.args[-1]]
+    elif (isinstance(inst, MacroCall)):
+        succs.append(i+1)
+        targets = inst.macro.var_map[2].values()
+    else:
+        succs.append(i+1)
+        targets = []
+    succs += [labels[l] for l in targets if l in labels]
+    return [x for x in succs if x <= size]
+
+def liveness(gen, kill, succs, exit=0, pure=None):
+    """Bitsets of the registers live after each instruction, given the
+    bitsets each one reads and overwrites and its successors. ``exit`` are
+    the registers read when the program ends. ``pure`` are the registers
+    written by the instructions whose only effect is writing them, their
+    reads only count when one of those is live, or 0 for the rest."""
+    size = len(succs)
+    preds = [[] for _ in range(size+1)]
+    for i, ss in enumerate(succs):
+        for j in ss:
+            preds[j].append(i)
+
+    live_in = [0]*size+[exit]
+    live_out = [0]*size
+    work = list(range(size))
+    queued = [True]*size
+    while work:
+        i = work.pop()
+        queued[i] = False
+        out = 0
+        for j in succs[i]:
+            out |= live_in[j]
+        live_out[i] = out
+        if (pure is not None and pure[i] and not pure[i] & out):
+            new = out & ~kill[i]
+        else:
+            new = gen[i] | (out & ~kill[i])
+        if (new != live_in[i]):
+            live_in[i] = new
+            for j in preds[i]:
+                if (not queued[j]):
+                    queued[j] = True
+                    work.append(j)
+    return live_out
+
+class RegisterAllocation(object):
+    """Dense numbering of the registers of an expanded program.
+
+    Registers of the program itself keep one register each, they are the
+    inputs and outputs. The auxiliary registers of the macros are given
+    the registers left after them, and two auxiliary registers share one
+    when they are never live at the same time, as told by a liveness
+    analysis over the instructions. ``instrs`` is the program over the new
+    registers and ``numb_map`` and ``word_map`` go from the old registers
+    to the new ones. ``load`` builds the register file, two lists."""
+
+    def __init__(self, instrs, labels):
+        self.labels = labels
+        pinned = program_registers(instrs)
+        # The return values, even when the program doesn't use them
+        pinned[0].add(0)
+        pinned[1].add(0)
+        self.numb_map = {r: i for i, r in enumerate(sorted(pinned[0]))}
+        self.word_map = {r: i for i, r in enumerate(sorted(pinned[1]))}
+        self._allocate([x[1] for x in instrs], pinned)
+        self.instrs = [self.renumber(x[1]) for x in instrs]
+        self.numb_size = max(self.numb_map.values(), default=-1)+1
+        self.word_size = max(self.word_map.values(), default=-1)+1
+
+    def _allocate(self, instrs, pinned):
+        # Bit of each auxiliary register on the liveness sets
+        bit = {}
+        order = []
+        gen, kill, defs = [], [], []
+        for inst in instrs:
+            uses, writes, kills = uses_defs(inst)
+            masks = []
+            for regs in (uses, writes, kills):
+                mask = 0
+                for reg in regs:
+                    if (reg[1] in pinned[reg[0]]):
+                        continue
+                    if (reg not in bit):
+                        bit[reg] = len(order)
+                        order.append(reg)
+                    mask |= 1 << bit[reg]
+                masks.append(mask)
+            gen.append(masks[0])
+            defs.append(masks[1])
+            kill.append(masks[2])
+
+        size = len(instrs)
+        succs = [successors(i, x, self.labels, size)
+                 for i, x in enumerate(instrs)]
+        live_out = liveness(gen, kill, succs)
+
+        # A register written while another one is live can't share its
+        # register with it
+        adj = [0]*len(order)
+        for i in range(size):
+            if (not defs[i]):
+                continue
+            written = defs[i]
+            live = live_out[i] | written
+            for b in _bits(written):
+                adj[b] |= live & ~(1 << b)
+        for b in range(len(order)):
+            for n in _bits(adj[b]):
+                adj[n] |= 1 << b
+
+        color = {}
+        maps = (self.numb_map, self.word_map)
+        start = [len(self.numb_map), len(self.word_map)]
+        for b, (tp, reg) in enumerate(order):
+            taken = {color[n] for n in _bits(adj[b])
+                     if n in color and order[n][0] == tp}
+            c = start[tp]
+            while c in taken:
+                c += 1
+            color[b] = c
+            maps[tp][reg] = c
+        logging.debug(
+            f"Allocated {len(order)} auxiliary registers on "
+            f"{len(set(self.numb_map.values()))} numbers and "
+            f"{len(set(self.word_map.values()))} words")
+
+    def renumber(self, inst):
+        if (isinstance(inst, LoopIdiom)):
+            return inst.renumber(self.numb_map, self.word_map)
+        if (isinstance(inst, MacroCall)):
+            macro = inst.macro
+            var_map = [{k: self.numb_map[v]
+                        for k, v in macro.var_map[0].items()},
+                       {k: self.word_map[v]
+                        for k, v in macro.var_map[1].items()},
+                       macro.var_map[2]]
+            new = MacroCall.from_macro(
+                VonNeumannMacro.from_var_map(macro.inst, macro.template,
+                                             var_map),
+                inst.alph)
+        else:
+            maps = {"N": self.numb_map, "P": self.word_map}
+            args = [maps[k][a] if k in maps else a
+                    for k, a in zip(inst.argKinds, inst.args)]
+            new = type(inst).build(args, inst.alph)
+        new.origin = inst.origin
+        return new
+
+    def load(self, ns, ws):
+        """Register file with the given inputs"""
+        numbs = [0]*self.numb_size
+        words = [""]*self.word_size
+        for i, n in enumerate(ns):
+            if (i in self.numb_map):
+                numbs[self.numb_map[i]] = n
+        for i, w in enumerate(ws):
+            if (i in self.word_map):
+                words[self.word_map[i]] = w
+        return numbs, words
+
+    def get(self, numbs, words, ret):
+        """Value asked by ``ret`` from the register file"""
+        if (ret == 'n'):
+            return numbs[self.numb_map[0]]
+        elif (ret == 'w'):
+            return words[self.word_map[0]]
\ No newline at end of file
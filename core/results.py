@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import sys
+import json
+import sqlite3
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+class ResultCache(object):
+    """Results of finished runs, keyed by the program and its inputs.
+
+    Programs are deterministic, so a run with the same inputs returns the
+    same result after the same amount of steps. Results are kept on a LRU
+    of at most ``max_bytes``, measured on the size of the results so a few
+    long words can't take it all, and, when ``path`` is given, on a sqlite
+    database that processes can share. The steps are stored with each
+    result, so a run that would stop on ``max_steps`` still does. Runs that
+    fail are never stored."""
+
+    def __init__(self, path=None, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.path = path
+        self.db = None
+        if (path):
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                            "key TEXT PRIMARY KEY, result TEXT, steps INTEGER)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(program, ns, ws, ret):
+        # Trailing zeros and empty words are the same as not passing them
+        ns = list(ns)
+        ws = list(ws)
+        while (ns and ns[-1] == 0):
+            ns.pop()
+        while (ws and ws[-1] == ""):
+            ws.pop()
+        data = json.dumps([program.get_fingerprint(), ns, ws, ret])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def _sizeof(key, result):
+        return sys.getsizeof(key)+sys.getsizeof(result)
+
+    def get(self, key):
+        """Returns ``(result, steps)`` or None"""
+        entry = self.entries.get(key)
+        if (entry is not None):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        if (self.db is not None):
+            row = self.db.execute(
+                "SELECT result, steps FROM results WHERE key = ?",
+                (key,)).fetchone()
+            if (row is not None):
+                entry = (json.loads(row[0]), row[1])
+                self._remember(key, entry)
+                self.disk_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def put(self, key, result, steps):
+        entry = (result, steps)
+        self._remember(key, entry)
+        if (self.db is not None):
+            try:
+                with self.db:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                        (key, json.dumps(result), steps))
+            except sqlite3.Error as e:
+                logging.debug(f"Could not store result: {e}")
+
+    def _remember(self, key, entry):
+        size = self._sizeof(key, entry[0])
+        if (size > self.max_bytes):
+            return
+        if (key in self.entries):
+            self.size -= self._sizeof(key, self.entries.pop(key)[0])
+        self.entries[key] = entry
+        self.size += size
+        while (self.size > self.max_bytes):
+            old, (result, _) = self.entries.popitem(last=False)
+            self.size -= self._sizeof(old, result)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+    def close(self):
+        if (self.db is not None):
+            self.db.close()
+            self.db = None
\ No newline at end of file
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+from .batch import RunTimeout
+
+class ProgramTask(object):
+    """A run of a program that can be stopped and resumed.
+
+    It runs over the bytecode of the program, whatever its backend, and
+    ``advance`` runs it for a given amount of steps. ``elapsed`` are the
+    seconds spent running it, the run fails with RunTimeout when they go
+    over ``timeout``. The greater the ``priority``, the more steps it gets
+    from the Scheduler."""
+
+    def __init__(self, program, ns, ws, ret, max_steps=None, timeout=None,
+                 priority=1):
+        if (priority <= 0):
+            raise ValueError("The priority must be positive")
+        self.program = program
+        self.ret = ret
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.priority = priority
+        self.numbs, self.words = program.get_allocation().load(ns, ws)
+        self.pc = 0
+        self.steps = 0
+        self.elapsed = 0
+        self.done = False
+        self.future = None
+
+    def advance(self, steps):
+        """Runs about ``steps`` more steps. Returns whether the program
+        ended"""
+        bytecode = self.program.get_bytecode()
+        start = time.perf_counter()
+        try:
+            self.pc, self.steps = bytecode.resume(self.numbs, self.words,
+                                                  self.pc, self.steps,
+                                                  self.max_steps,
+                                                  self.steps+steps)
+        finally:
+            self.elapsed += time.perf_counter()-start
+        self.done = self.pc == len(bytecode)
+        if (not self.done and self.timeout is not None and
+                self.elapsed > self.timeout):
+            raise RunTimeout(f"Timeout after {self.timeout} seconds")
+        return self.done
+
+    def result(self):
+        return self.program.get_allocation().get(self.numbs, self.words,
+                                                 self.ret)
+
+class Scheduler(object):
+    """Runs many programs at once on an asyncio event loop.
+
+    Each run is a ProgramTask that runs in slices of ``quantum`` steps, and
+    the event loop gets control back after every slice, so a long run
+    doesn't block the rest of the runs nor the other coroutines. The next
+    slice goes to the task that ran the least steps relative to its
+    priority, a task with priority 2 gets twice the steps of one with
+    priority 1. ``submit`` returns a future with the result of the run,
+    cancelling it stops the run."""
+    quantum = 10000
+
+    def __init__(self, quantum=None):
+        if (quantum is not None):
+            self.quantum = quantum
+        # Tasks by the steps they ran over their priority
+        self.queue = []
+        self.clock = 0
+        self.counter = itertools.count()
+        self.runner = None
+
+    def __len__(self):
+        return sum(1 for x in self.queue if not x[2].future.done())
+
+    def submit(self, program, ns, ws, ret, max_steps=None, timeout=None,
+               priority=1):
+        """Starts a run of ``program`` and returns a future with its
+        result. Must be called from a coroutine."""
+        return self.add(ProgramTask(program, ns, ws, ret, max_steps,
+                                    timeout, priority))
+
+    def add(self, task):
+        """Starts running a ProgramTask and returns a future with its
+        result. Must be called from a coroutine."""
+        loop = asyncio.get_running_loop()
+        task.future = loop.create_future()
+        # New tasks start with the least steps of the queue, so they
+        # don't take over the ones that are running
+        heapq.heappush(self.queue, (self.clock, next(self.counter), task))
+        if (self.runner is None or self.runner.done()):
+            self.runner = loop.create_task(self._run())
+        return task.future
+
+    async def run(self, program, ns, ws, ret, max_steps=None, timeout=None,
+                  priority=1):
+        """Runs ``program`` and returns its result"""
+        return await self.submit(program, ns, ws, ret, max_steps, timeout,
+                                 priority)
+
+    async def _run(self):
+        while self.queue:
+            clock, _, task = heapq.heappop(self.queue)
+            if (task.future.done()):
+                # Cancelled
+                continue
+            self.clock = clock
+            steps = task.steps
+            try:
+                done = task.advance(self.quantum)
+            except Exception as e:
+                task.future.set_exception(e)
+            else:
+                if (done):
+                    logging.debug(f"Run finished after {task.steps} steps")
+                    task.future.set_result(task.result())
+                else:
+                    clock += max(task.steps-steps, 1)/task.priority
+                    heapq.heappush(self.queue,
+                                   (clock, next(self.counter), task))
+            await asyncio.sleep(0)
\ No newline at end of file
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import marshal
+import logging
+
+from collections import Counter
+
+from .instructions import *
+from .macros import VonNeumannMacro
+from .idioms import LoopIdiom, ClosedLoop
+
+def _dump_loop(loop):
+    return (loop.kind, loop.guard, loop.char, dict(loop.incs),
+            dict(loop.decs), dict(loop.tails), dict(loop.appends),
+            loop.per, loop.exit, loop.label, loop.target)
+
+def _load_loop(rec):
+    loop = ClosedLoop.__new__(ClosedLoop)
+    (loop.kind, loop.guard, loop.char, incs, decs, tails, loop.appends,
+     loop.per, loop.exit, loop.label, loop.target) = rec
+    loop.incs = Counter(incs)
+    loop.decs = Counter(decs)
+    loop.tails = Counter(tails)
+    return loop
+
+def dump_instrs(expanded, template_index):
+    """Marshallable records of a list of ``(label, instruction)``.
+    ``template_index`` gives the number of each template they refer to."""
+    instrs = []
+    for l, inst in expanded:
+        if (isinstance(inst, MacroCall)):
+            data = (template_index(inst.macro.template),
+                    inst.macro.inst,
+                    tuple(inst.macro.var_map))
+        elif (isinstance(inst, LoopIdiom)):
+            data = tuple(map(_dump_loop, inst.loops))
+        else:
+            data = tuple(inst.args)
+        origin = tuple((name, template_index(t)) for name, t in inst.origin)
+        instrs.append((l, type(inst).__name__, data, origin))
+    return instrs
+
+def load_instrs(records, templates, settings):
+    """Instructions dumped by ``dump_instrs``, with ``templates`` in the
+    order of their numbers"""
+    expanded = []
+    for l, name, args, origin in records:
+        if (name == "MacroCall"):
+            template = templates[args[0]]
+            macro = VonNeumannMacro.from_var_map(args[1], template, args[2])
+            inst = MacroCall.from_macro(macro, settings.alph)
+        elif (name == "LoopIdiom"):
+            inst = LoopIdiom(list(map(_load_loop, args)))
+        else:
+            inst = settings.instrs[name].build(args, settings.alph)
+        if (origin):
+            inst.origin = tuple((x, templates[t]) for x, t in origin)
+        expanded.append((l, inst))
+    return expanded
+
+def read_cache(path, key):
+    try:
+        with open(path, "rb") as f:
+            data = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if (not isinstance(data, dict) or data.get("key") != key):
+        logging.debug(f"Cache {path} is stale")
+        return None
+    return data
+
+def write_cache(path, data):
+    # Write to a temporary file first so readers never see half a cache
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            marshal.dump(data, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.debug(f"Could not write cache {path}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
\ No newline at end of file
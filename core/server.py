@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import hmac
+import time
+import asyncio
+import logging
+import secrets
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from . import instructions
+from .utils import LanguageSettings
+from .cache import program_key
+from .library import include_keys
+from .program import VonNeumannProgram
+from .scheduler import Scheduler, ProgramTask
+
+DEFAULT_ADDRESS = "unix:"+os.path.expanduser("~/.vonneu.sock")
+DEFAULT_TOKEN_FILE = os.path.expanduser("~/.vonneu.token")
+
+# Hosts a request over TCP can name on its Host and Origin headers
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    503: "Service Unavailable",
+}
+
+def parse_address(address):
+    """``("unix", path)`` for addresses starting with ``unix:`` or with a
+    ``/`` in them, otherwise ``("tcp", (host, port))`` for ``host:port``
+    or ``port``, on localhost by default"""
+    if (address.startswith("unix:")):
+        return "unix", address[5:]
+    if ("/" in address):
+        return "unix", address
+    host, _, port = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+class ProgramStore(object):
+    """Compiled programs kept in memory, keyed by the hash of their source
+    and settings, so each program is parsed and expanded once. At most
+    ``max_programs`` are kept, the least recently used are dropped
+    first."""
+
+    def __init__(self, max_programs=64):
+        self.max_programs = max_programs
+        self.programs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_time = 0
+
+    def key(self, source, settings, base=None):
+        """Key of the program. ``base`` is the directory of the program's
+        file, relative includes need it."""
+        return program_key(source, settings,
+                           include_keys(source, base, settings))
+
+    def lookup(self, key):
+        """The program kept under ``key``, None when it isn't"""
+        program = self.programs.get(key)
+        if (program is None):
+            self.misses += 1
+            return None
+        self.programs.move_to_end(key)
+        self.hits += 1
+        return program
+
+    def compile(self, source, settings, base=None):
+        """Compiles a program without keeping it"""
+        start = time.perf_counter()
+        program = VonNeumannProgram(source, settings, base)
+        # The bytecode is built once, before the first run
+        program.get_bytecode()
+        self.compile_time += time.perf_counter()-start
+        return program
+
+    def add(self, key, program):
+        """Keeps a compiled program under ``key``"""
+        self.programs[key] = program
+        while (len(self.programs) > self.max_programs):
+            self.programs.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, source, settings, base=None):
+        """Returns the key of the program and the program, compiled when it
+        isn't kept"""
+        key = self.key(source, settings, base)
+        program = self.lookup(key)
+        if (program is None):
+            program = self.compile(source, settings, base)
+            self.add(key, program)
+        return key, program
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.programs),
+            "max_entries": self.max_programs,
+            "compile_seconds": self.compile_time,
+        }
+
+class BadRequest(Exception):
+    pass
+
+class VonNeumannServer(object):
+    """Compiles and runs programs for clients over HTTP, on a local TCP
+    port or a Unix socket.
+
+    ``POST /run`` takes a JSON object with the ``source`` of the program,
+    its alphabet ``alpha``, the optimization level ``O``, the inputs ``ns``
+    and ``ws``, the return type ``ret`` and optionally ``base``, the
+    absolute directory of the program's file, ``inline_limit``,
+    ``safe_macros``, ``max_steps``, ``timeout`` and ``priority``. It
+    answers with the ``result`` and the ``steps`` of the run, or an
+    ``error``. ``GET /stats`` answers with
+    the statistics of the program store and the runs.
+
+    Compiled programs are kept on a ProgramStore, programs that miss it
+    are compiled on a thread so the other requests go on meanwhile, and
+    the runs share a Scheduler. At most ``max_runs`` run at once, up to
+    ``max_waiting`` more wait for their turn and the rest are turned down.
+
+    The Unix socket is only open to its owner. Over TCP, where any
+    process and any web page on the browser can reach the port, requests
+    must name a local ``Host``, come from no ``Origin`` or a local one,
+    send JSON and carry ``token`` as ``Authorization: Bearer <token>``.
+    Without a given token one is made on ``start`` and written to
+    ``token_file``. The python code of the macros only runs with
+    ``allow_python``, otherwise programs that could run it with -O1 or
+    -O2 are turned down."""
+    max_body = 16 << 20
+
+    def __init__(self, max_programs=64, max_runs=32, max_waiting=256,
+                 quantum=None, token=None, token_file=DEFAULT_TOKEN_FILE,
+                 allow_python=False):
+        self.token = token
+        self.token_file = token_file
+        self.allow_python = allow_python
+        self.tcp = False
+        self.store = ProgramStore(max_programs)
+        self.scheduler = Scheduler(quantum)
+        self.max_runs = max_runs
+        self.max_waiting = max_waiting
+        self.slots = None
+        # Programs are compiled one at a time, off the event loop
+        self.compiler = ThreadPoolExecutor(1, "compile")
+        self.running = 0
+        self.waiting = 0
+        self.finished = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def stats(self):
+        return {
+            "programs": self.store.stats(),
+            "runs": {
+                "running": self.running,
+                "waiting": self.waiting,
+                "finished": self.finished,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "max_runs": self.max_runs,
+                "max_waiting": self.max_waiting,
+            },
+        }
+
+    async def _get_program(self, request):
+        source = request.get("source")
+        if (not isinstance(source, str)):
+            raise BadRequest("The program source is missing")
+        optim = request.get("O", 0)
+        if (optim not in (0, 1, 2)):
+            raise BadRequest(f"Invalid optimization level {optim}")
+        alpha = request.get("alpha", "[a-z0-9]")
+        for w in request.get("ws", []):
+            for c in w:
+                if (not re.fullmatch(alpha, c)):
+                    raise BadRequest(
+                        "Words passed to the program must be on the given"
+                        f" alphabet ({alpha})")
+        base = request.get("base")
+        if (base is not None and
+                (not isinstance(base, str) or not os.path.isabs(base))):
+            raise BadRequest(f"Invalid base directory {base}")
+        inline_limit = request.get("inline_limit")
+        if (inline_limit is not None and type(inline_limit) is not int):
+            raise BadRequest(f"Invalid inline limit {inline_limit}")
+        if (optim >= 1 and not self.allow_python and
+                re.search(r"!!|^[ \t]*INCLUDE", source, re.M)):
+            raise BadRequest(
+                "The python code of the macros is disabled on this server,"
+                " start it with --allow-python or use -O0")
+        settings = LanguageSettings(alpha, instructions.instruction_dict,
+                                    optim, "vm", inline_limit,
+                                    bool(request.get("safe_macros")))
+        try:
+            key = self.store.key(source, settings, base)
+            program = self.store.lookup(key)
+            if (program is None):
+                loop = asyncio.get_running_loop()
+                program = await loop.run_in_executor(
+                    self.compiler, self.store.compile, source, settings, base)
+                self.store.add(key, program)
+            return key, program
+        except (SyntaxError, ValueError, KeyError, RuntimeError) as e:
+            raise BadRequest(f"{type(e).__name__}: {e}")
+
+    async def run(self, request):
+        """Runs a request of ``/run``. Returns the status and the answer"""
+        if (not isinstance(request, dict)):
+            raise BadRequest("The request must be a JSON object")
+        key, program = await self._get_program(request)
+        if (self.running+self.waiting >= self.max_runs+self.max_waiting):
+            self.rejected += 1
+            return 503, {"error": "Too many runs"}
+        ret = request.get("ret", "n")
+        if (ret not in ("n", "w")):
+            raise BadRequest(f"Invalid return type {ret}")
+        try:
+            task = ProgramTask(program,
+                               request.get("ns", []),
+                               request.get("ws", []),
+                               ret,
+                               request.get("max_steps"),
+                               request.get("timeout"),
+                               request.get("priority", 1))
+        except (TypeError, ValueError) as e:
+            raise BadRequest(str(e))
+
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        answer = {"key": key}
+        try:
+            answer["result"] = await self.scheduler.add(task)
+            answer["steps"] = task.steps
+            self.finished += 1
+        except Exception as e:
+            answer["error"] = f"{type(e).__name__}: {e}"
+            self.failed += 1
+        finally:
+            self.running -= 1
+            self.slots.release()
+        return 200, answer
+
+    def _check_access(self, method, headers):
+        """Status and error to turn down a request over TCP with, None to
+        accept it"""
+        if (not self.tcp):
+            return None
+        host = urlsplit("//"+headers.get("host", "")).hostname
+        if (host not in LOCAL_HOSTS):
+            return 403, {"error": "Only local hosts are served"}
+        origin = headers.get("origin")
+        if (origin is not None and urlsplit(origin).hostname not in
+                LOCAL_HOSTS):
+            return 403, {"error": f"Requests from {origin} are not allowed"}
+        if (not hmac.compare_digest(headers.get("authorization", ""),
+                                    f"Bearer {self.token}")):
+            return 401, {"error": "Missing or wrong token"}
+        kind = headers.get("content-type", "").split(";")[0].strip()
+        if (method == "POST" and kind.lower() != "application/json"):
+            return 415, {"error": "Requests must be application/json"}
+        return None
+
+    async def dispatch(self, method, path, body, headers):
+        refused = self._check_access(method, headers)
+        if (refused is not None):
+            return refused
+        if (path == "/stats"):
+            if (method != "GET"):
+                return 405, {"error": f"{method} not allowed"}
+            return 200, self.stats()
+        if (path == "/run"):
+            if (method != "POST"):
+                return 405, {"error": f"{method} not allowed"}
+            try:
+                return await self.run(json.loads(body or b"null"))
+            except json.JSONDecodeError as e:
+                return 400, {"error": f"Invalid JSON: {e}"}
+            except BadRequest as e:
+                return 400, {"error": str(e)}
+        return 404, {"error": f"Unknown path {path}"}
+
+    async def handle(self, reader, writer):
+        """Answers the requests of one connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if (not line):
+                    break
+                method, path, version = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if (not line.strip()):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                close = (version == "HTTP/1.0" or
+                         headers.get("connection", "").lower() == "close")
+                length = int(headers.get("content-length", 0))
+                if (length > self.max_body):
+                    status, answer = 413, {"error": "Request too large"}
+                    close = True
+                else:
+                    body = await reader.readexactly(length)
+                    status, answer = await self.dispatch(method, path, body,
+                                                         headers)
+                payload = json.dumps(answer).encode()
+                head = [f"HTTP/1.1 {status} {REASONS[status]}",
+                        "Content-Type: application/json",
+                        f"Content-Length: {len(payload)}"]
+                if (close):
+                    head.append("Connection: close")
+                writer.write(("\r\n".join(head)+"\r\n\r\n").encode()+payload)
+                await writer.drain()
+                if (close):
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.debug(f"Connection dropped: {e}")
+        finally:
+            writer.close()
+
+    async def start(self, address=DEFAULT_ADDRESS):
+        """Starts listening on ``address``, see ``parse_address``. Returns
+        the asyncio server"""
+        self.slots = asyncio.Semaphore(self.max_runs)
+        kind, where = parse_address(address)
+        if (kind == "unix"):
+            if (os.path.exists(where)):
+                os.remove(where)
+            server = await asyncio.start_unix_server(self.handle, where)
+            os.chmod(where, 0o600)
+        else:
+            self.tcp = True
+            if (self.token is None):
+                self.token = secrets.token_urlsafe(32)
+                self._write_token()
+            server = await asyncio.start_server(self.handle, *where)
+        logging.info(f"Listening on {address}")
+        return server
+
+    def _write_token(self):
+        # Only readable by the owner, as the clients of the same user
+        fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(self.token)
+        logging.info(f"Token written to {self.token_file}")
+
+    async def serve_forever(self, address=DEFAULT_ADDRESS):
+        server = await self.start(address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.compiler.shutdown(wait=False)
+            kind, where = parse_address(address)
+            if (kind == "unix" and os.path.exists(where)):
+                os.remove(where)
\ No newline at end of file
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import logging
+
+from .instructions import *
+from .macros import VonNeumannMacro
+from .regalloc import uses_defs
+
+# Instructions that copy a register of each type
+COPIES = (AssignNumber, AssignWord)
+
+class Subroutine(object):
+    """A macro template emitted once and shared by its calls.
+
+    The parameters of the template get registers of their own, ``params``
+    maps each one like the ``var_map`` of a macro. A call copies its
+    arguments into them, stores its number on the ``bits`` registers, in
+    binary, and jumps to ``entry``. When the body ends, or jumps to one of
+    the labels of the template, a tree of ``IF`` over the bits jumps back
+    to the call, which copies the parameters the body writes back to its
+    arguments and goes on."""
+
+    def __init__(self, template, params, body, entry):
+        self.template = template
+        self.params = params
+        self.body = body
+        self.entry = entry
+        self.frame = ((template.name, template),)
+        self.sites = 0
+        self.bits = []
+        # Return labels of each call, by exit: None when the body ends and
+        # the label parameter when it jumps there
+        self.returns = []
+        self.exits = {}
+        used, written = set(), set()
+        for l, inst in body:
+            reads, writes, _ = uses_defs(inst)
+            used.update(reads)
+            used.update(writes)
+            written.update(writes)
+        self.copy_in = [(tp, p) for tp in range(2)
+                        for p, r in sorted(params[tp].items())
+                        if ((tp, r) in used)]
+        self.copy_out = [(tp, p) for tp in range(2)
+                         for p, r in sorted(params[tp].items())
+                         if ((tp, r) in written)]
+
+class SubroutineLowering(object):
+    """Turns the calls left on an expanded program into calls to
+    subroutines.
+
+    The parser leaves unexpanded the calls to the templates whose body is
+    longer than the ``inline_limit`` of the settings. Each of those
+    templates is emitted once, after the program, and its calls jump in
+    and out of it, so the program grows with the amount of calls instead
+    of with the product of the sizes of the nested macros. Calls that pass
+    the same register as two parameters are expanded as before, since the
+    copies would change what the body sees. ``run`` returns the new
+    program."""
+
+    def __init__(self, macro_state, settings):
+        self.macro_state = macro_state
+        self.alph = settings.alph
+        self.optim = settings.optim
+        self.subroutines = {}
+        self.order = []
+
+    def _is_call(self, inst):
+        return (isinstance(inst, MacroCall) and
+                not (self.optim >= 1 and inst.optimized))
+
+    @staticmethod
+    def _aliased(macro):
+        params = macro.template.get_parameters()
+        for tp in range(2):
+            args = [macro.var_map[tp][p] for p in params[tp]]
+            if (len(set(args)) != len(args)):
+                return True
+        return False
+
+    def _build(self, cls, args, frame):
+        inst = cls.build(args, self.alph)
+        inst.origin = frame
+        return inst
+
+    def _prepare(self, instrs):
+        """Expands the aliased calls and counts the rest on their
+        subroutines"""
+        out = []
+        for l, inst in instrs:
+            if (not self._is_call(inst)):
+                out.append((l, inst))
+            elif (self._aliased(inst.macro)):
+                if (l is not None):
+                    out.append((l, self._build(Skip, [], inst.origin)))
+                out += self._prepare(inst.macro.parse_code(self.macro_state))
+            else:
+                self._get_subroutine(inst.macro.template).sites += 1
+                out.append((l, inst))
+        return out
+
+    def _get_subroutine(self, template):
+        if (template in self.subroutines):
+            return self.subroutines[template]
+        params = template.get_parameters()
+        var_map = [{p: self.macro_state.alloc_var(tp) for p in params[tp]}
+                   for tp in range(3)]
+        macro = VonNeumannMacro.from_var_map(template.name, template,
+                                             var_map)
+        body = self._prepare(macro.parse_code(self.macro_state))
+        entry = self.macro_state.alloc_var(2)
+        sub = Subroutine(template, var_map, body, entry)
+        self.subroutines[template] = sub
+        self.order.append(sub)
+        return sub
+
+    def _lower(self, instrs):
+        """Replaces the calls by the calling sequence"""
+        out = []
+        for l, inst in instrs:
+            if (not self._is_call(inst)):
+                out.append((l, inst))
+                continue
+            macro = inst.macro
+            sub = self.subroutines[macro.template]
+            frame = inst.origin+((macro.inst, macro.template),)
+            site = len(sub.returns)
+            seq = []
+            for j, bit in enumerate(sub.bits):
+                seq.append((None, self._build(AssignZero, [bit], frame)))
+                if (site >> j & 1):
+                    seq.append((None, self._build(Suc, [bit], frame)))
+            for tp, p in sub.copy_in:
+                seq.append((None, self._build(
+                    COPIES[tp], [sub.params[tp][p], macro.var_map[tp][p]],
+                    frame)))
+            seq.append((None, self._build(Goto, [sub.entry], frame)))
+
+            returns = {}
+            for e in [x for x in sub.exits]+[None]:
+                returns[e] = self.macro_state.alloc_var(2)
+                stub = [(None, self._build(
+                            COPIES[tp],
+                            [macro.var_map[tp][p], sub.params[tp][p]],
+                            frame))
+                        for tp, p in sub.copy_out]
+                if (e is not None):
+                    stub.append((None, self._build(
+                        Goto, [macro.var_map[2][e]], frame)))
+                elif (not stub):
+                    stub.append((None, self._build(Skip, [], frame)))
+                stub[0] = (returns[e], stub[0][1])
+                seq += stub
+            sub.returns.append(returns)
+            seq[0] = (l, seq[0][1])
+            out += seq
+        return out
+
+    def _dispatch(self, sub, exit, sites, j):
+        """Jumps from the exit of ``sub`` to the return label of the call
+        among ``sites`` whose number is on the bits up to ``j``"""
+        if (len(sites) == 1):
+            return [(None, self._build(
+                Goto, [sub.returns[sites[0]][exit]], sub.frame))]
+        zeros = [k for k in sites if not (k >> j & 1)]
+        ones = [k for k in sites if (k >> j & 1)]
+        if (not ones or not zeros):
+            return self._dispatch(sub, exit, zeros or ones, j-1)
+        label = self.macro_state.alloc_var(2)
+        out = [(None, self._build(Ifneq0, [sub.bits[j], label], sub.frame))]
+        out += self._dispatch(sub, exit, zeros, j-1)
+        right = self._dispatch(sub, exit, ones, j-1)
+        right[0] = (label, right[0][1])
+        return out+right
+
+    def _emit(self, sub, body):
+        out = list(body)
+        if (not out or out[0][0] is not None):
+            out.insert(0, (None, self._build(Skip, [], sub.frame)))
+        out[0] = (sub.entry, out[0][1])
+        sites = list(range(len(sub.returns)))
+        for e in [None]+[x for x in sub.exits]:
+            tree = self._dispatch(sub, e, sites, len(sub.bits)-1)
+            tree[0] = (sub.exits.get(e), tree[0][1])
+            out += tree
+        return out
+
+    def run(self, instrs):
+        instrs = self._prepare(instrs)
+        if (not self.order):
+            return instrs
+        bodies = []
+        for sub in self.order:
+            template = sub.template
+            sub.bits = [self.macro_state.alloc_var(0)
+                        for _ in range((sub.sites-1).bit_length())]
+            # Jumps to the labels of the template leave the body
+            sub.exits = {p: sub.params[2][p]
+                         for p in template.get_parameters()[2]}
+        out = self._lower(instrs)
+        # Bodies are lowered before any dispatch is built, they add calls
+        # to the subroutines of the macros they call
+        for sub in list(self.order):
+            bodies.append(self._lower(sub.body))
+        end = self.macro_state.alloc_var(2)
+        out.append((None, Goto.build([end], self.alph)))
+        for sub, body in zip(self.order, bodies):
+            out += self._emit(sub, body)
+        out.append((end, Skip.build([], self.alph)))
+        logging.debug(f"Lowered {len(self.order)} macros to subroutines")
+        return out
+
+def lower_subroutines(instrs, macro_state, settings):
+    return SubroutineLowering(macro_state, settings).run(instrs)
\ No newline at end of file
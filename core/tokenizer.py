@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import io
+import re
+
+from .utils import NUM_RE
+from .instructions import *
+
+WHITESPACE = str.maketrans("", "", " \n\t")
+
+class Include(object):
+    """``INCLUDE path`` line among the macros, which loads the macros of
+    a library"""
+    def __init__(self, path):
+        self.path = path
+
+class VonNeumannTokenizer(object):
+    """Single pass tokenizer for Vonneu programs.
+
+    Reads the source, a string or a text stream, in chunks. The macro
+    definitions at the start are returned raw by ``macros``, iterating
+    returns ``(label, instruction class, args)`` for each instruction of
+    the code (``args`` is the name for macro calls). Each instruction is
+    matched once, by a pattern picked from its first character, over a
+    window of the source with the whitespace removed. The window only
+    keeps what has not been parsed yet, together with the raw lines it
+    came from, so errors can tell the real line and column."""
+    chunk_size = 1 << 16
+
+    label_re = re.compile(r"L([0-9]+)")
+    macro_re = re.compile(r"{.*?}[ \n]*{.*?}(?:[ \n]*!!.*?!!)?", re.DOTALL)
+    include_re = re.compile(r"INCLUDE[ \t]+(\S[^\n]*?)[ \t]*(?:\n|$)")
+
+    def __init__(self, source, alph):
+        if (isinstance(source, str)):
+            source = io.StringIO(source)
+        self.stream = source
+        self.alph = alph
+        self.eof = False
+        self.header = True
+        # Raw text while reading the macros
+        self.raw = ""
+        self.raw_pos = 0
+        # Window over the code without whitespace. base is the offset of
+        # buf[0] from the start of the code
+        self.buf = ""
+        self.pos = 0
+        self.base = 0
+        self.start = 0
+        # [offset of the first char, line number, raw text, first column]
+        self.lines = []
+        self.lineno = 1
+        self.col0 = 0
+        self.macro_loc = (1, 1)
+        self.families = self._gen_families(alph)
+
+    @staticmethod
+    def _gen_families(alph):
+        a = f"(?:{alph})"
+        return {
+            "N": re.compile(
+                fr"N(?P<a>{NUM_RE})<-"
+                fr"(?:N(?P<b>{NUM_RE})(?P<op>\+1|\.-1)?|(?P<z>0))"),
+            "P": re.compile(
+                fr"P(?P<a>{NUM_RE})<-"
+                fr"(?:P(?P<b>{NUM_RE})(?:\.(?P<c>{a}))?"
+                fr"|>P(?P<t>{NUM_RE})|(?P<e>e))"),
+            "I": re.compile(
+                fr"IF(?:N(?P<n>{NUM_RE})\/=0"
+                fr"|P(?P<p>{NUM_RE})BEGINS(?P<c>{a})?)GOTOL(?P<l>{NUM_RE})"),
+            "G": re.compile(fr"GOTOL(?P<l>{NUM_RE})"),
+            "S": re.compile(r"SKIP"),
+            "[": re.compile(r"\[(?P<m>.*?)\]", re.DOTALL),
+        }
+
+    def _read(self):
+        chunk = self.stream.read(self.chunk_size)
+        if (not chunk):
+            self.eof = True
+        return chunk
+
+    def macros(self):
+        """Yields the text of each macro definition at the start of the
+        source, and an Include for each ``INCLUDE`` line"""
+        while True:
+            # Skip whitespace, keeping track of the position
+            while True:
+                stripped = self.raw.lstrip(" \n\t")
+                self._advance_raw(len(self.raw)-len(stripped))
+                if (self.raw or self.eof):
+                    break
+                self.raw += self._read()
+            if (self.raw.startswith("I") and "\n" not in self.raw and
+                    not self.eof):
+                self.raw += self._read()
+                continue
+            if (self.raw.startswith("INCLUDE")):
+                m = self.include_re.match(self.raw)
+                if (m is None):
+                    line, col = self.location()
+                    raise SyntaxError(
+                        f"On line {line}, column {col}: Could not match an"
+                        " include")
+                self.macro_loc = (self.lineno, self.col0+1)
+                yield Include(m.group(1))
+                self._advance_raw(m.end())
+                continue
+            if (not self.raw.startswith("{")):
+                break
+            m = self.macro_re.match(self.raw)
+            rest = self.raw[m.end():].lstrip(" \n") if m else ""
+            if (not self.eof and (m is None or not rest or rest[0] == "!")):
+                self.raw += self._read()
+                continue
+            if (m is None):
+                line, col = self.location()
+                raise SyntaxError(
+                    f"On line {line}, column {col}: Could not match a macro")
+            self.macro_loc = (self.lineno, self.col0+1)
+            yield m.group()
+            self._advance_raw(m.end())
+        self._end_header()
+
+    def _advance_raw(self, n):
+        consumed = self.raw[:n]
+        lines = consumed.count("\n")
+        if (lines):
+            self.lineno += lines
+            self.col0 = n-consumed.rindex("\n")-1
+        else:
+            self.col0 += n
+        self.raw = self.raw[n:]
+
+    def _end_header(self):
+        if (not self.header):
+            return
+        self.header = False
+        raw, self.raw = self.raw, ""
+        self._feed(raw)
+
+    def _feed(self, raw):
+        parts = raw.split("\n")
+        clean = []
+        offset = self.base+len(self.buf)
+        for j, part in enumerate(parts):
+            if (j > 0):
+                self.lineno += 1
+                self.col0 = 0
+                self.lines.append([offset, self.lineno, "", 0])
+            elif (not self.lines):
+                self.lines.append([offset, self.lineno, "", self.col0])
+            self.lines[-1][2] += part
+            c = part.translate(WHITESPACE)
+            offset += len(c)
+            clean.append(c)
+        self.buf += "".join(clean)
+
+    def _fill(self):
+        # Drop what was already parsed before reading more
+        self.buf = self.buf[self.start:]
+        self.base += self.start
+        self.pos -= self.start
+        self.start = 0
+        while (len(self.lines) > 1 and self.lines[1][0] <= self.base):
+            self.lines.pop(0)
+        self._feed(self._read())
+
+    def location(self, offset=None):
+        """Line and column of the given offset of the code, by default of
+        the start of the current instruction"""
+        if (self.header):
+            return self.lineno, self.col0+1
+        if (offset is None):
+            offset = self.base+self.start
+        line = self.lines[-1]
+        for entry in self.lines:
+            start, _, raw, _ = entry
+            if (start <= offset < start+len(raw.translate(WHITESPACE))):
+                line = entry
+                break
+        start, lineno, raw, col0 = line
+        count = offset-start
+        col = len(raw)
+        for i, c in enumerate(raw):
+            if (c in " \t"):
+                continue
+            if (count == 0):
+                col = i
+                break
+            count -= 1
+        return lineno, col0+col+1
+
+    def _error(self, msg):
+        line, col = self.location()
+        raise SyntaxError(f"On line {line}, column {col}: {msg}")
+
+    def _match(self, pattern):
+        """Matches the pattern at the current position, reading more of the
+        source when the match could be cut by the end of the window"""
+        while True:
+            m = pattern.match(self.buf, self.pos)
+            if (self.eof or (m is not None and m.end() < len(self.buf))):
+                return m
+            self._fill()
+
+    def __iter__(self):
+        self._end_header()
+        families = self.families
+        while True:
+            if (len(self.buf)-self.pos < 256 and not self.eof):
+                self.start = self.pos
+                self._fill()
+                continue
+            if (self.pos >= len(self.buf)):
+                return
+            self.start = self.pos
+            label = None
+            if (self.buf[self.pos] == "L"):
+                m = self._match(self.label_re)
+                if (m is None):
+                    self._error(f"Could not match {self._context()}")
+                label = int(m.group(1))
+                self.pos = m.end()
+            c = self.buf[self.pos] if self.pos < len(self.buf) else ""
+            pattern = families.get(c)
+            m = self._match(pattern) if pattern is not None else None
+            if (m is None):
+                self._error(f"Could not match {self._context()}")
+            self.pos = m.end()
+            cls, args = self._classify(c, m)
+            yield label, cls, args
+
+    def _context(self):
+        return self.buf[self.start:self.start+20] or "the end of the code"
+
+    def _classify(self, c, m):
+        g = m.group
+        if (c == "N"):
+            a = int(g("a"))
+            if (g("z") is not None):
+                return AssignZero, [a]
+            b = int(g("b"))
+            if (g("op") is None):
+                return AssignNumber, [a, b]
+            if (a != b):
+                self._error(f"Unable to parse instruction: {m.group()}")
+            return (Suc if g("op") == "+1" else Pred), [a]
+        elif (c == "P"):
+            a = int(g("a"))
+            if (g("e") is not None):
+                return AssignEpsilon, [a]
+            if (g("t") is not None):
+                if (a != int(g("t"))):
+                    self._error(f"Unable to parse instruction: {m.group()}")
+                return Tail, [a]
+            b = int(g("b"))
+            if (g("c") is None):
+                return AssignWord, [a, b]
+            if (a != b):
+                self._error(f"Unable to parse instruction: {m.group()}")
+            return Append, [a, g("c")]
+        elif (c == "I"):
+            if (g("n") is not None):
+                return Ifneq0, [int(g("n")), int(g("l"))]
+            return Ifbeg, [int(g("p")), g("c") or "", int(g("l"))]
+        elif (c == "G"):
+            return Goto, [int(g("l"))]
+        elif (c == "S"):
+            return Skip, []
+        return MacroCall, g("m")
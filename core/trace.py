@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+from array import array
+
+from .vm import *
+
+TRACE_NONE = 0
+TRACE_NUMB = 1
+TRACE_WORD = 2
+
+NUMB_OPS = (OP_PRED, OP_SUC, OP_ASSN, OP_ZERO)
+WORD_OPS = (OP_APPEND, OP_TAIL, OP_ASSW, OP_EPS)
+WIDE_OPS = (OP_IDIOM, OP_MACRO)
+
+# Numbers that don't fit on a record are kept on the objects list
+MAX_VALUE = (1 << 63)-1
+
+def jump_label(program, pc, i):
+    """Label the instruction ``pc`` jumped to when the next one is ``i``,
+    None when it went on to the next one"""
+    inst = program.instrs[pc]
+    if (i != pc+1 or isinstance(inst, Goto)):
+        if (inst.argKinds and inst.argKinds[-1] == "L"):
+            return inst.args[-1]
+        for l, j in program.labels.items():
+            if (j == i):
+                return l
+    return None
+
+class StepTrace(object):
+    """Bounded record of the steps of a run.
+
+    Each record holds the index of the executed instruction, its opcode,
+    the index of the next instruction, the register it changed and the new
+    value, stored on arrays used as a ring buffer of ``size`` records.
+    Words and big numbers are kept on a list next to them. Macros and
+    fused loops can change several registers, they take one record for
+    each one and every record after the first has pc -1.
+
+    The trace is passed to a backend, which calls it after each step, or
+    only after one of every ``sample`` steps. Records are decoded to text
+    by ``lines``. Without sampling the state before the oldest record is
+    kept, so each line shows the whole state. With sampling each line only
+    shows the registers changed by its step."""
+
+    def __init__(self, program, size=1 << 16, sample=1):
+        if (size < 1 or sample < 1):
+            raise ValueError("The trace size and sample must be positive")
+        self.program = program
+        self.bytecode = program.get_bytecode()
+        self.size = size
+        self.sample = sample
+        self.pcs = array("q", bytes(8*size))
+        self.nexts = array("q", bytes(8*size))
+        self.ops = array("B", bytes(size))
+        self.kinds = array("B", bytes(size))
+        self.regs = array("q", bytes(8*size))
+        self.values = array("q", bytes(8*size))
+        self.objects = [None]*size
+        self.wide = {}
+        self.start({}, {})
+
+    def start(self, numbs, words, maps=None):
+        """Binds the trace to the state of a new run. ``maps`` are the
+        numbers and words maps of the RegisterAllocation when the state is
+        a register file, records keep the registers of the program."""
+        self.numbs = numbs
+        self.words = words
+        self.maps = maps
+        if (maps is None):
+            self.base = (dict(numbs), dict(words))
+        else:
+            self.base = tuple({r: state[i] for r, i in m.items() if state[i]}
+                              for m, state in zip(maps, (numbs, words)))
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def _registers(self, pc):
+        # Registers changed by a macro or a fused loop
+        if (pc not in self.wide):
+            used = self.program.instrs[pc].get_used_vars()
+            self.wide[pc] = ([(TRACE_NUMB, x) for x in sorted(used[0])] +
+                             [(TRACE_WORD, x) for x in sorted(used[1])])
+        return self.wide[pc]
+
+    def __call__(self, pc, i):
+        op = self.bytecode.ops[pc]
+        if (op in NUMB_OPS):
+            self._write(pc, op, i, TRACE_NUMB,
+                        self.program.instrs[pc].args[0])
+        elif (op in WORD_OPS):
+            self._write(pc, op, i, TRACE_WORD,
+                        self.program.instrs[pc].args[0])
+        elif (op in WIDE_OPS):
+            regs = self._registers(pc)
+            if (not regs):
+                self._write(pc, op, i, TRACE_NONE, 0)
+            for j, (kind, reg) in enumerate(regs):
+                self._write(pc if j == 0 else -1, op, i, kind, reg)
+        else:
+            self._write(pc, op, i, TRACE_NONE, 0)
+
+    def _write(self, pc, op, i, kind, reg):
+        slot = self.count % self.size
+        if (self.count >= self.size and self.sample == 1):
+            self._fold(slot)
+        self.count += 1
+        self.pcs[slot] = pc
+        self.nexts[slot] = i
+        self.ops[slot] = op
+        self.kinds[slot] = kind
+        self.regs[slot] = reg
+        if (kind == TRACE_NONE):
+            return
+        indx = reg if self.maps is None else self.maps[kind-1][reg]
+        if (kind == TRACE_NUMB):
+            value = self.numbs[indx]
+            if (value <= MAX_VALUE):
+                self.values[slot] = value
+                self.objects[slot] = None
+                return
+        else:
+            value = self.words[indx]
+        self.objects[slot] = value
+
+    def _value(self, slot):
+        if (self.objects[slot] is not None):
+            return self.objects[slot]
+        return self.values[slot]
+
+    def _fold(self, slot):
+        # The oldest record is dropped, its change moves to the base state
+        kind = self.kinds[slot]
+        if (kind != TRACE_NONE):
+            self.base[kind-1][self.regs[slot]] = self._value(slot)
+
+    def records(self):
+        """Yields ``(pc, next pc, changes)`` for each recorded step, from
+        the oldest one. ``changes`` is a list of ``(kind, register, value)``
+        with ``kind`` TRACE_NUMB or TRACE_WORD."""
+        first = max(self.count-self.size, 0)
+        step = None
+        for n in range(first, self.count):
+            slot = n % self.size
+            pc = self.pcs[slot]
+            if (pc >= 0):
+                if (step is not None):
+                    yield step
+                step = (pc, self.nexts[slot], [])
+            elif (step is None):
+                # The start of this step was already dropped
+                continue
+            kind = self.kinds[slot]
+            if (kind != TRACE_NONE):
+                step[2].append((kind, self.regs[slot], self._value(slot)))
+        if (step is not None):
+            yield step
+
+    def lines(self):
+        """Yields the recorded steps as the reference interpreter logs
+        them"""
+        full = self.sample == 1
+        if (full and self.count > self.size):
+            # Changes of a step cut by the ring are already on the base
+            for n in range(self.count-self.size, self.count):
+                slot = n % self.size
+                if (self.pcs[slot] >= 0):
+                    break
+                self._fold(slot)
+        numbs, words = (dict(x) for x in self.base)
+        for pc, i, changes in self.records():
+            if (not full):
+                numbs, words = {}, {}
+            for kind, reg, value in changes:
+                (numbs if kind == TRACE_NUMB else words)[reg] = value
+            yield self.program._str_state(
+                pc, jump_label(self.program, pc, i), numbs, words)
\ No newline at end of file
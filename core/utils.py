@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import re
+import heapq
 
 VAR_TP_CHAR = ["N", "P", "L"]
 VAR_TP_INDX = { k:i for i,k in enumerate(VAR_TP_CHAR)}
@@ -11,6 +13,10 @@ NUM_RE = r"(?:[1-9][0-9]*|0)"
 VAR_MATCH = fr"([NPL])({NUM_RE})"
 AUX_MATCH = fr"([VWA])({NUM_RE})"
 
+def call_shape(name):
+    """Name of a macro call with each variable replaced by ``#``"""
+    return re.sub(r"[NPL][0-9]+", "#", name)
+
 def gen_regex(inst, alph):
     r = r"(?:L([0-9]+))?(?:"
     for k,i in inst.items():
@@ -23,26 +29,68 @@ def clean_program(program: str):
     return program.replace(" ", "").replace("\n", "").replace("\t", "")
 
 class LanguageSettings(object):
-    def __init__(self, alph, instrs, optim=0):
+    def __init__(self, alph, instrs, optim=0, backend="vm",
+                 inline_limit=None, safe_macros=False):
         self.alph = alph
         self.instrs = instrs
         self.optim = optim
+        self.backend = backend
+        # Macros whose body is longer are lowered to subroutines
+        self.inline_limit = inline_limit
+        # Only the optimized code checked against the body is used
+        self.safe_macros = safe_macros
 
 class MacroState(object):
+    """Registered macro templates and the variables in use.
+
+    Templates are indexed by their shape, the name with each variable
+    replaced by ``#``, so a call is only tried against the templates that
+    could match it. Templates whose shape can't be told from the name are
+    tried on every call. ``verifier`` is the MacroVerifier that decides
+    which optimized code can be used, when there's one."""
+    verifier = None
+
     def __init__(self):
         self.macros = []
+        self.positions = {}
+        self.shapes = {}
+        self.generic = []
         self.used_vars = [set(), set(), set()]
+        self.free = [0, 0, 0]
+
+    def fork(self):
+        """State with the same templates and no variables in use, where the
+        body of a macro is parsed with its own numbering"""
+        state = MacroState()
+        state.macros = self.macros
+        state.positions = self.positions
+        state.shapes = self.shapes
+        state.generic = self.generic
+        state.verifier = self.verifier
+        return state
 
     def register_macro(self, macro):
+        position = len(self.macros)
+        self.positions[macro] = position
         self.macros.append(macro)
+        shape = macro.get_shape()
+        if (shape is None):
+            self.generic.append(position)
+        else:
+            self.shapes.setdefault(shape, []).append(position)
 
     def match(self, macro, inside_macro=None):
         if inside_macro:
-            stop = self.macros.index(inside_macro.template)
+            template = getattr(inside_macro, "template", inside_macro)
+            stop = self.positions[template]
         else:
             stop = len(self.macros)
-        for i in self.macros[:stop]:
-            inst = i.match_inst(macro)
+        candidates = heapq.merge(self.shapes.get(call_shape(macro), ()),
+                                 self.generic)
+        for i in candidates:
+            if (i >= stop):
+                break
+            inst = self.macros[i].match_inst(macro)
             if (inst is not None):
                 return inst
         raise SyntaxError(f"Could not match macro {macro}")
@@ -61,13 +109,23 @@ class MacroState(object):
 
     def update_used_vars(self, used):
         for i in range(3):
-            self.used_vars[i] = self.used_vars[i].union(set(used[i]))
+            self.used_vars[i].update(used[i])
 
     def take_var(self, tp, indx):
         taken = indx in self.used_vars[tp]
         self.used_vars[tp].add(indx)
         return taken
 
+    def alloc_var(self, tp):
+        """Takes the lowest variable of type ``tp`` not in use"""
+        used = self.used_vars[tp]
+        indx = self.free[tp]
+        while indx in used:
+            indx += 1
+        used.add(indx)
+        self.free[tp] = indx+1
+        return indx
+
     def take_number(self, indx):
         return self.take_var(0, indx)
 
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import re
+import random
+import logging
+
+from collections import defaultdict
+
+from .instructions import *
+from .utils import *
+from .macros import VonNeumannMacroTemplate
+
+class MacroReport(object):
+    """Outcome of checking the optimized code of a template. ``checked``
+    are the inputs both ran on, ``inconclusive`` the ones where the body
+    ran out of steps, and ``divergences`` the inputs where they differ,
+    up to ``max_divergences`` of them."""
+    max_divergences = 5
+
+    def __init__(self, template):
+        self.template = template
+        self.checked = 0
+        self.inconclusive = 0
+        self.failed = 0
+        self.divergences = []
+
+    @property
+    def verified(self):
+        return self.checked > 0 and self.failed == 0
+
+    def add_divergence(self, inputs, diffs):
+        self.failed += 1
+        if (len(self.divergences) < self.max_divergences):
+            self.divergences.append({"inputs": inputs, "diffs": diffs})
+
+    def as_dict(self):
+        return {
+            "macro": self.template.name,
+            "verified": self.verified,
+            "checked": self.checked,
+            "inconclusive": self.inconclusive,
+            "failed": self.failed,
+            "divergences": self.divergences,
+        }
+
+class MacroVerifier(object):
+    """Checks the optimized code of the templates against their vonneu
+    code.
+
+    Both run from the same registers, drawn at random, on the parameters
+    and the auxiliary variables of the template, numbered as on its body.
+    The body runs fully expanded, as with -O0, on the reference
+    interpreter and for at most ``max_steps``. Afterwards every parameter
+    and auxiliary variable and the label the macro jumps to, if any, must
+    be the same. The optimized code is trusted to end."""
+    samples = 200
+    max_steps = 10000
+    max_number = 5
+    max_length = 4
+
+    def __init__(self, templates, settings, seed=0):
+        self.settings = LanguageSettings(settings.alph, settings.instrs, 0,
+                                         "object")
+        self.seed = seed
+        self.chars = [chr(c) for c in range(32, 127)
+                      if re.fullmatch(settings.alph, chr(c))]
+        # Copies of the templates that always expand their calls
+        self.state = MacroState()
+        self.references = {}
+        for template in templates:
+            reference = VonNeumannMacroTemplate(template.source,
+                                                self.settings, self.state)
+            self.state.register_macro(reference)
+            self.references[template] = reference
+        self.reports = {}
+
+    def _reference(self, template):
+        """Expanded body of the template and the index of its labels"""
+        body = self.references[template].get_body()[0]
+        labels = {}
+        for i, (l, inst) in enumerate(body):
+            if (l is not None and l not in labels):
+                labels[l] = i
+        return body, labels
+
+    def _inputs(self, rng, registers, chars):
+        numbs = {r: rng.randint(0, self.max_number) for r in registers[0]}
+        words = {r: "".join(rng.choice(chars) for _ in
+                            range(rng.randint(0, self.max_length)))
+                 for r in registers[1]}
+        return numbs, words
+
+    def _run_reference(self, body, labels, exits, numbs, words):
+        """Runs the body like ``run_objects``. Returns the label it jumps
+        to, None when it ends, and the registers."""
+        numbs, words = self._state(numbs, words)
+        i = 0
+        s = 0
+        while i < len(body):
+            if (s >= self.max_steps):
+                raise RuntimeError("Max ammount of steps reached")
+            s += 1
+            l, numbs, words = body[i][1](numbs, words)
+            if (l is None):
+                i += 1
+            elif (l in labels):
+                i = labels[l]
+            elif (l in exits):
+                return l, numbs, words
+            else:
+                raise KeyError(l)
+        return None, numbs, words
+
+    @staticmethod
+    def _state(numbs, words):
+        state = (defaultdict(lambda: 0), defaultdict(lambda: ""))
+        state[0].update(numbs)
+        state[1].update(words)
+        return state
+
+    def _run_optimized(self, function, numbs, words):
+        numbs, words = self._state(numbs, words)
+        return function(numbs, words), numbs, words
+
+    def verify(self, template):
+        """Runs the template both ways, once. Returns a MacroReport"""
+        if (template in self.reports):
+            return self.reports[template]
+        report = MacroReport(template)
+        self.reports[template] = report
+        params = template.get_parameters()
+        aux = template.get_auxiliary()
+        registers = [sorted(set(params[i]) | aux[i]) for i in range(3)]
+        try:
+            body, labels = self._reference(template)
+            function = template.get_opt_factory().bind(
+                *({r: r for r in registers[i]} for i in range(3)))
+        except (SyntaxError, IndexError) as e:
+            report.add_divergence(None, [f"{type(e).__name__}: {e}"])
+            return report
+
+        # Characters the body looks for are drawn more often
+        consts = [a for l, inst in body
+                  for k, a in zip(inst.argKinds, inst.args) if k == "C"]
+        chars = (self.chars[:3]+consts) or [""]
+        rng = random.Random(f"{self.seed}:{template.name}")
+        for k in range(self.samples):
+            numbs, words = self._inputs(rng, registers, chars)
+            if (k == 0):
+                numbs = dict.fromkeys(numbs, 0)
+                words = dict.fromkeys(words, "")
+            inputs = {"numbs": dict(numbs), "words": dict(words)}
+            try:
+                expected = self._run_reference(body, labels, params[2],
+                                               numbs, words)
+            except RuntimeError:
+                report.inconclusive += 1
+                continue
+            except KeyError as e:
+                report.add_divergence(
+                    inputs, [f"The body jumps to undefined label L{e}"])
+                continue
+            try:
+                got = self._run_optimized(function, numbs, words)
+            except Exception as e:
+                report.add_divergence(
+                    inputs, [f"The optimized code raised "
+                             f"{type(e).__name__}: {e}"])
+                continue
+            report.checked += 1
+            diffs = self._compare(template, registers, expected, got)
+            if (diffs):
+                report.add_divergence(inputs, diffs)
+        if (not report.checked):
+            logging.warning(
+                f"Macro {template.name} couldn't be checked, its body ran out"
+                f" of steps on every input")
+        elif (report.failed):
+            logging.warning(
+                f"Optimized code of macro {template.name} doesn't match its"
+                f" body on {report.failed} of {self.samples} inputs")
+        return report
+
+    @staticmethod
+    def _compare(template, registers, expected, got):
+        diffs = []
+        if (expected[0] != got[0]):
+            ways = ["ends" if x is None else f"jumps to A{x}"
+                    for x in (expected[0], got[0])]
+            diffs.append(f"The body {ways[0]}, the optimized code {ways[1]}")
+        params = template.get_parameters()
+        for i, tp in enumerate(AUX_TP_CHAR[:2]):
+            for r in registers[i]:
+                if (expected[i+1][r] != got[i+1][r]):
+                    kind = "parameter" if r in params[i] else "auxiliary"
+                    diffs.append(f"{kind} {tp}{r} is {expected[i+1][r]!r} "
+                                 f"on the body and {got[i+1][r]!r} on the"
+                                 f" optimized code")
+        return diffs
+
+    def trust(self, template):
+        """Whether the optimized code of the template can be used. When it
+        isn't verified the code is dropped, and its calls are expanded.
+        Templates already trusted, as the ones of a library, aren't
+        checked again."""
+        if (getattr(template, "trusted", False)):
+            return True
+        report = self.verify(template)
+        if (not report.verified):
+            template.drop_opt_code()
+        template.trusted = report.verified
+        return report.verified
+
+def verify_macros(program, seed=0):
+    """Reports of the optimized templates of ``program``"""
+    verifier = MacroVerifier(program.macro_state.macros, program.settings,
+                             seed)
+    return [verifier.verify(t)
+            for t in program.macro_state.macros if t.optimized]
\ No newline at end of file
@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+import sys
+
+from array import array
+
+from .instructions import *
+from .idioms import LoopIdiom
+from .words import Alphabet, Word
+
+# Opcodes. The order of the dispatch chain in Bytecode.execute follows the
+# frequency these usually have on expanded programs.
+OP_IFNZ = 0
+OP_GOTO = 1
+OP_PRED = 2
+OP_SUC = 3
+OP_ASSN = 4
+OP_ZERO = 5
+OP_IFBEG = 6
+OP_APPEND = 7
+OP_TAIL = 8
+OP_ASSW = 9
+OP_EPS = 10
+OP_IDIOM = 11
+OP_SKIP = 12
+OP_MACRO = 13
+# Superinstructions, each one runs a sequence of the opcodes above
+OP_BRANCH = 14
+OP_BRANCHW = 15
+OP_DECINCJ = 16
+OP_DECINC = 17
+OP_ONE = 18
+# Head of a loop that could be fast-forwarded
+OP_HEAD = 19
+OP_HALT = 20
+OP_UNDEF = 21
+
+OPCODES = {
+    Ifneq0: OP_IFNZ,
+    Goto: OP_GOTO,
+    Pred: OP_PRED,
+    Suc: OP_SUC,
+    AssignNumber: OP_ASSN,
+    AssignZero: OP_ZERO,
+    Ifbeg: OP_IFBEG,
+    Append: OP_APPEND,
+    Tail: OP_TAIL,
+    AssignWord: OP_ASSW,
+    AssignEpsilon: OP_EPS,
+    LoopIdiom: OP_IDIOM,
+    Skip: OP_SKIP,
+    MacroCall: OP_MACRO,
+}
+
+# Sequences fused into a superinstruction, tried in order on every
+# instruction: the opcodes of the sequence, the superinstruction and a
+# check over the ``(a, b, c)`` operands of the sequence, or None. Patterns
+# found hot when profiling go here, with a case for the superinstruction
+# on Bytecode.execute.
+FUSIONS = [
+    # IF Nx /= 0 GOTO La ; GOTO Lb
+    ((OP_IFNZ, OP_GOTO), OP_BRANCH, None),
+    # IF Px BEGINS a GOTO La ; GOTO Lb
+    ((OP_IFBEG, OP_GOTO), OP_BRANCHW, None),
+    # Nx <- Nx .- 1 ; Ny <- Ny + 1 ; GOTO La
+    ((OP_PRED, OP_SUC, OP_GOTO), OP_DECINCJ, None),
+    # Nx <- Nx .- 1 ; Ny <- Ny + 1
+    ((OP_PRED, OP_SUC), OP_DECINC, None),
+    # Nx <- 0 ; Nx <- Nx + 1
+    ((OP_ZERO, OP_SUC), OP_ONE, lambda args: args[0][0] == args[1][0]),
+]
+
+# Steps taken by each superinstruction, at most
+SUPER_STEPS = {x[1]: len(x[0]) for x in FUSIONS}
+
+class Bytecode(object):
+    """Flat representation of an expanded program.
+
+    Every instruction is stored as an opcode and three operands: ``a`` is the
+    register the instruction works on, ``b`` is the source register or the
+    index of a character on ``consts`` or of a fused loop on ``idioms`` and
+    ``c`` is the index of the jump target. Index ``size`` holds a HALT and,
+    after it, one trap for each label that is jumped to but never
+    defined.
+
+    ``fused`` are the opcodes with the first instruction of each sequence
+    on FUSIONS replaced by its superinstruction, which runs the whole
+    sequence on one dispatch. The rest of the sequence is kept, so jumps
+    into it still work. Loop heads are marked there with OP_HEAD, their
+    own opcode is kept on ``heads``, and untraced runs try to
+    fast-forward the loops that get hot. Untraced runs use them.
+
+    Words are kept as Word registers during the run, with the characters
+    interned by ``alphabet``, and turned back into strings when it ends.
+    Macros and fused loops work over strings, so ``synced`` holds the word
+    registers of each one, which are converted around the call."""
+    __slots__ = ("ops", "fused", "heads", "loops", "a", "b", "c", "consts",
+                 "macros", "idioms", "labels", "size", "alphabet", "synced")
+    fusions = FUSIONS
+    # Visits to a loop head before trying to fast-forward it, the longest
+    # path recorded and the visits to wait after a loop that can't be
+    # fast-forwarded
+    watch = 2
+    max_path = 64
+    backoff = 1024
+
+    def __init__(self, instrs, labels):
+        self.ops = array("B")
+        self.a = array("q")
+        self.b = array("q")
+        self.c = array("q")
+        self.consts = []
+        self.macros = []
+        self.idioms = []
+        self.labels = labels
+        self.size = len(instrs)
+        self.synced = {}
+
+        undefined = {}
+        def target(label):
+            if (label in labels):
+                return labels[label]
+            if (label not in undefined):
+                undefined[label] = self.size + 1 + len(undefined)
+            return undefined[label]
+
+        for inst in instrs:
+            try:
+                op = OPCODES[type(inst)]
+            except KeyError:
+                raise RuntimeError(
+                    f"Instruction {inst} has no bytecode") from None
+            a = b = c = 0
+            if (op == OP_MACRO):
+                a = len(self.macros)
+                self.macros.append(inst.macro)
+                self.synced[len(self.ops)] = sorted(inst.get_used_vars()[1])
+            elif (op == OP_IDIOM):
+                b = len(self.idioms)
+                self.idioms.append(inst.get_function())
+                c = target(inst.args[0])
+                self.synced[len(self.ops)] = sorted(inst.get_used_vars()[1])
+            else:
+                regs = []
+                for kind, arg in zip(inst.argKinds, inst.args):
+                    if (kind == "L"):
+                        c = target(arg)
+                    elif (kind == "C"):
+                        if (arg not in self.consts):
+                            self.consts.append(arg)
+                        b = self.consts.index(arg)
+                    else:
+                        regs.append(arg)
+                if (regs):
+                    a = regs[0]
+                if (len(regs) > 1):
+                    b = regs[1]
+            self._emit(op, a, b, c)
+
+        self._emit(OP_HALT, 0, 0, 0)
+        for label in undefined:
+            self._emit(OP_UNDEF, label, 0, 0)
+        self.alphabet = Alphabet(x for x in self.consts if x)
+        self.fused = self.fuse()
+
+    def fuse(self):
+        """Opcodes with the superinstructions of ``fusions`` and the loop
+        heads"""
+        ops = self.ops
+        fused = array("B", ops)
+        for i in range(self.size):
+            for pattern, op, check in self.fusions:
+                n = len(pattern)
+                if (tuple(ops[i:i+n]) != pattern):
+                    continue
+                if (check is not None and
+                        not check([(self.a[j], self.b[j], self.c[j])
+                                   for j in range(i, i+n)])):
+                    continue
+                fused[i] = op
+                break
+        # Loop heads, targets of a jump backwards that start on a step
+        # fast_forward can record, keep their opcode on ``heads``. The
+        # last jump back to each one is on ``loops``
+        self.heads = {}
+        self.loops = {}
+        for i in range(self.size):
+            c = self.c[i]
+            if (ops[i] in (OP_IFNZ, OP_GOTO, OP_IFBEG) and c <= i and
+                    (ops[c] <= OP_ZERO or ops[c] == OP_SKIP)):
+                self.heads[c] = fused[c]
+                self.loops[c] = i
+        for c in self.heads:
+            fused[c] = OP_HEAD
+        return fused
+
+    def _emit(self, op, a, b, c):
+        self.ops.append(op)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+
+    def __len__(self):
+        return self.size
+
+    def _iterate(self, head, numbs, s, limit):
+        """Runs the loop starting on ``head`` once, while it only works
+        over numbers. Returns the next instruction, the steps and the path
+        taken, a tuple of ``(pc, jumped)``. The path is None if the loop
+        was left or the steps reached ``limit`` and False if a step can't
+        be recorded."""
+        ops = self.ops
+        xa = self.a
+        xc = self.c
+        tail = self.loops[head]
+        path = []
+        i = head
+        while (len(path) < self.max_path):
+            if (i < head or i > tail or s >= limit):
+                return i, s, None
+            op = ops[i]
+            if (op > OP_ZERO and op != OP_SKIP):
+                return i, s, False
+            s += 1
+            jumped = False
+            if (op == OP_IFNZ):
+                if (numbs[xa[i]] != 0):
+                    jumped = True
+            elif (op == OP_GOTO):
+                jumped = True
+            elif (op == OP_PRED):
+                if (numbs[xa[i]] > 0):
+                    numbs[xa[i]] -= 1
+            elif (op == OP_SUC):
+                numbs[xa[i]] += 1
+            elif (op == OP_ASSN):
+                numbs[xa[i]] = numbs[self.b[i]]
+            elif (op == OP_ZERO):
+                numbs[xa[i]] = 0
+            path.append((i, jumped))
+            i = xc[i] if jumped else i+1
+            if (i == head):
+                return i, s, tuple(path)
+        return i, s, False
+
+    def _effects(self, path):
+        """Symbolic run of a loop path. Every register is written as a
+        register at the start of the iteration, or None for a constant,
+        plus an offset. Returns the value of each written register at the
+        end, the branches as ``(base, offset, jumped)`` and the values
+        decremented as ``(base, offset)``."""
+        ops = self.ops
+        xa = self.a
+        regs = {}
+        tests = []
+        preds = []
+        for pc, jumped in path:
+            op = ops[pc]
+            a = xa[pc]
+            if (op == OP_IFNZ):
+                tests.append(regs.get(a, (a, 0))+(jumped,))
+            elif (op == OP_PRED):
+                base, off = regs.get(a, (a, 0))
+                preds.append((base, off))
+                regs[a] = (base, off-1)
+            elif (op == OP_SUC):
+                base, off = regs.get(a, (a, 0))
+                regs[a] = (base, off+1)
+            elif (op == OP_ASSN):
+                regs[a] = regs.get(self.b[pc], (self.b[pc], 0))
+            elif (op == OP_ZERO):
+                regs[a] = (None, 0)
+        return regs, tests, preds
+
+    @staticmethod
+    def _slopes(regs):
+        """Change of each register on each iteration and the iterations
+        needed before it changes by it, or None when registers are copied
+        around in a cycle"""
+        slopes = {}
+        depths = {}
+        def slope(r, seen):
+            if (r in slopes):
+                return True
+            base, off = regs.get(r, (r, 0))
+            if (base == r):
+                slopes[r], depths[r] = off, 0
+            elif (base is None):
+                slopes[r], depths[r] = 0, 1
+            elif (base in seen or not slope(base, seen | {r})):
+                return False
+            else:
+                slopes[r], depths[r] = slopes[base], depths[base]+1
+            return True
+        for r in regs:
+            if (not slope(r, frozenset())):
+                return None
+        return slopes, depths
+
+    def fast_forward(self, head, numbs, s, limit):
+        """Skips iterations of the loop on ``head``.
+
+        The loop runs on until the same path was taken as many times in a
+        row as the copies between registers need to settle, at least
+        twice. If every register it changes grows or shrinks by the same
+        amount each time, the iterations left before a branch goes the
+        other way or a decrement hits zero are computed and their effects
+        applied at once, as long as their steps fit in ``limit``, -1 for no
+        limit. Loops with no test or decrement that bounds them are never
+        skipped. The iterations after that are stepped as usual. Returns
+        the next instruction, the steps and whether the loop was affine."""
+        last = None
+        same = 0
+        while True:
+            i, s, path = self._iterate(head, numbs, s,
+                                       sys.maxsize if limit < 0 else limit)
+            if (not path):
+                return i, s, path is None
+            if (path != last):
+                last = path
+                same = 1
+                regs, tests, preds = self._effects(path)
+                slopes = self._slopes(regs)
+                if (slopes is None):
+                    return i, s, False
+                slopes, depths = slopes
+                settle = max(2, max(depths.values(), default=0))
+            else:
+                same += 1
+            if (same >= settle):
+                break
+
+        def value(base, off):
+            # Value now and change per iteration
+            if (base is None):
+                return off, 0
+            return numbs[base]+off, slopes.get(base, 0)
+
+        k = None
+        for base, off, jumped in tests:
+            a, b = value(base, off)
+            if (jumped):
+                if (a == 0):
+                    return i, s, True
+                if (b < 0):
+                    n = (a-b-1)//-b
+                    k = n if k is None else min(k, n)
+            elif (a != 0):
+                return i, s, True
+            elif (b != 0):
+                k = 1 if k is None else min(k, 1)
+        for base, off in preds:
+            a, b = value(base, off)
+            if (a < 1):
+                return i, s, True
+            if (b < 0):
+                n = (a-1)//-b+1
+                k = n if k is None else min(k, n)
+        if (k is None):
+            # Nothing bounds the loop, it may never end
+            return i, s, False
+        if (limit >= 0):
+            k = min(k, (limit-s)//len(path))
+        if (k < 1):
+            return i, s, True
+        for r, d in slopes.items():
+            numbs[r] += k*d
+        return head, s+k*len(path), True
+
+    def execute(self, numbs, words, max_steps=None, trace=None):
+        """Runs the bytecode over the given state.
+
+        ``numbs`` and ``words`` are the register file, lists with an item
+        for each register. ``trace`` is called after every step, or after
+        one of every ``trace.sample`` steps when it has that attribute, with
+        the index of the executed instruction and the index of the next
+        one. The word changed by a traced step is written back to ``words``
+        before the call. Returns the amount of steps executed."""
+        return self.resume(numbs, words, 0, 0, max_steps, None, trace)[1]
+
+    def resume(self, numbs, words, i, s, max_steps=None, pause=None,
+               trace=None):
+        """Runs the bytecode from the instruction ``i`` after ``s`` steps
+        until it ends or the steps reach ``pause``. A fused loop or a
+        macro started before ``pause`` runs to its end, so the run can
+        stop a few steps after it. Returns the next instruction, ``size``
+        when the program ended, and the steps."""
+        plain = self.ops
+        ops = self.fused if trace is None else plain
+        widths = SUPER_STEPS
+        xa = self.a
+        xb = self.b
+        xc = self.c
+        macros = self.macros
+        idioms = self.idioms
+        labels = self.labels
+        synced = self.synced
+        alphabet = self.alphabet
+        # Characters as codes, the empty one can't start any word
+        codes = [alphabet.code(x) if x else -1 for x in self.consts]
+        limit = -1 if max_steps is None else max_steps
+        # Steps where the run stops, with an error if they are the limit
+        stop = sys.maxsize if max_steps is None else max_steps
+        if (pause is not None and pause < stop):
+            stop = pause
+        # Fused loops are only skipped up to a real bound
+        bound = -1 if stop == sys.maxsize else stop
+        budget = sys.maxsize
+        left = sample = getattr(trace, "sample", 1)
+
+        ws = [alphabet.word(w) for w in words]
+
+        heads = self.heads
+        # Visits to each loop head
+        hot = dict.fromkeys(heads, 0)
+        watch = self.watch
+
+        try:
+            while True:
+                pc = i
+                op = ops[i]
+                if (op > OP_MACRO):
+                    if (op == OP_HEAD):
+                        hot[i] += 1
+                        if (hot[i] == watch):
+                            i, s, affine = self.fast_forward(pc, numbs, s,
+                                                             bound)
+                            hot[pc] = 0 if affine else -self.backoff
+                            continue
+                        op = heads[i]
+                if (op > OP_MACRO):
+                    if (op >= OP_HALT):
+                        if (op == OP_UNDEF):
+                            raise KeyError(xa[i])
+                        break
+                    # Superinstructions only run when all their steps
+                    # fit, otherwise the sequence runs one by one
+                    if (s+widths[op] <= stop):
+                        if (op == OP_BRANCH):
+                            if (numbs[xa[i]] != 0):
+                                s += 1
+                                i = xc[i]
+                            else:
+                                s += 2
+                                i = xc[i+1]
+                        elif (op == OP_DECINCJ):
+                            n = xa[i]
+                            if (numbs[n] > 0):
+                                numbs[n] -= 1
+                            numbs[xa[i+1]] += 1
+                            s += 3
+                            i = xc[i+2]
+                        elif (op == OP_BRANCHW):
+                            w = ws[xa[i]]
+                            if (w.start < w.end and
+                                    w.buf[w.start] == codes[xb[i]]):
+                                s += 1
+                                i = xc[i]
+                            else:
+                                s += 2
+                                i = xc[i+1]
+                        elif (op == OP_DECINC):
+                            n = xa[i]
+                            if (numbs[n] > 0):
+                                numbs[n] -= 1
+                            numbs[xa[i+1]] += 1
+                            s += 2
+                            i += 2
+                        else:
+                            numbs[xa[i]] = 1
+                            s += 2
+                            i += 2
+                        continue
+                    op = plain[i]
+                if (s >= stop):
+                    if (s == limit):
+                        raise RuntimeError("Max ammount of steps reached")
+                    break
+                s += 1
+                if (op == OP_IFNZ):
+                    if (numbs[xa[i]] != 0):
+                        i = xc[i]
+                    else:
+                        i += 1
+                elif (op == OP_GOTO):
+                    i = xc[i]
+                elif (op == OP_PRED):
+                    n = xa[i]
+                    if (numbs[n] > 0):
+                        numbs[n] -= 1
+                    i += 1
+                elif (op == OP_SUC):
+                    numbs[xa[i]] += 1
+                    i += 1
+                elif (op == OP_ASSN):
+                    numbs[xa[i]] = numbs[xb[i]]
+                    i += 1
+                elif (op == OP_ZERO):
+                    numbs[xa[i]] = 0
+                    i += 1
+                elif (op == OP_IFBEG):
+                    w = ws[xa[i]]
+                    if (w.start < w.end and w.buf[w.start] == codes[xb[i]]):
+                        i = xc[i]
+                    else:
+                        i += 1
+                elif (op == OP_APPEND):
+                    w = ws[xa[i]]
+                    if (w.end == len(w.buf) and w.start < 64):
+                        w.buf.append(codes[xb[i]])
+                        w.end += 1
+                    else:
+                        w.append(codes[xb[i]])
+                    i += 1
+                elif (op == OP_TAIL):
+                    w = ws[xa[i]]
+                    if (w.start < w.end):
+                        w.start += 1
+                    i += 1
+                elif (op == OP_ASSW):
+                    ws[xa[i]] = ws[xb[i]].copy()
+                    i += 1
+                elif (op == OP_EPS):
+                    ws[xa[i]] = Word()
+                    i += 1
+                elif (op == OP_SKIP):
+                    i += 1
+                else:
+                    # Macros and fused loops work over the strings
+                    regs = synced[i]
+                    for r in regs:
+                        words[r] = alphabet.text(ws[r])
+                    if (op == OP_IDIOM):
+                        if (limit >= 0):
+                            budget = limit-s+1
+                        s += idioms[xb[i]](numbs, words, budget)-1
+                        i = xc[i]
+                    else:
+                        l, numbs, words = macros[xa[i]](numbs, words)
+                        if (l is not None):
+                            i = labels[l]
+                        else:
+                            i += 1
+                    for r in regs:
+                        ws[r] = alphabet.word(words[r])
+                if (trace is not None):
+                    left -= 1
+                    if (left == 0):
+                        left = sample
+                        if (OP_IFBEG < ops[pc] < OP_IDIOM):
+                            words[xa[pc]] = alphabet.text(ws[xa[pc]])
+                        trace(pc, i)
+        finally:
+            for r, w in enumerate(ws):
+                words[r] = alphabet.text(w)
+        return i, s
\ No newline at end of file
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+class Alphabet(object):
+    """Interns the characters of the words as small integers, numbered in
+    the order they are seen. Up to 256 characters can be interned, so words
+    are stored as bytes."""
+
+    def __init__(self, chars=()):
+        self.codes = {}
+        self.chars = {}
+        for c in chars:
+            self.code(c)
+
+    def code(self, char):
+        code = self.codes.get(ord(char))
+        if (code is None):
+            if (len(self.codes) == 256):
+                raise RuntimeError(
+                    "Words can't have more than 256 different characters")
+            code = self.codes[ord(char)] = len(self.codes)
+            self.chars[code] = char
+        return code
+
+    def word(self, text):
+        for c in set(text):
+            self.code(c)
+        buf = bytearray(text.translate(self.codes).encode("latin-1"))
+        return Word(buf, 0, len(buf))
+
+    def text(self, word):
+        buf = word.buf[word.start:word.end]
+        return buf.decode("latin-1").translate(self.chars)
+
+class Word(object):
+    """Word register as a view ``[start, end)`` of a buffer of character
+    codes.
+
+    Buffers are only appended to, so words can share them: assigning a
+    word copies the view, removing the first character moves ``start``
+    and appending writes after ``end`` when nothing was written there yet.
+    A word whose buffer was grown by another one, or that only uses the
+    end of a long buffer, copies its characters to a new buffer first."""
+    __slots__ = ("buf", "start", "end")
+
+    def __init__(self, buf=None, start=0, end=0):
+        self.buf = bytearray() if buf is None else buf
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end-self.start
+
+    def copy(self):
+        return Word(self.buf, self.start, self.end)
+
+    def append(self, code):
+        buf = self.buf
+        if (self.end != len(buf) or
+                (self.start > 64 and self.start > self.end-self.start)):
+            buf = self.buf = buf[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        buf.append(code)
+        self.end += 1
\ No newline at end of file
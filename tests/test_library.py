@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from core import instructions, library
+from core.utils import LanguageSettings
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+class LibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.settings = LanguageSettings("[a-z]",
+                                         instructions.instruction_dict, 0,
+                                         "vm")
+        library._libraries.clear()
+
+    def tearDown(self):
+        library._libraries.clear()
+        shutil.rmtree(self.dir)
+
+    def test_cycle_through_a_stale_pack(self):
+        a = os.path.join(self.dir, "a.vn")
+        b = os.path.join(self.dir, "b.vn")
+        write(a, "INCLUDE b.vn\n{V0 <- ONE} {\n V0 <- 0\n V0 <- V0 + 1\n}\n")
+        write(b, "{V0 <- TWO} {\n V0 <- 0\n V0 <- V0 + 1\n"
+                 " V0 <- V0 + 1\n}\n")
+        library.load_library(a, self.settings)
+        self.assertTrue(os.path.exists(library.get_pack_path(a)))
+        # The pack of a.vn still includes b.vn, which now includes a.vn
+        write(b, "INCLUDE a.vn\n")
+        library._libraries.clear()
+        with self.assertRaisesRegex(SyntaxError, "includes itself"):
+            library.load_library(a, self.settings)
+
+if __name__ == "__main__":
+    unittest.main()
\ No newline at end of file
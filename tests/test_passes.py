@@ -0,0 +1,37 @@
+import unittest
+
+from core import VonNeumannProgram, instructions
+from core.utils import LanguageSettings
+
+# L7 is defined twice, jumps go to the first one. Moving the block of L2
+# after the branch would leave the second one first.
+DUPLICATE_LABEL = """IF N4 /= 0 GOTO L6
+N0 <- N0 + 1
+GOTO L5
+L2 N0 <- N0 + 1
+L7 N0 <- N0 + 1
+GOTO L8
+L6 N0 <- N0 + 1
+L7 N0 <- N0 + 1
+N0 <- N0 + 1
+GOTO L8
+L5 IF N2 /= 0 GOTO L9
+GOTO L2
+L9 GOTO L7
+L8 SKIP
+"""
+
+def run(source, optim, ns):
+    settings = LanguageSettings("[a-z]", instructions.instruction_dict,
+                                optim, "vm")
+    return VonNeumannProgram(source, settings)(ns, [], "n", 10000)
+
+class BranchInversionTest(unittest.TestCase):
+
+    def test_duplicate_labels_keep_their_meaning(self):
+        for ns in ([0, 0, 1], [0, 0, 0], [0, 0, 0, 0, 1]):
+            self.assertEqual(run(DUPLICATE_LABEL, 2, ns),
+                             run(DUPLICATE_LABEL, 1, ns))
+
+if __name__ == "__main__":
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+import subprocess
+
+from core import VonNeumannProgram, instructions
+from core.utils import LanguageSettings
+
+# N1 only grows, so the loop never ends
+UNBOUNDED = """L1 N1 <- N1 + 1
+N0 <- N0 + 1
+IF N1 /= 0 GOTO L1
+"""
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), os.pardir, "examples")
+
+def build(source, optim, backend="vm"):
+    settings = LanguageSettings("[a-z]", instructions.instruction_dict,
+                                optim, backend)
+    return VonNeumannProgram(source, settings)
+
+class FastForwardTest(unittest.TestCase):
+
+    def test_unbounded_loop_hits_the_step_limit(self):
+        for optim in (0, 1, 2):
+            program = build(UNBOUNDED, optim)
+            with self.assertRaisesRegex(RuntimeError,
+                                        "Max ammount of steps reached"):
+                program([3, 4], [], "n", 100000)
+
+    def test_unbounded_loop_never_ends(self):
+        # It used to be skipped to the end of the steps and return
+        code = ("from test_vm import *;"
+                " build(UNBOUNDED, 1)([3, 4], [], 'n', None)")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.dirname(__file__), os.path.join(EXAMPLES, os.pardir)]))
+        with self.assertRaises(subprocess.TimeoutExpired):
+            subprocess.run([sys.executable, "-c", code], env=env,
+                           capture_output=True, timeout=2)
+
+    def test_bounded_loop_is_skipped(self):
+        source = open(os.path.join(EXAMPLES, "vonsum.vn")).read()
+        for optim in (0, 1, 2):
+            program = build(source, optim)
+            self.assertEqual(program([10**8, 5], [], "n", None), 10**8+5)
+
+if __name__ == "__main__":
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Runs programs on a server started with ``vonneu.py --serve``, which
+keeps them compiled between runs. It doesn't import the interpreter, so it
+starts fast."""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import http.client
+
+DEFAULT_ADDRESS = "unix:"+os.path.expanduser("~/.vonneu.sock")
+DEFAULT_TOKEN_FILE = os.path.expanduser("~/.vonneu.token")
+
+class UnixConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket"""
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def connect(address, timeout=None):
+    """Connection to the server on ``address``, a Unix socket path or
+    ``host:port``"""
+    if (address.startswith("unix:")):
+        return UnixConnection(address[5:], timeout)
+    if ("/" in address):
+        return UnixConnection(address, timeout)
+    host, _, port = address.rpartition(":")
+    return http.client.HTTPConnection(host or "127.0.0.1", int(port),
+                                      timeout=timeout)
+
+def request(address, method, path, data=None, token=None):
+    """Sends a request to the server and returns its status and answer.
+    ``token`` is needed by servers on a TCP port."""
+    conn = connect(address)
+    try:
+        body = None if data is None else json.dumps(data)
+        headers = {"Content-Type": "application/json"}
+        if (token is not None):
+            headers["Authorization"] = f"Bearer {token}"
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+aparser = argparse.ArgumentParser(
+    description="Run Sigma-Von Neumann programs on a vonneu.py server")
+aparser.add_argument("-i", "--input",
+    metavar="I",
+    type=argparse.FileType("r"),
+    default=None,
+    help="Input program file"
+    )
+aparser.add_argument("-a", "--alpha",
+    metavar="A",
+    type=str,
+    default="[a-z0-9]",
+    help="The program's alphabet. Default [a-z0-9]."
+    )
+aparser.add_argument("-r", "--ret",
+    metavar="[nw]",
+    type=str,
+    default="n",
+    choices="nw",
+    help="Return value. Either n (number) or w (word). Default n."
+    )
+aparser.add_argument("-O",
+    metavar="O",
+    type=int,
+    default=0,
+    choices=[0,1,2],
+    help="Optimization level, as on vonneu.py. Default 0."
+    )
+aparser.add_argument("--inline-limit",
+    metavar="S",
+    type=int,
+    default=None,
+    help="Emit the macros longer than S instructions as subroutines, as on"
+         " vonneu.py"
+    )
+aparser.add_argument("--safe-macros",
+    action="store_true",
+    help="Only use the optimized code of the macros that match their body,"
+         " as on vonneu.py"
+    )
+aparser.add_argument("-m", "--max-steps",
+    metavar="M",
+    type=int,
+    default=None,
+    help="Max ammount of steps to run the program"
+    )
+aparser.add_argument("--timeout",
+    metavar="T",
+    type=float,
+    default=None,
+    help="Seconds the run can take on the server"
+    )
+aparser.add_argument("--priority",
+    metavar="P",
+    type=float,
+    default=1,
+    help="Share of the server given to the run relative to the others."
+         " Default 1."
+    )
+aparser.add_argument("-s", "--server",
+    metavar="ADDR",
+    type=str,
+    default=DEFAULT_ADDRESS,
+    help=f"Address of the server. Default {DEFAULT_ADDRESS}"
+    )
+aparser.add_argument("--token",
+    metavar="T",
+    type=str,
+    default=None,
+    help="Token of a server on a TCP port. By default it is read from the"
+         " token file"
+    )
+aparser.add_argument("--token-file",
+    metavar="FILE",
+    type=str,
+    default=DEFAULT_TOKEN_FILE,
+    help="File where the server on a TCP port wrote its token, as on"
+         f" vonneu.py. Default {DEFAULT_TOKEN_FILE}"
+    )
+aparser.add_argument("--stats",
+    action="store_true",
+    help="Print the statistics of the server instead of running a program"
+    )
+aparser.add_argument('-ns',
+    metavar='N',
+    type=int,
+    nargs='*',
+    default=[],
+    help="Numeric arguments."
+    )
+aparser.add_argument('-ws',
+    metavar='W',
+    type=str,
+    nargs="*",
+    default=[],
+    help="Word arguments."
+    )
+
+if __name__=="__main__":
+    args = aparser.parse_args()
+    token = args.token
+    if (token is None and os.path.exists(args.token_file)):
+        with open(args.token_file) as f:
+            token = f.read().strip()
+    if (args.stats):
+        status, answer = request(args.server, "GET", "/stats", None, token)
+        print(json.dumps(answer, indent=2))
+        sys.exit(0 if status == 200 else 1)
+    if (args.input is None):
+        aparser.error("the following arguments are required: -i/--input")
+    with args.input:
+        source = args.input.read()
+    status, answer = request(args.server, "POST", "/run", {
+        "source": source,
+        # Included libraries are relative to the program's file
+        "base": os.path.dirname(os.path.abspath(args.input.name)),
+        "alpha": args.alpha,
+        "O": args.O,
+        "inline_limit": args.inline_limit,
+        "safe_macros": args.safe_macros,
+        "ret": args.ret,
+        "ns": args.ns,
+        "ws": args.ws,
+        "max_steps": args.max_steps,
+        "timeout": args.timeout,
+        "priority": args.priority,
+    }, token)
+    if ("error" in answer):
+        print(answer["error"], file=sys.stderr)
+        sys.exit(1)
+    print(answer["result"])
\ No newline at end of file
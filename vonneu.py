@@ -3,18 +3,28 @@
 import logging
 import argparse
 import sys
+import os
+import json
+import asyncio
 
 from core import *
 from core import instructions
 from core.utils import LanguageSettings, clean_program
+from core.cache import compile_cached
+from core.trace import StepTrace
+from core.batch import BatchRunner, READERS
+from core.lockstep import LockstepRunner
+from core.results import ResultCache
+from core.server import VonNeumannServer, DEFAULT_ADDRESS, DEFAULT_TOKEN_FILE
+from core.verify import verify_macros
 
 aparser = argparse.ArgumentParser(
     description="Process and interpret Sigma-Von Neumann imperative Programs"
     )
 aparser.add_argument("-i", "--input",
     metavar="I",
-    type=open,
-    required=True,
+    type=str,
+    default=None,
     help="Input program file"
     )
 aparser.add_argument("-a", "--alpha",
@@ -42,14 +52,187 @@ aparser.add_argument("-O",
     metavar="O",
     type=int,
     default=0,
-    choices=[0,1],
-    help="Optimaziations. Setting this to 1 will use the macro's python code")
+    choices=[0,1,2],
+    help="Optimaziations. Setting this to 1 will use the macro's python code"
+    " and fuse counting loops, 2 also runs the optimization passes over the"
+    " expanded program")
+aparser.add_argument("-b", "--backend",
+    metavar="B",
+    type=str,
+    default="vm",
+    choices=["vm", "compiled", "object"],
+    help="Execution backend. vm runs the program compiled to bytecode,"
+         " compiled generates a python function for the whole program and"
+         " object runs the reference interpreter. Default vm."
+    )
+aparser.add_argument("--inline-limit",
+    metavar="S",
+    type=int,
+    default=None,
+    help="Emit the macros whose body has more than S instructions once, as a"
+         " subroutine shared by their calls, instead of expanding each call."
+         " By default every call is expanded"
+    )
+aparser.add_argument("--safe-macros",
+    action="store_true",
+    help="With -O1 or more, check the optimized code of each macro against"
+         " its body before using it, and expand the calls of the ones that"
+         " differ"
+    )
+aparser.add_argument("--verify-macros",
+    action="store_true",
+    help="Check the optimized code of every macro against its body, print"
+         " the differences as JSON and exit with status 1 if any differ"
+    )
+aparser.add_argument("--no-cache",
+    action="store_true",
+    help="Don't read nor write the compiled program cache (.vnc file)"
+    )
 aparser.add_argument("-m", "--max-steps",
     metavar="M",
     type=int,
     default=None,
     help="Max ammount of steps to run the program"
 )
+aparser.add_argument("--profile",
+    metavar="FILE",
+    type=str,
+    default=None,
+    help="Count the steps of each instruction and macro and write the report"
+         " as JSON to FILE, and as collapsed stacks for flame graphs to FILE"
+         " with the .folded extension"
+)
+aparser.add_argument("--batch",
+    metavar="FILE",
+    type=str,
+    default=None,
+    help="Run the program once for each input of FILE (- for stdin), a JSON"
+         " lines or CSV file, printing one JSON line for each run"
+)
+aparser.add_argument("--batch-format",
+    metavar="F",
+    type=str,
+    default=None,
+    choices=["jsonl", "csv"],
+    help="Format of the batch inputs, jsonl or csv. By default taken from"
+         " the extension of the file, jsonl for stdin."
+)
+aparser.add_argument("-j", "--jobs",
+    metavar="J",
+    type=int,
+    default=None,
+    help="Processes running the batch. Default one for each core."
+)
+aparser.add_argument("--lockstep",
+    action="store_true",
+    help="Run the inputs of the batch together on this process, with each"
+         " number register as a numpy array over the inputs. Needs numpy"
+)
+aparser.add_argument("--timeout",
+    metavar="T",
+    type=float,
+    default=None,
+    help="Seconds each run of the batch can take"
+)
+aparser.add_argument("--unordered",
+    action="store_true",
+    help="Print the results of the batch as they are done instead of in the"
+         " order of the inputs"
+)
+aparser.add_argument("--memo",
+    metavar="DB",
+    type=str,
+    nargs="?",
+    const="",
+    default=None,
+    help="Reuse the results of previous runs with the same program and"
+         " inputs. Results are kept in memory and, if DB is given, on that"
+         " sqlite database"
+)
+aparser.add_argument("--serve",
+    metavar="ADDR",
+    type=str,
+    nargs="?",
+    const=DEFAULT_ADDRESS,
+    default=None,
+    help="Run a server that compiles and runs programs for vonclient.py on"
+         " ADDR, host:port or a Unix socket path. Default"
+         f" {DEFAULT_ADDRESS}"
+)
+aparser.add_argument("--token-file",
+    metavar="FILE",
+    type=str,
+    default=DEFAULT_TOKEN_FILE,
+    help="File where a server on a TCP port writes the token its clients"
+         f" must send. Default {DEFAULT_TOKEN_FILE}"
+)
+aparser.add_argument("--allow-python",
+    action="store_true",
+    help="Let the server run the python code of the macros sent to it"
+)
+aparser.add_argument("--max-programs",
+    metavar="P",
+    type=int,
+    default=64,
+    help="Compiled programs kept in memory by the server. Default 64."
+)
+aparser.add_argument("--max-runs",
+    metavar="R",
+    type=int,
+    default=32,
+    help="Runs the server runs at once, up to 8 times more wait for their"
+         " turn. Default 32."
+)
+aparser.add_argument("--trace-size",
+    metavar="T",
+    type=int,
+    default=1 << 16,
+    help="Amount of steps kept by the trace logged with INFO verbosity."
+         " Default 65536."
+)
+aparser.add_argument("--trace-sample",
+    metavar="S",
+    type=int,
+    default=1,
+    help="Trace only one of every S steps. Default 1."
+)
+aparser.add_argument("--at",
+    metavar="S",
+    type=int,
+    action="append",
+    default=[],
+    help="Record the run and print the state after S steps. Can be given"
+         " many times."
+)
+aparser.add_argument("--last-write",
+    metavar="R",
+    type=str,
+    action="append",
+    default=[],
+    help="Record the run and print the last step that wrote the register R,"
+         " as N3 or P0. Can be given many times."
+)
+aparser.add_argument("--first-empty",
+    metavar="R",
+    type=str,
+    action="append",
+    default=[],
+    help="Record the run and print the first step that left the word"
+         " register R empty. Can be given many times."
+)
+aparser.add_argument("--snapshot-every",
+    metavar="K",
+    type=int,
+    default=1024,
+    help="Steps between the snapshots of a recorded run. Default 1024."
+)
+aparser.add_argument("--record-budget",
+    metavar="MB",
+    type=float,
+    default=64,
+    help="Megabytes a recorded run can take, older steps are dropped past"
+         " it. Default 64."
+)
 aparser.add_argument('-ns',
     metavar='N',
     type=int,
@@ -74,14 +257,101 @@ if __name__=="__main__":
         sys.tracebacklimit = -1
 
     logging.debug(f"Arguments: {args}")
-    prog = args.input.read()
-    logging.debug(f"Program: {prog}")
-    settings = LanguageSettings(args.alpha, instructions.instruction_dict, args.O)
+    if (args.serve):
+        server = VonNeumannServer(args.max_programs, args.max_runs,
+                                  8*args.max_runs,
+                                  token_file=args.token_file,
+                                  allow_python=args.allow_python)
+        try:
+            asyncio.run(server.serve_forever(args.serve))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    if (args.input is None):
+        aparser.error("the following arguments are required: -i/--input")
+    if (not os.path.isfile(args.input)):
+        aparser.error(f"argument -i/--input: can't open '{args.input}'")
+    settings = LanguageSettings(args.alpha,
+                                instructions.instruction_dict,
+                                args.O,
+                                args.backend,
+                                args.inline_limit,
+                                args.safe_macros)
     for s in args.ws:
         for c in s:
             if (c not in args.alpha):
                 raise ValueError(
                     "Words passed to the program must be on the given alphabet"
                     f"({args.alpha})")
-    program = VonNeumannProgram(prog, settings=settings)
-    print(program(args.ns, args.ws, args.ret, args.max_steps))
\ No newline at end of file
+    if (args.no_cache or args.verify_macros):
+        # Cached programs only keep the macros they call
+        with open(args.input) as f:
+            program = VonNeumannProgram(f, settings=settings)
+    else:
+        program = compile_cached(args.input, settings)
+    if (args.verify_macros):
+        reports = verify_macros(program)
+        for report in reports:
+            print(json.dumps(report.as_dict()))
+        sys.exit(0 if all(r.verified for r in reports) else 1)
+    if (args.batch):
+        fmt = args.batch_format
+        if (fmt is None):
+            fmt = "csv" if args.batch.endswith(".csv") else "jsonl"
+        if (args.lockstep):
+            if (args.timeout is not None or args.memo is not None):
+                aparser.error("--lockstep can't be used with --timeout nor"
+                              " --memo")
+            runner = LockstepRunner(program, args.ret, args.max_steps)
+        else:
+            runner = BatchRunner(program, args.ret, args.max_steps,
+                                 args.timeout, args.jobs, args.memo)
+        stream = sys.stdin if args.batch == "-" else open(args.batch)
+        with stream:
+            results = (runner.run(READERS[fmt](stream)) if args.lockstep
+                       else runner.run(READERS[fmt](stream),
+                                       not args.unordered))
+            for result in results:
+                print(json.dumps(result), flush=True)
+        sys.exit(0)
+    if (args.profile):
+        profile = program.profile(args.ns, args.ws, args.ret, args.max_steps)
+        with open(args.profile, "w") as f:
+            f.write(profile.get_json())
+        with open(os.path.splitext(args.profile)[0]+".folded", "w") as f:
+            f.write(profile.get_collapsed())
+        print(profile.result)
+        sys.exit(0)
+    if (args.at or args.last_write or args.first_empty):
+        recorder = program.record(args.ns, args.ws, args.ret, args.max_steps,
+                                  args.snapshot_every,
+                                  int(args.record_budget*(1 << 20)))
+        answers = []
+        for step in args.at:
+            i, numbs, words = recorder.state(step)
+            answers.append({"at": step, "next": i,
+                            "numbs": {f"N{r}": v for r, v in numbs.items()},
+                            "words": {f"P{r}": v for r, v in words.items()}})
+        for name in args.last_write:
+            answers.append({"last_write": name,
+                            "step": recorder.last_write(name)})
+        for name in args.first_empty:
+            answers.append({"first_empty": name,
+                            "step": recorder.first_empty(name)})
+        for answer in answers:
+            print(json.dumps(answer))
+        if (recorder.error is not None):
+            print(f"{type(recorder.error).__name__}: {recorder.error}",
+                  file=sys.stderr)
+            sys.exit(1)
+        print(recorder.result)
+        sys.exit(0)
+    if (args.memo is not None):
+        program.result_cache = ResultCache(args.memo or None)
+    trace = None
+    if (numeric_level <= logging.INFO and args.backend != "compiled" and
+            args.memo is None):
+        trace = StepTrace(program, args.trace_size, args.trace_sample)
+    print(program(args.ns, args.ws, args.ret, args.max_steps, trace))
+    if (program.result_cache is not None):
+        logging.debug(f"Result cache {program.result_cache.stats()}")
\ No newline at end of file